@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+### End-to-end benchmarks of tokenize, parse and interpret (including send) using the debug client
+from __future__ import annotations
+from typing import *
+from time import perf_counter
+
+import asyncio
+import json
+import platform
+import tracemalloc
+
+from .clients.debug import Context
+from .impls.shparser import Parser, ENGINES
+from .impls.interpreter import Interpreter
+from .impls.cache import ByteLRUCache
+from .impls.command import commands
+from . import commands as builtin_commands  # registers the builtin commands lazily
+
+__all__: List[str] = ['Case', 'CASES', 'run_case', 'run']
+
+class Case:
+    def __init__(self, name: str, script: str, variables: Dict[str, str] = None, attachments: Dict[str, bytes] = None):
+        self.name = name
+        self.script = script
+        self.variables = variables or {}
+        self.attachments = attachments or {}
+
+    def __repr__(self):
+        return f"<Case {self.name} {len(self.script)}B>"
+
+VARIABLES = {f"V{i}": f"value{i}" for i in range(32)}
+
+CASES: List[Case] = [
+    Case('short', "echo hello world"),
+    Case('long', "echo " + " ".join(f"word{i}" for i in range(400))),
+    Case('deep_pipe', "echo start" + " | echo" * 50 + " | cb -l txt"),
+    Case('many_statements', "; ".join(f"echo line{i}" for i in range(200))),
+    Case('var_expansion', " ; ".join(f'echo $V{i % 32} "quoted $V{(i + 1) % 32} text"' for i in range(100)), variables=VARIABLES),
+    Case('large_attachment', "cb -l txt < big.bin", attachments={'big.bin': b'x' * (4 * 1024 * 1024)}),
+    Case('heredoc', "cb -l txt << EOF\n" + "some inline data, pasted by hand\n" * 4096 + "EOF"),
+    Case('redirects', "echo a > a.txt; echo b 1> b.txt; echo c 2> c.txt; echo d | cb > d.txt; echo done"),
+]
+
+def percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return 0.0
+
+    samples = sorted(samples)
+    k = (len(samples) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(samples) - 1)
+    return samples[f] + (samples[c] - samples[f]) * (k - f)
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    return {
+        'mean_us': sum(samples) / len(samples) * 1e6 if samples else 0.0,
+        'p50_us': percentile(samples, 50) * 1e6,
+        'p95_us': percentile(samples, 95) * 1e6,
+        'p99_us': percentile(samples, 99) * 1e6,
+        'max_us': max(samples) * 1e6 if samples else 0.0,
+    }
+
+async def run_once(case: Case, parser: Parser, interpreter: Interpreter) -> Tuple[float, float, float]:
+    ctx = Context(None, attachments=case.attachments, quiet=True)
+
+    started = perf_counter()
+    tokens = parser.tokenize(case.script, case.variables, ctx.client_name)
+    tokenized = perf_counter()
+    instrs = parser.parse(tokens, ctx.client_name)
+    parsed = perf_counter()
+    await interpreter.interpret(ctx, commands, instrs)
+    interpreted = perf_counter()
+
+    return tokenized - started, parsed - tokenized, interpreted - parsed
+
+async def run_case(case: Case, iterations: int = 200, engine: str = 'classic', streaming: bool = False) -> Dict[str, Any]:
+    parser = Parser(engine=engine)
+    # attachments are fetched every time so the `<` path is measured, not the cache
+    interpreter = Interpreter(streaming=streaming, attachment_cache=ByteLRUCache(max_bytes=0))
+
+    await run_once(case, parser, interpreter)
+
+    stages: Dict[str, List[float]] = {'tokenize': [], 'parse': [], 'interpret': [], 'total': []}
+    started = perf_counter()
+    for _ in range(iterations):
+        tokenize, parse, interpret = await run_once(case, parser, interpreter)
+        stages['tokenize'].append(tokenize)
+        stages['parse'].append(parse)
+        stages['interpret'].append(interpret)
+        stages['total'].append(tokenize + parse + interpret)
+    elapsed = perf_counter() - started
+
+    tracemalloc.start()
+    await run_once(case, parser, interpreter)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'case': case.name,
+        'script_bytes': len(case.script),
+        'iterations': iterations,
+        'throughput_per_s': iterations / elapsed,
+        'peak_memory_bytes': peak,
+        'stages': {stage: summarize(samples) for stage, samples in stages.items()},
+    }
+
+async def run(
+    cases: Iterable[Case] = CASES,
+    iterations: int = 200,
+    engine: str = 'classic',
+    streaming: bool = False,
+) -> Dict[str, Any]:
+    return {
+        'python': platform.python_version(),
+        'engine': engine,
+        'streaming': streaming,
+        'results': [await run_case(case, iterations, engine, streaming) for case in cases],
+    }
+
+def report(results: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> str:
+    previous = {result['case']: result for result in baseline['results']} if baseline else {}
+    lines = [f"{'case':<18} {'ops/s':>10} {'p50 us':>10} {'p95 us':>10} {'p99 us':>10} {'peak KiB':>10}  change"]
+    for result in results['results']:
+        total = result['stages']['total']
+        change = ''
+        if result['case'] in previous:
+            before = previous[result['case']]['throughput_per_s']
+            change = f"{(result['throughput_per_s'] / before - 1) * 100:+.1f}% ops/s"
+        lines.append(
+            f"{result['case']:<18} {result['throughput_per_s']:>10.1f} {total['p50_us']:>10.1f} "
+            f"{total['p95_us']:>10.1f} {total['p99_us']:>10.1f} {result['peak_memory_bytes'] / 1024:>10.1f}  {change}"
+        )
+
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser: Any = argparse.ArgumentParser(description="end-to-end benchmarks for shbot")
+    parser.add_argument("--iterations", "-n", type=int, default=200, help="runs per case")
+    parser.add_argument("--engine", "-e", choices=ENGINES, default="classic", help="tokenizer engine to use")
+    parser.add_argument("--streaming", action="store_true", help="run pipes in streaming mode")
+    parser.add_argument("--cases", "-c", nargs="+", metavar="CASE", help="only run these cases")
+    parser.add_argument("--output", "-o", metavar="FILE", help="write the results as json to FILE")
+    parser.add_argument("--compare", metavar="FILE", help="compare against results saved with --output")
+
+    args = parser.parse_args()
+
+    cases = [case for case in CASES if args.cases is None or case.name in args.cases]
+    results = asyncio.run(run(cases, args.iterations, args.engine, args.streaming))
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+
+    print(report(results, baseline))
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
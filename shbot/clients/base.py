@@ -1,8 +1,14 @@
 ### This holds the implementation of the base client
 from __future__ import annotations
 from typing import *
+from functools import wraps
+from time import perf_counter
 
-__all__: List[str] = ['Context', 'Files', 'File']
+import io
+
+from ..impls.metrics import metrics
+
+__all__: List[str] = ['Context', 'Files', 'File', 'OutputPolicy', 'BufferReader', 'RateLimitedError', 'open_buffer', 'instrumented']
 
 class File:
     def __init__(self, filename: str, fp: bytes):
@@ -10,21 +16,164 @@ class File:
         self.fp = fp
         
     def __repr__(self):
-        return f"<filename={repr(self.filename)}, fp={str(len(self.fp)) + 'B' if len(self.fp) > 1000 else repr(self.fp)}>"
+        return f"<filename={repr(self.filename)}, fp={str(len(self.fp)) + 'B' if len(self.fp) > 1000 else repr(bytes(self.fp))}>"
     
 Files = Iterable[File]
 
+class RateLimitedError(Exception):
+    """raised by `Context.send` when the platform refused a message, it may be retried after `retry_after` seconds"""
+    def __init__(self, retry_after: float):
+        super().__init__(f"rate limited, retry after {retry_after:.2f}s")
+        self.retry_after = retry_after
+
+class BufferReader(io.RawIOBase):
+    """a read only file over a bytes-like object that doesn't copy it, unlike BytesIO for anything but bytes"""
+
+    def __init__(self, buffer: Any):
+        self._view = memoryview(buffer).cast('B')
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def readinto(self, buffer: Any) -> int:
+        chunk = self._view[self._pos : self._pos + len(buffer)]
+        n = len(chunk)
+        memoryview(buffer).cast('B')[:n] = chunk
+        self._pos += n
+        return n
+
+    def readall(self) -> bytes:
+        content = self._view[self._pos :].tobytes()
+        self._pos = len(self._view)
+        return content
+
+    def close(self) -> None:
+        self._view.release()
+        super().close()
+
+def open_buffer(buffer: Any) -> BinaryIO:
+    """a file to upload `buffer` from, bytes are shared by BytesIO itself"""
+    return io.BytesIO(buffer) if isinstance(buffer, bytes) else BufferReader(buffer)
+
+class OutputPolicy:
+    """how output that doesn't fit in one message is delivered:
+    'paginate' sends up to `max_pages` messages (attaching the whole output to the last one
+    if even that isn't enough), 'file' attaches the whole output as `filename` and 'truncate',
+    which has to be asked for, drops it"""
+    MODES = ('truncate', 'paginate', 'file')
+
+    def __init__(self, mode: str = 'paginate', limit: int = 2000, max_pages: int = 5, filename: str = 'output.txt', empty: str = '** **'):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown output policy mode {repr(mode)}, expected one of {self.MODES}")
+
+        self.mode = mode
+        self.limit = limit
+        self.max_pages = max(max_pages, 1)
+        self.filename = filename
+        self.empty = empty
+
+    def __repr__(self):
+        return f"<OutputPolicy mode={self.mode} limit={self.limit} max_pages={self.max_pages}>"
+
+def instrumented(stage: str):
+    """records the latency and errors of a `send` or `fetch_attachment_content` implementation"""
+    def decorator(coro):
+        @wraps(coro)
+        async def wrap(self, *args, **kwargs):
+            if not metrics.enabled:
+                return await coro(self, *args, **kwargs)
+
+            started = perf_counter()
+            try:
+                return await coro(self, *args, **kwargs)
+            except BaseException:
+                metrics.inc('errors_total', stage=stage, client=self.client_name)
+                raise
+            finally:
+                metrics.observe('stage_seconds', perf_counter() - started, stage=stage, client=self.client_name)
+        return wrap
+    return decorator
+
 class Context:
-    
+    output_policy = OutputPolicy()
+    # the Outbox messages are queued in (see clients.outbound), None sends them right away
+    outbox: Optional[Any] = None
+    # the Capture received scripts are recorded to (see clients.capture), None records nothing
+    capture: Optional[Any] = None
+
     def __init__(self, message):
         self.message = message
         self.client_name = 'base'
         
     async def send(self, content: str = None, files: Files = None) -> None:
+        """sends one message, raises RateLimitedError when the platform asks to slow down"""
         raise NotImplementedError
     
+    def get_channel_id(self) -> Hashable:
+        raise NotImplementedError
+
+    def get_author_id(self) -> Hashable:
+        raise NotImplementedError
+
+    def get_guild_id(self) -> Optional[Hashable]:
+        """the guild (or server) the message was sent in, None in direct messages"""
+        return None
+
+    def is_admin(self) -> bool:
+        """whether the author may use the admin commands"""
+        return False
+
+    async def get_variables(self) -> Mapping[str, str]:
+        """the kept variables the context sees"""
+        from ..impls.env import environment
+
+        return environment.scope(self).base
+
+    async def set_variable(self, scope: str, name: str, value: Optional[str]) -> None:
+        """assigns (or with None unsets) a variable in the context's layer of `scope`"""
+        from ..impls.env import environment
+
+        environment.set(scope, environment.key_of(self, scope), name, value)
+
     def get_attachments(self) -> Dict:
         raise NotImplementedError
     
     async def fetch_attachment_content(self, name: str) -> bytes:
         raise NotImplementedError
+
+    async def stream_attachment_content(self, attch) -> AsyncIterator[bytes]:
+        """the content of an attachment chunk by chunk, in one piece unless the client streams it"""
+        yield await self.fetch_attachment_content(attch)
+
+    def streams_attachment(self, attch) -> bool:
+        """whether stream_attachment_content yields the attachment as it downloads, a streaming interpreter
+        then pipes it into the command reading it instead of fetching it before the script runs"""
+        return False
+
+    def attachment_key(self, attch) -> Optional[Hashable]:
+        """identifies an attachment across messages so its content can be cached, None disables caching"""
+        return None
+
+    def attachment_size(self, attch) -> Optional[int]:
+        """the size of an attachment if it's known without fetching it"""
+        return None
+
+    def received(self, script: str) -> None:
+        """called with every script the context is about to run"""
+        if self.capture is not None:
+            self.capture.record(self, script)
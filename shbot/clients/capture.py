@@ -0,0 +1,131 @@
+### Records the scripts contexts receive to a log that shbot.replay plays back
+from __future__ import annotations
+from typing import *
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import perf_counter, time
+
+import gzip
+import json
+import zlib
+
+__all__: List[str] = ['Capture', 'CaptureEntry', 'read_capture', 'write_capture']
+
+class CaptureEntry:
+    __slots__ = ('offset', 'channel', 'author', 'script', 'attachments')
+
+    def __init__(self, offset: float, channel: int, author: int, script: str, attachments: Dict[str, int]):
+        self.offset = offset
+        self.channel = channel
+        self.author = author
+        self.script = script
+        self.attachments = attachments
+
+    def __repr__(self) -> str:
+        return f"<CaptureEntry +{self.offset:.3f}s channel={self.channel} {len(self.script)}B attachments={self.attachments}>"
+
+
+def pseudonym(id: Hashable) -> int:
+    """ids are kept as checksums, enough to tell channels and authors apart without keeping who they were"""
+    return zlib.crc32(repr(id).encode())
+
+class Capture:
+    """appends what contexts receive to `path`, gzipped when it ends in .gz. the first line is a header,
+    every other is a json array of the milliseconds since the capture started, the channel and author
+    pseudonyms, the script and the sizes of its attachments (-1 when unknown). the content of attachments
+    isn't kept. lines are buffered and every `flush_every` entries handed to a thread that writes them,
+    so recording never waits on the file (or gzip)"""
+
+    def __init__(self, path: str, flush_every: int = 64):
+        self.path = path
+        self.flush_every = flush_every
+        self.entries = 0
+        self._started = perf_counter()
+        self._fp: Optional[IO[str]] = gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')
+        self._pending: List[str] = [json.dumps({'version': 1, 'started': time()}) + '\n']
+        # a single thread, so batches are written in the order they were recorded
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='capture')
+        self._written: Optional[Future] = None
+
+    def record(self, ctx: Any, script: str) -> None:
+        if self._fp is None:
+            return
+
+        attachments = ctx.get_attachments() if '<' in script else {}
+        sizes = {}
+        for name, attch in attachments.items():
+            size = ctx.attachment_size(attch)
+            sizes[name] = size if size is not None else -1
+
+        entry = [
+            round((perf_counter() - self._started) * 1000),
+            pseudonym(ctx.get_channel_id()),
+            pseudonym(ctx.get_author_id()),
+            script,
+            sizes,
+        ]
+        self._pending.append(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.entries += 1
+        if self.entries % self.flush_every == 0:
+            self.flush()
+
+    def flush(self) -> None:
+        """hands the buffered lines to the writer thread"""
+        if self._fp is None or not self._pending:
+            return
+
+        lines, self._pending = self._pending, []
+        self._written = self._writer.submit(self._write, self._fp, lines)
+
+    @staticmethod
+    def _write(fp: IO[str], lines: List[str]) -> None:
+        fp.write(''.join(lines))
+        fp.flush()
+
+    def close(self) -> None:
+        """writes what's left and closes the file, raising if a write failed"""
+        if self._fp is None:
+            return
+
+        self.flush()
+        self._writer.shutdown(wait=True)
+        fp, self._fp = self._fp, None
+        try:
+            if self._written is not None:
+                self._written.result()
+        finally:
+            fp.close()
+
+    def __enter__(self) -> Capture:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"<Capture {self.path} entries={self.entries}>"
+
+
+def read_capture(path: str) -> List[CaptureEntry]:
+    with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path)) as fp:
+        header = json.loads(fp.readline() or '{}')
+        if header.get('version') != 1:
+            raise ValueError(f"{path} isn't a capture")
+
+        entries = []
+        for line in fp:
+            try:
+                offset, channel, author, script, attachments = json.loads(line)
+            except ValueError:
+                # the last line of a capture that wasn't closed may be cut short
+                break
+            entries.append(CaptureEntry(offset / 1000, channel, author, script, attachments))
+
+        return entries
+
+def write_capture(path: str, entries: Iterable[CaptureEntry]) -> None:
+    """writes entries made up elsewhere (eg. synthetic traffic) as a capture"""
+    with (gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')) as fp:
+        fp.write(json.dumps({'version': 1, 'started': time()}) + '\n')
+        for entry in entries:
+            line = [round(entry.offset * 1000), entry.channel, entry.author, entry.script, entry.attachments]
+            fp.write(json.dumps(line, separators=(',', ':')) + '\n')
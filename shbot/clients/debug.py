@@ -1,23 +1,121 @@
 from __future__ import annotations
 from typing import *
+from hashlib import blake2b
 from io import BytesIO
 
-from .base import Context as BaseContext, File, Files
+import asyncio
 
-__all__: List[str] = ['Context', 'File']
+from .base import Context as BaseContext, File, Files, OutputPolicy, RateLimitedError, instrumented
+
+__all__: List[str] = ['Context', 'File', 'RateLimitSimulator']
+
+class RateLimitSimulator:
+    """pretends to be a platform that accepts at most `limit` messages per channel every `per` seconds,
+    share one between contexts to test how they cope with rate limits offline"""
+
+    def __init__(self, limit: int = 5, per: float = 5.0):
+        self.limit = limit
+        self.per = per
+        self.refused = 0
+        self._sent: Dict[Hashable, List[float]] = {}
+
+    def check(self, channel: Hashable) -> None:
+        now = asyncio.get_running_loop().time()
+        sent = [t for t in self._sent.get(channel, ()) if t > now - self.per]
+        if len(sent) >= self.limit:
+            self._sent[channel] = sent
+            self.refused += 1
+            raise RateLimitedError(sent[0] + self.per - now if sent else self.per)
+
+        sent.append(now)
+        self._sent[channel] = sent
 
 class Context(BaseContext):
-    def __init__(self, message):
+    def __init__(
+        self,
+        message,
+        attachments: Optional[Dict[str, Union[bytes, str]]] = None,
+        channel_id: Hashable = 'debug',
+        guild_id: Optional[Hashable] = None,
+        author_id: Hashable = 'debug',
+        quiet: bool = False,
+        output_policy: Optional[OutputPolicy] = None,
+        outbox: Optional[Any] = None,
+        rate_limit: Optional[RateLimitSimulator] = None,
+        admin: bool = False,
+        capture: Optional[Any] = None,
+    ):
         self.message = message
         self.client_name = 'debug'
+        self.attachments = attachments if attachments is not None else {'myfile': b'some content'}
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.author_id = author_id
+        self.quiet = quiet
+        if output_policy is not None:
+            self.output_policy = output_policy
+        self.outbox = outbox
+        self.rate_limit = rate_limit
+        self.admin = admin
+        self.capture = capture
+        self.fetches = 0
+        self.sends = 0
+        self.last_sent: Optional[Tuple[Optional[str], Optional[Files]]] = None
         
+    @instrumented('send')
     async def send(self, content: str = None, files: Files = None) -> None:
-        print(f"[DEBUG SEND] content = {repr(content)}, files = {[repr(file) for file in files]}")
+        if self.rate_limit is not None:
+            self.rate_limit.check(self.channel_id)
+
+        self.sends += 1
+        self.last_sent = (content, files)
+        if not self.quiet:
+            print(f"[DEBUG SEND] content = {repr(content)}, files = {[repr(file) for file in files or ()]}")
         
+    def get_channel_id(self) -> Hashable:
+        return self.channel_id
+
+    def get_author_id(self) -> Hashable:
+        return self.author_id
+
+    def get_guild_id(self) -> Optional[Hashable]:
+        return self.guild_id
+
+    def is_admin(self) -> bool:
+        return self.admin
+
     def get_attachments(self) -> Dict:
-        return {'myfile': b'some content'}
-        raise NotImplementedError
+        return {filename: File(filename=filename, fp=fp) for filename, fp in self.attachments.items()}
         
+    @instrumented('fetch')
     async def fetch_attachment_content(self, attch) -> bytes:
-        return b'some content'
-        raise NotImplementedError
+        self.fetches += 1
+        if isinstance(attch.fp, str):
+            # an url, eg. of a StandInServer
+            from .transport import transport
+            return await transport.fetch(attch.fp)
+
+        return attch.fp
+
+    async def stream_attachment_content(self, attch) -> AsyncIterator[bytes]:
+        self.fetches += 1
+        if isinstance(attch.fp, str):
+            from .transport import transport
+            async for chunk in transport.stream(attch.fp):
+                yield chunk
+        else:
+            yield attch.fp
+
+    def streams_attachment(self, attch) -> bool:
+        # the others are in memory already
+        return isinstance(attch.fp, str)
+
+    def attachment_key(self, attch) -> Optional[Hashable]:
+        if isinstance(attch.fp, str):
+            return (self.client_name, attch.fp)
+
+        # keyed on the content itself, two attachments with the same key never have different contents
+        return (self.client_name, blake2b(attch.fp, digest_size=16).digest())
+
+    def attachment_size(self, attch) -> Optional[int]:
+        return len(attch.fp) if not isinstance(attch.fp, str) else None
@@ -1,31 +1,66 @@
-from telnetlib import SE
 from typing import *
-from io import BytesIO
-from typing_extensions import Self
-from click import command
 
 import discord
 
-from shbot.impls.command import CommandOutput
-from ..base import Context as BaseContext, File, Files
+from ..base import Context as BaseContext, File, Files, OutputPolicy, RateLimitedError, instrumented, open_buffer
+from ..outbound import outbox
+from ..transport import transport
 
 __all__: List[str] = ['Context', 'File']
 
 class Context(BaseContext):
+    outbox = outbox
+    # discord messages hold 2000 characters, longer output goes on in more of them
+    output_policy = OutputPolicy(mode='paginate', limit=2000)
+
     def __init__(self, message):
         self.message = message
         self.client_name = 'discord'
         
+    @instrumented('send')
     async def send(self, content: str = None, files: Files = None) -> None:
         if files is not None:
-            files = [discord.File(filename=file.filename, fp=BytesIO(file.fp)) for file in files]
-        await self.message.channel.send(content, files=files)
+            files = [discord.File(filename=file.filename, fp=open_buffer(file.fp)) for file in files]
+        try:
+            await self.message.channel.send(content, files=files)
+        except discord.HTTPException as err:
+            if err.status != 429:
+                raise
+            raise RateLimitedError(float(err.response.headers.get('Retry-After', 1))) from err
         
+    def get_channel_id(self) -> Hashable:
+        return self.message.channel.id
+
+    def get_author_id(self) -> Hashable:
+        return self.message.author.id
+
+    def get_guild_id(self) -> Optional[Hashable]:
+        return self.message.guild.id if self.message.guild is not None else None
+
+    def is_admin(self) -> bool:
+        # authors of direct messages have no guild permissions
+        permissions = getattr(self.message.author, 'guild_permissions', None)
+        return permissions is not None and permissions.administrator
+
     def get_attachments(self) -> Dict:
         return {atch.filename: atch for atch in self.message.attachments}
         
+    @instrumented('fetch')
     async def fetch_attachment_content(self, attch) -> bytes:
-        return await attch.read()
+        # the size discord reports lets an oversized attachment fail before it's downloaded
+        return await transport.fetch(attch.url, size=attch.size)
+
+    def stream_attachment_content(self, attch) -> AsyncIterator[bytes]:
+        return transport.stream(attch.url, size=attch.size)
+
+    def streams_attachment(self, attch) -> bool:
+        return True
+
+    def attachment_key(self, attch) -> Optional[Hashable]:
+        return (self.client_name, attch.id)
+
+    def attachment_size(self, attch) -> Optional[int]:
+        return attch.size
 
     def __eq__(self, item: object) -> bool:
         return item == self.client_name
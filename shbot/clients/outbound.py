@@ -0,0 +1,226 @@
+### Per channel outbound queues shared by the clients, messages are rate limited and coalesced before they're sent
+from __future__ import annotations
+from typing import *
+from collections import deque
+from time import perf_counter
+
+import asyncio
+
+from ..impls.metrics import metrics
+from .base import Context, File, RateLimitedError
+
+__all__: List[str] = ['Outbox', 'TokenBucket', 'OutboxError', 'outbox']
+
+class OutboxError(Exception): pass
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `capacity` of them"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now: float) -> float:
+        """takes a token and returns 0, or returns how long to wait before one is available"""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+
+        return max(self.updated - now, 0.0) + (1 - self.tokens) / self.rate
+
+    def pause(self, now: float, seconds: float) -> None:
+        """empties the bucket and stops it from refilling for `seconds`, eg. after the platform said to retry later"""
+        self._refill(now)
+        self.tokens = 0.0
+        self.updated = max(self.updated, now + seconds)
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Message:
+    __slots__ = ('ctx', 'content', 'files', 'future', 'queued')
+
+    def __init__(self, ctx: Context, content: str, files: List[File], future: asyncio.Future, queued: float):
+        self.ctx = ctx
+        self.content = content
+        self.files = files
+        self.future = future
+        self.queued = queued
+
+
+class Outbox:
+    """queues the messages of every context per channel, a task per busy channel sends them in order
+    at most `rate` per second (bursts of `burst`). messages of the same author waiting in a row in a
+    channel are merged into one (sent as a reply through the first one's context) as long as the text
+    stays under `limit` chars and the files under `max_files`, small ones wait `window` seconds for company. when a send raises RateLimitedError the channel backs off
+    for as long as it was told to and retries, up to `max_retries` times"""
+
+    def __init__(
+        self,
+        rate: float = 1.0,
+        burst: int = 5,
+        window: float = 0.02,
+        limit: int = 2000,
+        max_files: int = 10,
+        max_retries: int = 3,
+        max_queue_depth: int = 256,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.limit = limit
+        self.max_files = max_files
+        self.max_retries = max_retries
+        self.max_queue_depth = max_queue_depth
+        self.sent = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        self._queues: Dict[Hashable, Deque[Message]] = {}
+        self._workers: Dict[Hashable, asyncio.Task] = {}
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+
+    async def send(self, ctx: Context, content: str, files: List[File]) -> None:
+        """queues a message and waits until it (or the message it was merged into) has been sent"""
+        channel = ctx.get_channel_id()
+        queue = self._queues.setdefault(channel, deque())
+        if len(queue) >= self.max_queue_depth:
+            raise OutboxError(f"too many messages waiting to be sent in this channel")
+
+        loop = asyncio.get_running_loop()
+        message = Message(ctx, content, files, loop.create_future(), perf_counter())
+        queue.append(message)
+
+        if metrics.enabled:
+            metrics.observe('outbound_queue_depth', len(queue), client=ctx.client_name)
+
+        if channel not in self._workers:
+            self._workers[channel] = asyncio.ensure_future(self._work(channel))
+
+        await asyncio.shield(message.future)
+
+    def _fits(self, first: Message, length: int, files: int, message: Message) -> bool:
+        return (
+            length + 1 + len(message.content) <= self.limit
+            and files + len(message.files) <= self.max_files
+            and (message.ctx is first.ctx or message.ctx.get_author_id() == first.ctx.get_author_id())
+        )
+
+    def _take(self, queue: Deque[Message]) -> List[Message]:
+        """pops the first message and every following one that can be merged into it"""
+        batch = [queue.popleft()]
+        length = len(batch[0].content)
+        files = len(batch[0].files)
+        while queue and self._fits(batch[0], length, files, queue[0]):
+            message = queue.popleft()
+            batch.append(message)
+            length += 1 + len(message.content)
+            files += len(message.files)
+
+        return batch
+
+    def _merge(self, batch: List[Message]) -> Tuple[str, List[File]]:
+        if len(batch) == 1:
+            return batch[0].content, batch[0].files
+
+        empty = batch[0].ctx.output_policy.empty
+        content = '\n'.join(message.content for message in batch if message.content != empty) or empty
+        return content, [file for message in batch for file in message.files]
+
+    async def _work(self, channel: Hashable) -> None:
+        loop = asyncio.get_running_loop()
+        queue = self._queues[channel]
+        bucket = self._buckets.get(channel)
+        if bucket is None:
+            bucket = self._buckets[channel] = TokenBucket(self.rate, self.burst, loop.time())
+
+        try:
+            while queue:
+                if self.window > 0 and len(queue[0].content) < self.limit:
+                    await asyncio.sleep(self.window)
+
+                batch = self._take(queue)
+                try:
+                    content, files = self._merge(batch)
+                    try:
+                        await self._send(batch[0].ctx, bucket, content, files)
+                    except Exception as err:
+                        for message in batch:
+                            if not message.future.done():
+                                message.future.set_exception(err)
+                        continue
+
+                    self.sent += 1
+                    self.coalesced += len(batch) - 1
+                    now = perf_counter()
+                    for message in batch:
+                        if metrics.enabled:
+                            metrics.observe('outbound_wait_seconds', now - message.queued, client=message.ctx.client_name)
+                        if not message.future.done():
+                            message.future.set_result(None)
+
+                    if metrics.enabled and len(batch) > 1:
+                        metrics.inc('outbound_coalesced_total', len(batch) - 1, client=batch[0].ctx.client_name)
+                finally:
+                    # the worker was cancelled while sending, whoever waits on the batch mustn't wait forever
+                    for message in batch:
+                        if not message.future.done():
+                            message.future.cancel()
+        except BaseException:
+            # and neither must whoever waits on the messages it didn't get to
+            while queue:
+                queue.popleft().future.cancel()
+            raise
+        finally:
+            del self._workers[channel]
+            if not queue:
+                del self._queues[channel]
+            if bucket.full(loop.time()):
+                del self._buckets[channel]
+
+    async def _send(self, ctx: Context, bucket: TokenBucket, content: str, files: List[File]) -> None:
+        loop = asyncio.get_running_loop()
+        retries = 0
+        while True:
+            wait = bucket.take(loop.time())
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = bucket.take(loop.time())
+
+            try:
+                return await ctx.send(content, files=files)
+            except RateLimitedError as err:
+                self.rate_limited += 1
+                if metrics.enabled:
+                    metrics.inc('outbound_rate_limited_total', client=ctx.client_name)
+
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+
+                bucket.pause(loop.time(), err.retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'channels': len(self._workers),
+            'queued': sum(len(queue) for queue in self._queues.values()),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'rate_limited': self.rate_limited,
+        }
+
+    def __repr__(self) -> str:
+        return f"<Outbox {self.stats()}>"
+
+
+outbox = Outbox()
@@ -1,18 +1,59 @@
 from typing import *
-from io import BytesIO
 
 import revolt
-import asyncio
-import aiohttp
 
-class Client(revolt.Client):
-    async def on_message(self, message: revolt.Message):
-        if message.content == "hello":
-            await message.channel.send("hi how are you")
+from ..base import Context as BaseContext, File, Files, OutputPolicy, instrumented
+from ..outbound import outbox
+from ..transport import transport
 
-async def main():
-    async with aiohttp.ClientSession() as session:
-        client = Client(session, "BOT TOKEN HERE")
-        await client.start()
+__all__: List[str] = ['Context', 'File', 'make_client']
 
-asyncio.run(main())
+class Context(BaseContext):
+    outbox = outbox
+    # revolt messages hold 2000 characters, longer output goes on in more of them
+    output_policy = OutputPolicy(mode='paginate', limit=2000)
+
+    def __init__(self, message: revolt.Message):
+        self.message = message
+        self.client_name = 'revolt'
+
+    @instrumented('send')
+    async def send(self, content: str = None, files: Files = None) -> None:
+        attachments = [revolt.File(bytes(file.fp), filename=file.filename) for file in files or ()]
+        await self.message.channel.send(content, attachments=attachments or None)
+
+    def get_channel_id(self) -> Hashable:
+        return self.message.channel.id
+
+    def get_author_id(self) -> Hashable:
+        return self.message.author.id
+
+    def get_guild_id(self) -> Optional[Hashable]:
+        # revolt calls them servers, messages outside of one have no server id
+        return getattr(self.message.channel, 'server_id', None) or None
+
+    def get_attachments(self) -> Dict:
+        return {atch.filename: atch for atch in self.message.attachments}
+
+    @instrumented('fetch')
+    async def fetch_attachment_content(self, attch) -> bytes:
+        return await transport.fetch(attch.url, size=attch.size)
+
+    def stream_attachment_content(self, attch) -> AsyncIterator[bytes]:
+        return transport.stream(attch.url, size=attch.size)
+
+    def streams_attachment(self, attch) -> bool:
+        return True
+
+    def attachment_key(self, attch) -> Optional[Hashable]:
+        return (self.client_name, attch.id)
+
+    def attachment_size(self, attch) -> Optional[int]:
+        return attch.size
+
+    def __eq__(self, item: object) -> bool:
+        return item == self.client_name
+
+def make_client(client_class: Type[revolt.Client], token: str) -> revolt.Client:
+    """a revolt client on the session attachments are downloaded with, call it from within the event loop"""
+    return client_class(transport.session(), token)
@@ -0,0 +1,94 @@
+### A local HTTP server standing in for a platform's CDN, so attachment downloads can be tried offline
+from __future__ import annotations
+from typing import *
+
+import asyncio
+
+from aiohttp import web
+
+__all__: List[str] = ['StandInServer']
+
+class StandInServer:
+    """serves `files` at http://`host`:`port`/<name> (port 0 picks a free one), `chunk_size` bytes
+    every `delay` seconds. without `content_length` the files go out with chunked encoding.
+    it counts requests and the connections they came in on, to see whether those are reused
+
+        async with StandInServer({'a.txt': b'hello'}) as server:
+            content = await transport.fetch(server.url('a.txt'))
+    """
+
+    def __init__(
+        self,
+        files: Optional[Dict[str, bytes]] = None,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        chunk_size: int = 64 * 1024,
+        delay: float = 0.0,
+        content_length: bool = True,
+    ):
+        self.files = files if files is not None else {}
+        self.host = host
+        self.port = port
+        self.chunk_size = chunk_size
+        self.delay = delay
+        self.content_length = content_length
+        self.requests = 0
+        self.connections: Set[Tuple[str, int]] = set()
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        self.connections.add(request.transport.get_extra_info('peername'))
+
+        content = self.files.get(request.match_info['name'])
+        if content is None:
+            raise web.HTTPNotFound()
+
+        response = web.StreamResponse()
+        if self.content_length:
+            response.content_length = len(content)
+        else:
+            response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        view = memoryview(content)
+        for pos in range(0, len(content), self.chunk_size):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            await response.write(view[pos : pos + self.chunk_size])
+
+        await response.write_eof()
+        return response
+
+    async def start(self) -> str:
+        """starts serving and returns the base url"""
+        app = web.Application()
+        app.router.add_get('/{name}', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.base_url
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def url(self, name: str) -> str:
+        return f"{self.base_url}/{name}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> StandInServer:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.stop()
+
+    def __repr__(self) -> str:
+        return f"<StandInServer {self.base_url} files={len(self.files)} requests={self.requests} connections={len(self.connections)}>"
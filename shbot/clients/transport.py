@@ -0,0 +1,131 @@
+### The HTTP transport attachments are downloaded through, one pooled session shared by every client
+from __future__ import annotations
+from typing import *
+
+import asyncio
+
+import aiohttp
+
+from ..impls.metrics import metrics
+
+__all__: List[str] = ['AttachmentTransport', 'TransportError', 'AttachmentTooLargeError', 'transport']
+
+class TransportError(Exception): pass
+class AttachmentTooLargeError(TransportError): pass
+
+class AttachmentTransport:
+    """downloads attachments over one aiohttp session, whose connections are kept alive for
+    `keepalive_timeout` seconds and bounded to `limit` in total and `limit_per_host` per host.
+    downloads are read in chunks of `chunk_size` and fail as soon as they go over `max_size` bytes"""
+
+    def __init__(
+        self,
+        limit: int = 64,
+        limit_per_host: int = 8,
+        keepalive_timeout: float = 30.0,
+        chunk_size: int = 64 * 1024,
+        max_size: int = 8 * 1024 * 1024,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 30.0,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.headers = headers or {}
+        self.requests = 0
+        self.bytes = 0
+        self.too_large = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._keeper: Optional[asyncio.Task] = None
+
+    def session(self) -> aiohttp.ClientSession:
+        """the shared session, made on first use. a session belongs to its event loop so a new loop gets a new one,
+        the old one is closed on its own loop when that shuts down"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                ),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+                headers=self.headers,
+            )
+            self._loop = loop
+            self._keeper = loop.create_task(self._keep(self._session))
+
+        return self._session
+
+    @staticmethod
+    async def _keep(session: aiohttp.ClientSession) -> None:
+        # waits until the loop shuts down (asyncio.run cancels the tasks left) and closes the session on it
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            await session.close()
+
+    def _too_large(self, url: str, max_size: int) -> AttachmentTooLargeError:
+        self.too_large += 1
+        return AttachmentTooLargeError(f"{url} is larger than {max_size} bytes")
+
+    async def stream(self, url: str, max_size: Optional[int] = None, size: Optional[int] = None) -> AsyncGenerator[bytes, None]:
+        """yields the content at `url` chunk by chunk. `size` is what the platform says the attachment
+        weighs, which like Content-Length lets an oversized one fail before anything is read"""
+        max_size = max_size if max_size is not None else self.max_size
+        if size is not None and size > max_size:
+            raise self._too_large(url, max_size)
+
+        self.requests += 1
+        async with self.session().get(url) as response:
+            if response.status != 200:
+                raise TransportError(f"GET {url}: HTTP {response.status}")
+
+            if response.content_length is not None and response.content_length > max_size:
+                raise self._too_large(url, max_size)
+
+            read = 0
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                read += len(chunk)
+                if read > max_size:
+                    raise self._too_large(url, max_size)
+
+                self.bytes += len(chunk)
+                if metrics.enabled:
+                    metrics.inc('transport_bytes_total', len(chunk))
+                yield chunk
+
+    async def fetch(self, url: str, max_size: Optional[int] = None, size: Optional[int] = None) -> bytes:
+        """the whole content at `url`, its chunks are joined once at the end"""
+        chunks = []
+        async for chunk in self.stream(url, max_size, size):
+            chunks.append(chunk)
+
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+    async def close(self) -> None:
+        if self._keeper is not None:
+            self._keeper.cancel()
+            self._keeper = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'requests': self.requests,
+            'bytes': self.bytes,
+            'too_large': self.too_large,
+        }
+
+    def __repr__(self) -> str:
+        return f"<AttachmentTransport {self.stats()}>"
+
+
+transport = AttachmentTransport()
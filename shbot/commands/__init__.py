@@ -0,0 +1,16 @@
+from ..impls.command import commands
+
+# command name -> module that registers it, modules are only imported once one of their commands is used
+ENTRY_POINTS = {
+    'echo': 'shbot.commands.basics',
+    'cb': 'shbot.commands.basics',
+    'jobs': 'shbot.commands.jobs',
+    'wait': 'shbot.commands.jobs',
+    'kill': 'shbot.commands.jobs',
+    'slowlog': 'shbot.commands.admin',
+    'export': 'shbot.commands.variables',
+    'unset': 'shbot.commands.variables',
+}
+
+for _name, _module in ENTRY_POINTS.items():
+    commands.lazy(_name, _module)
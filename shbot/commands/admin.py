@@ -0,0 +1,35 @@
+from time import strftime, localtime
+
+from ..impls.command import commands
+from ..impls.argparser import ArgumentParser
+from ..impls.budget import format_size
+from ..impls.slowlog import slow_log
+
+@commands.command(argparser=ArgumentParser(description="shows the scripts that took longer than the slow log threshold")
+    .add_argument("-n", metavar="N", type=int, default=5, help="number of entries to show")
+    .add_argument("--verbose", "-v", action="store_true", help="show the time spent on every instruction")
+    .add_argument("--clear", action="store_true", help="empty the log"),
+)
+async def slowlog(ctx, out, args, pipe=None):
+    if not ctx.is_admin():
+        out @ 1 // "slowlog: permission denied\n"
+        return
+
+    if args.clear:
+        slow_log.clear()
+        out << "slow log cleared\n"
+        return
+
+    if not slow_log.enabled:
+        out << "the slow log is disabled\n"
+
+    for entry in slow_log.latest(args.n):
+        out << f"{strftime('%H:%M:%S', localtime(entry.started))} {entry.duration:.3f}s {entry.client} "
+        out << f"in {format_size(entry.bytes_in)} out {format_size(entry.bytes_out)}: {entry.script}\n"
+        if entry.error is not None:
+            out << f"  error: {entry.error}\n"
+        if entry.profile is not None:
+            out << f"  profile: {entry.profile}\n"
+        if args.verbose:
+            for op, seconds in entry.ops:
+                out << f"  {seconds:.3f}s {op}\n"
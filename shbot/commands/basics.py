@@ -1,17 +1,19 @@
 from ..impls.command import commands, CommandNotImplementedError
 from ..impls.argparser import ArgumentParser
 
-@commands.command()
+@commands.command(streaming=True, pure=True)
 async def echo(ctx, out, args, pipe=None):
     if pipe is not None:
-        out << b''.join(pipe.get_stds())
+        async for content in pipe:
+            out << content
+            await out.drain()
     else:
         out << ' '.join(args)
 
 @commands.command(argparser=ArgumentParser(description="puts text within a codeblock")
     .add_argument('text', metavar='TEXT', type=str, nargs='?', help='text')
-    .add_argument("--language", "-l", metavar="LANG", type=str, help="highlight language")
-    
+    .add_argument("--language", "-l", metavar="LANG", type=str, help="highlight language"),
+    pure=True,
 )
 async def cb(ctx, out, args, pipe=None):
     lang = args.language or ''
@@ -0,0 +1,46 @@
+from ..impls.command import commands
+from ..impls.jobs import JobError, current_job_tables
+
+def parse_job_ids(out, args):
+    try:
+        return [int(arg.lstrip('%')) for arg in args]
+    except ValueError as err:
+        out @ 1 // f"bad job id: {err}\n"
+        return None
+
+@commands.command()
+async def jobs(ctx, out, args, pipe=None):
+    """lists the background jobs of this channel"""
+    for job in current_job_tables.get().get(ctx.get_channel_id()).list():
+        out << f"{job}\n"
+
+@commands.command(waits=True)
+async def wait(ctx, out, args, pipe=None):
+    """waits for the given background jobs, or all of them"""
+    job_ids = parse_job_ids(out, args)
+    if job_ids is None:
+        return
+
+    try:
+        done = await current_job_tables.get().get(ctx.get_channel_id()).wait(job_ids or None)
+    except JobError as err:
+        out @ 1 // f"{err}\n"
+    else:
+        for job in done:
+            out << f"{job}\n"
+
+@commands.command()
+async def kill(ctx, out, args, pipe=None):
+    """kills the given background jobs"""
+    job_ids = parse_job_ids(out, args)
+    if job_ids is None:
+        return
+
+    table = current_job_tables.get().get(ctx.get_channel_id())
+    for job_id in job_ids:
+        try:
+            table.kill(job_id)
+        except JobError as err:
+            out @ 1 // f"{err}\n"
+        else:
+            out << f"[{job_id}] killed\n"
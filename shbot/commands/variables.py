@@ -0,0 +1,51 @@
+from ..impls.command import commands
+from ..impls.argparser import ArgumentParser
+from ..impls.env import SCOPES, VariableError
+
+# assigning these affects everyone in the guild, or everywhere
+ADMIN_SCOPES = ('global', 'guild')
+
+def check_scope(ctx, out, scope):
+    if scope in ADMIN_SCOPES and not ctx.is_admin():
+        out @ 1 // f"only admins may set {scope} variables\n"
+        return False
+
+    return True
+
+@commands.command(argparser=ArgumentParser(description="keeps variables for the following messages, NAME=value in front of a command only lasts for the script")
+    .add_argument('assignments', metavar='NAME=value', type=str, nargs='*', help='variables to set, none lists the ones visible here')
+    .add_argument("--scope", "-s", choices=SCOPES, default='channel', help="who sees them (default: channel)"),
+)
+async def export(ctx, out, args, pipe=None):
+    if not args.assignments:
+        for name, value in sorted((await ctx.get_variables()).items()):
+            out << f"{name}={value}\n"
+        return
+
+    if not check_scope(ctx, out, args.scope):
+        return
+
+    for assignment in args.assignments:
+        name, eq, value = assignment.partition('=')
+        if not eq:
+            out @ 1 // f"export: expected NAME=value, got {repr(assignment)}\n"
+            continue
+
+        try:
+            await ctx.set_variable(args.scope, name, value)
+        except VariableError as err:
+            out @ 1 // f"export: {err}\n"
+
+@commands.command(argparser=ArgumentParser(description="removes kept variables")
+    .add_argument('names', metavar='NAME', type=str, nargs='+', help='variables to remove')
+    .add_argument("--scope", "-s", choices=SCOPES, default='channel', help="the scope to remove them from (default: channel)"),
+)
+async def unset(ctx, out, args, pipe=None):
+    if not check_scope(ctx, out, args.scope):
+        return
+
+    for name in args.names:
+        try:
+            await ctx.set_variable(args.scope, name, None)
+        except VariableError as err:
+            out @ 1 // f"unset: {err}\n"
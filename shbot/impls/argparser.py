@@ -2,14 +2,17 @@ from __future__ import annotations
 from typing import *
 
 import argparse
+import keyword
+import re
 
-__all__: List[str] = ['ArgumentParser', 'ArgumentParserParseError', 'ArgumentParserHelpCallError']
+__all__: List[str] = ['ArgumentParser', 'ArgumentParserParseError', 'ArgumentParserHelpCallError', 'ArgSpec', 'ArgNamespace']
 
 class ArgumentParserParseError(Exception): pass
 class ArgumentParserHelpCallError(Exception): pass
 
 class ArgumentParser(argparse.ArgumentParser):
     def __init__(self, *args, **kwargs):
+        self._spec = None
         super(ArgumentParser, self).__init__(*args, **kwargs)
 
     def error(self, error_message):
@@ -17,6 +20,7 @@ class ArgumentParser(argparse.ArgumentParser):
 
     def add_argument(self, *args, **kwargs):
         super().add_argument(*args, **kwargs)
+        self._spec = None
         return self
 
     def parse_args(self, *_args, **kwargs):
@@ -26,10 +30,315 @@ class ArgumentParser(argparse.ArgumentParser):
             args = None
 
         return args
-    
+
     def print_help(self):
         raise ArgumentParserHelpCallError(self.format_help())
 
+    def compile(self) -> ArgSpec:
+        """returns the ArgSpec of this parser, built once and rebuilt only after `add_argument`"""
+        if self._spec is None:
+            self._spec = ArgSpec(self)
+
+        return self._spec
+
+
+class ArgNamespace:
+    """an immutable argparse.Namespace"""
+    __slots__ = ('_values',)
+
+    def __init__(self, values: Dict[str, Any]):
+        object.__setattr__(self, '_values', values)
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._values
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, (ArgNamespace, argparse.Namespace)):
+            return self._values == vars(other) if isinstance(other, argparse.Namespace) else self._values == other._values
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(tuple(sorted(self._values.items())))
+
+    def __reduce__(self):
+        return (ArgNamespace, (self._values,))
+
+    def __repr__(self) -> str:
+        return f"ArgNamespace({', '.join(f'{k}={v!r}' for k, v in self._values.items())})"
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(self._values)
+
+
+ParseResult = Tuple[Optional[Any], Optional[str], bool]
+
+NEGATIVE_NUMBER_RE = re.compile(r'^-\d+$|^-\d*\.\d+$')
+
+_HELP = object()
+_FAIL = object()
+
+class ArgSpec:
+    """an ArgumentParser compiled into plain lookup tables, parsing common token lists needs neither
+    argparse nor exceptions, anything unusual (and every error) is handed to argparse itself"""
+
+    def __init__(self, parser: argparse.ArgumentParser):
+        self.parser = parser
+        self.fast = True
+        self._help: Optional[str] = None
+        # option string -> (dest, nargs, type, choices, const, append)
+        self._options: Dict[str, Any] = {}
+        self._long_options: List[str] = []
+        # (dest, nargs, type, choices, default)
+        self._positionals: List[Tuple[str, Any, Any, Any, Any]] = []
+        self._min_positionals: List[int] = []
+        self._required: Set[str] = set()
+        self._defaults: Dict[str, Any] = {}
+        self._negative_options = bool(parser._has_negative_number_optionals)
+
+        if parser.prefix_chars != '-' or parser.fromfile_prefix_chars or parser._mutually_exclusive_groups:
+            self.fast = False
+            return
+
+        for action in parser._actions:
+            if not self._add_action(action):
+                self.fast = False
+                break
+
+    def _add_action(self, action: argparse.Action) -> bool:
+        if isinstance(action, argparse._HelpAction):
+            for option in action.option_strings:
+                self._options[option] = _HELP
+            self._long_options += [o for o in action.option_strings if o.startswith('--')]
+            return True
+
+        dest = action.dest
+        if not dest.isidentifier() or keyword.iskeyword(dest) or action.default is argparse.SUPPRESS:
+            return False
+        if action.type is not None and not callable(action.type):
+            return False
+
+        default = action.default
+        if isinstance(default, str) and action.type is not None:
+            try:
+                default = action.type(default)
+            except Exception:
+                return False
+        self._defaults[dest] = default
+
+        if isinstance(action, (argparse._StoreTrueAction, argparse._StoreFalseAction, argparse._StoreConstAction)):
+            entry = (dest, 0, None, None, action.const, False)
+        elif isinstance(action, argparse._StoreAction) and action.option_strings and action.nargs is None:
+            entry = (dest, None, action.type, action.choices, None, False)
+        elif isinstance(action, argparse._AppendAction) and action.nargs is None and default is None:
+            entry = (dest, None, action.type, action.choices, None, True)
+        elif isinstance(action, argparse._StoreAction) and not action.option_strings:
+            if action.nargs not in (None, '?', '*', '+') and not isinstance(action.nargs, int):
+                return False
+            self._positionals.append((dest, action.nargs, action.type, action.choices, default))
+            self._min_positionals.append(1 if action.nargs in (None, '+') else action.nargs if isinstance(action.nargs, int) else 0)
+            if action.nargs in (None, '+') or isinstance(action.nargs, int):
+                self._required.add(dest)
+            return True
+        else:
+            return False
+
+        for option in action.option_strings:
+            self._options[option] = entry
+        self._long_options += [o for o in action.option_strings if o.startswith('--')]
+
+        if action.required:
+            self._required.add(dest)
+
+        return True
+
+    def format_help(self) -> str:
+        if self._help is None:
+            self._help = self.parser.format_help()
+
+        return self._help
+
+    def parse(self, tokens: Sequence[str]) -> ParseResult:
+        """returns (namespace, error message, whether help was asked for)"""
+        if self.fast:
+            result = self._parse_fast(tokens)
+            if result is _HELP:
+                return None, None, True
+            if result is not _FAIL:
+                return result, None, False
+
+        return self._parse_slow(tokens)
 
+    def _parse_slow(self, tokens: Sequence[str]) -> ParseResult:
+        try:
+            args = self.parser.parse_args(list(tokens))
+        except ArgumentParserParseError as err:
+            return None, err.args[0], False
+        except ArgumentParserHelpCallError:
+            return None, None, True
+
+        if args is None:
+            return None, "failed to parse the arguments", False
+
+        return ArgNamespace({k: tuple(v) if isinstance(v, list) else v for k, v in vars(args).items()}), None, False
+
+    def _looks_optional(self, token: str) -> bool:
+        if not token.startswith('-') or token == '-':
+            return False
+
+        return self._negative_options or not NEGATIVE_NUMBER_RE.match(token)
+
+    def _find_option(self, name: str) -> Any:
+        option = self._options.get(name)
+        if option is None and name.startswith('--') and self.parser.allow_abbrev:
+            matches = [o for o in self._long_options if o.startswith(name)]
+            if len(matches) == 1:
+                option = self._options[matches[0]]
+
+        return option
+
+    def _convert(self, value: str, type: Any, choices: Any) -> Any:
+        if type is not None:
+            try:
+                value = type(value)
+            except Exception:
+                return _FAIL
+
+        if choices is not None and value not in choices:
+            return _FAIL
+
+        return value
+
+    def _parse_fast(self, tokens: Sequence[str]) -> Any:
+        values = self._defaults.copy()
+        seen: Set[str] = set()
+        positionals: List[str] = []
+        chunks = 0
+        in_chunk = False
+        n = len(tokens)
+        i = 0
+        while i < n:
+            token = tokens[i]
+            i += 1
+
+            if not self._looks_optional(token):
+                if not in_chunk:
+                    chunks += 1
+                    in_chunk = True
+                positionals.append(token)
+                continue
+
+            in_chunk = False
+
+            if token == '--':
+                # argparse has its own rules about where '--' may appear
+                return _FAIL
+
+            attached = None
+            option = self._find_option(token)
+            if option is None:
+                if token.startswith('--'):
+                    name, eq, attached = token.partition('=')
+                    if not eq:
+                        return _FAIL
+                else:
+                    name, attached = token[:2], token[2:]
+                option = self._find_option(name)
+                if option is None:
+                    return _FAIL
+
+            if option is _HELP:
+                # positionals before the help flag get converted (and may fail) first
+                return _FAIL if positionals else _HELP
+
+            dest, nargs, type, choices, const, append = option
+            if nargs == 0:
+                if attached is not None:
+                    return _FAIL
+                values[dest] = const
+            else:
+                if attached is None:
+                    if i >= n or self._looks_optional(tokens[i]):
+                        return _FAIL
+                    attached = tokens[i]
+                    i += 1
+
+                value = self._convert(attached, type, choices)
+                if value is _FAIL:
+                    return _FAIL
+                values[dest] = (values[dest] or ()) + (value,) if append else value
+
+            seen.add(dest)
+
+        if chunks > 1 and len(self._positionals) > 0:
+            return _FAIL
+
+        j = 0
+        rest = sum(self._min_positionals)
+        for spec, minimum in zip(self._positionals, self._min_positionals):
+            dest, nargs, type, choices, default = spec
+            rest -= minimum
+            available = len(positionals) - j - rest
+
+            if nargs is None:
+                take = 1
+            elif isinstance(nargs, int):
+                take = nargs
+            elif nargs == '?':
+                take = 1 if available >= 1 else 0
+            else:
+                take = available
+
+            if take < minimum or take > available:
+                return _FAIL
+
+            if take:
+                converted = []
+                for token in positionals[j : j + take]:
+                    value = self._convert(token, type, choices)
+                    if value is _FAIL:
+                        return _FAIL
+                    converted.append(value)
+                values[dest] = converted[0] if nargs in (None, '?') else tuple(converted)
+                seen.add(dest)
+            elif nargs == '*' and default is None:
+                values[dest] = ()
+
+            j += take
+
+        if j != len(positionals) or not self._required <= seen:
+            return _FAIL
+
+        return ArgNamespace(values)
+
+
+def benchmark(number: int = 20000) -> None:
+    """compares ArgumentParser.parse_args with ArgSpec.parse on the `cb` command's arguments"""
+    import timeit
+
+    parser = (ArgumentParser(prog='cb', description="puts text within a codeblock")
+        .add_argument('text', metavar='TEXT', type=str, nargs='?', help='text')
+        .add_argument("--language", "-l", metavar="LANG", type=str, help="highlight language"))
+    spec = parser.compile()
+
+    def parse_args(tokens):
+        try:
+            return parser.parse_args(tokens)
+        except (ArgumentParserParseError, ArgumentParserHelpCallError) as err:
+            return err
 
+    for tokens in ([], ['hello'], ['-l', 'py'], ['hello', '--language', 'py'], ['-lpy', 'hello'], ['a', 'b'], ['-h']):
+        old = timeit.timeit(lambda: parse_args(tokens), number=number)
+        new = timeit.timeit(lambda: spec.parse(tokens), number=number)
+        print(f"{' '.join(tokens) or '<empty>':<24} argparse {old / number * 1e6:8.2f}us  spec {new / number * 1e6:8.2f}us  x{old / new:5.1f}")
 
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,168 @@
+from __future__ import annotations
+from typing import *
+from contextvars import ContextVar
+
+import mmap
+import tempfile
+import weakref
+
+__all__: List[str] = ['MemoryBudget', 'MemoryBudgetError', 'MemoryBudgetExceededError', 'SpillBuffer', 'current_budget', 'format_size']
+
+class MemoryBudgetError(Exception): pass
+class MemoryBudgetExceededError(MemoryBudgetError): pass
+
+def format_size(n: float) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if n < 1024:
+            return f"{n:.0f}{unit}" if unit == 'B' else f"{n:.1f}{unit}"
+        n /= 1024
+
+    return f"{n:.1f}GiB"
+
+
+class SpillBuffer:
+    """a growable byte buffer kept in an (already unlinked) temporary file, read through mmap.
+    it supports what CommandOutput does with its bytearrays: `+=`, len, slicing and views"""
+    __slots__ = ('_file', '_size', '_map', '__weakref__')
+
+    def __init__(self, content: Any = b'', dir: Optional[str] = None):
+        self._file = tempfile.TemporaryFile(dir=dir)
+        self._size = 0
+        self._map: Optional[mmap.mmap] = None
+        if len(content):
+            self += content
+
+    def __iadd__(self, content: Any) -> SpillBuffer:
+        self._file.seek(0, 2)
+        self._file.write(content)
+        self._size += len(content)
+        # views of the old mapping stay valid, it's unmapped once the last one is gone
+        self._map = None
+        return self
+
+    def __len__(self) -> int:
+        return self._size
+
+    def view(self) -> memoryview:
+        if not self._size:
+            return memoryview(b'')
+
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)
+
+        return memoryview(self._map)
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        return self.view()[index]
+
+    def __bytes__(self) -> bytes:
+        return self.view().tobytes()
+
+    def __reduce__(self):
+        # pickles (eg. for a cpu bound command) as a plain bytearray
+        return (bytearray, (bytes(self),))
+
+    def copy(self) -> SpillBuffer:
+        return SpillBuffer(self.view(), dir=None)
+
+    def close(self) -> None:
+        """closes the temporary file, views handed out before stay readable until they're gone"""
+        self._map = None
+        self._file.close()
+
+    def __repr__(self) -> str:
+        return f"<SpillBuffer {format_size(self._size)}>"
+
+
+def buffer_view(buf: Any) -> memoryview:
+    return buf.view() if type(buf) is SpillBuffer else memoryview(buf)
+
+
+# spilling a buffer smaller than this wouldn't save anything worth the syscalls
+MIN_SPILL = 64 * 1024
+
+class MemoryBudget:
+    """accounts the bytes held by the outputs of one interpretation. a buffer growing past `spill_threshold`,
+    or any buffer of at least MIN_SPILL once the script holds over `max_memory` in memory, is moved into
+    a SpillBuffer under `spill_dir`. holding more than `max_bytes` in total (memory and spilled) aborts the script"""
+
+    def __init__(
+        self,
+        max_memory: int = 64 * 1024 * 1024,
+        max_bytes: int = 512 * 1024 * 1024,
+        spill_threshold: int = 8 * 1024 * 1024,
+        spill_dir: Optional[str] = None,
+    ):
+        self.max_memory = max_memory
+        self.max_bytes = max_bytes
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.memory = 0
+        self.spilled = 0
+        self.peak_memory = 0
+        self.peak = 0
+        self.spills = 0
+        self._buffers: weakref.WeakSet[SpillBuffer] = weakref.WeakSet()
+
+    def charge(self, n: int, spilled: bool = False) -> None:
+        """accounts `n` more bytes, raises before going over `max_bytes`"""
+        if self.memory + self.spilled + n > self.max_bytes:
+            raise MemoryBudgetExceededError(f"the script needs more than {format_size(self.max_bytes)} for its output")
+
+        if spilled:
+            self.spilled += n
+        else:
+            self.memory += n
+            if self.memory > self.peak_memory:
+                self.peak_memory = self.memory
+
+        if self.memory + self.spilled > self.peak:
+            self.peak = self.memory + self.spilled
+
+    def release(self, n: int, spilled: bool = False) -> None:
+        if spilled:
+            self.spilled = max(self.spilled - n, 0)
+        else:
+            self.memory = max(self.memory - n, 0)
+
+    def should_spill(self, size: int) -> bool:
+        return size >= self.spill_threshold or (size >= MIN_SPILL and self.memory > self.max_memory)
+
+    def spill_buffer(self, content: Any = b'') -> SpillBuffer:
+        """a SpillBuffer under `spill_dir` that is closed along with the budget"""
+        buf = SpillBuffer(content, dir=self.spill_dir)
+        self._buffers.add(buf)
+        return buf
+
+    def spill(self, buf: Any) -> SpillBuffer:
+        spill = self.spill_buffer(buf)
+        self.memory = max(self.memory - len(buf), 0)
+        self.spilled += len(buf)
+        self.spills += 1
+        return spill
+
+    def close(self) -> None:
+        """closes the temporary files of the buffers spilled by the script, once it's done with them"""
+        for buf in list(self._buffers):
+            buf.close()
+        self._buffers.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'memory': self.memory,
+            'spilled': self.spilled,
+            'peak_memory': self.peak_memory,
+            'peak': self.peak,
+            'spills': self.spills,
+        }
+
+    def report(self) -> str:
+        return f"peak {format_size(self.peak)} ({format_size(self.peak_memory)} in memory), {self.spills} buffers spilled"
+
+    def __repr__(self) -> str:
+        return f"<MemoryBudget {self.stats()}>"
+
+
+# the budget of the interpretation running in the current task, CommandOutputs made in it charge it
+current_budget: ContextVar[Optional[MemoryBudget]] = ContextVar('current_budget', default=None)
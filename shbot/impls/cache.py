@@ -0,0 +1,179 @@
+from __future__ import annotations
+from typing import *
+from collections import OrderedDict
+
+import asyncio
+
+from .shparser import Parser, FrozenInstr, VAR_RE
+from .compiler import Program, compile_program
+
+__all__: List[str] = ['LRUCache', 'ByteLRUCache', 'ScriptCache', 'CompiledScript', 'attachment_cache', 'command_cache']
+
+class LRUCache:
+    """a bounded least recently used mapping with hit/miss/eviction counters"""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        # key -> [the task loading it, how many are waiting for it]
+        self._inflight: Dict[Hashable, List[Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def fetch(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        """the value of `key`, loaded with `load` and kept on a miss. concurrent misses of a key share one load,
+        which runs in a task of its own and is only cancelled once everyone waiting for it has gone away"""
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(load())
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda task: self._loaded(key, task))
+        else:
+            self.coalesced += 1
+
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not entry[0].done():
+                entry[0].cancel()
+
+    def _loaded(self, key: Hashable, task: asyncio.Future) -> None:
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'coalesced': self.coalesced,
+        }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.stats()}>"
+
+
+class ByteLRUCache(LRUCache):
+    """an LRUCache bounded by the total size of its values instead of their count"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, sizeof: Callable[[Any], int] = len):
+        super().__init__(maxsize=max_bytes)
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        if key in self._data:
+            self.nbytes -= self.sizeof(self._data[key])
+
+        self._data[key] = value
+        self._data.move_to_end(key)
+        self.nbytes += size
+
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.nbytes -= self.sizeof(evicted)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        super().clear()
+        self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        stats = super().stats()
+        stats['nbytes'] = self.nbytes
+        stats['max_bytes'] = stats.pop('maxsize')
+        return stats
+
+
+CompiledScript = Tuple[FrozenInstr, ...]
+
+class ScriptCache(LRUCache):
+    """caches the parsed form of scripts so that repeated scripts skip tokenizing and parsing,
+    the key is the script text plus the bindings of the variables the script references"""
+
+    def __init__(self, parser: Optional[Parser] = None, maxsize: int = 1024):
+        super().__init__(maxsize=maxsize)
+        self.parser = parser if parser is not None else Parser()
+
+    def make_key(self, string: str, variables: Mapping[str, str]) -> Hashable:
+        if '$' not in string:
+            return (string, ())
+
+        names = sorted(set(VAR_RE.findall(string)))
+        return (string, tuple((name, variables[name] if name in variables else None) for name in names))
+
+    def compile(self, string: str, variables: Mapping[str, str] = {}, client: str = 'unknown') -> CompiledScript:
+        key = self.make_key(string, variables)
+        instrs = self.get(key)
+
+        if instrs is None:
+            instrs = tuple(instr.freeze() for instr in self.parser.parse(self.parser.tokenize(string, variables, client), client))
+            self.put(key, instrs)
+
+        return instrs
+
+    def load(self, string: str, variables: Mapping[str, str], commands: Any, client: str = 'unknown') -> Program:
+        """like `compile` but returns the script compiled into a Program with `commands`,
+        Programs are kept per registry since each one's bound to the commands it was compiled with"""
+        key = ('program', commands, self.make_key(string, variables))
+        program = self.get(key)
+
+        if program is None:
+            program = compile_program(self.compile(string, variables, client), commands)
+            self.put(key, program)
+
+        return program
+
+
+# attachment contents shared by every interpretation in the process, keyed by `Context.attachment_key`
+attachment_cache = ByteLRUCache()
+
+# outputs of pure commands keyed by (command name, args, digest of the pipe)
+command_cache = ByteLRUCache(max_bytes=16 * 1024 * 1024, sizeof=lambda out: out.nbytes + 64)
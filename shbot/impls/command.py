@@ -2,11 +2,19 @@ from __future__ import annotations
 from typing import *
 from typing_extensions import Self
 
-from .argparser import ArgumentParserHelpCallError, ArgumentParserParseError
+from .procpool import ProcessPoolTimeoutError, process_pool
+from .metrics import metrics
+from .budget import SpillBuffer, buffer_view, current_budget
+from array import array
+from hashlib import blake2b
+
+from time import perf_counter
 
 import argparse
+import asyncio
+import importlib
 
-__all__ = ['CommandOutput', 'Stdout', 'Stderr', 'CommandError', 'CommandNotFoundError', 'CommandNotImplementedError']
+__all__ = ['CommandOutput', 'Stdout', 'Stderr', 'CommandError', 'CommandNotFoundError', 'CommandNotImplementedError', 'CommandTimeoutError']
 
 class CommandError(Exception): pass
 
@@ -14,6 +22,8 @@ class CommandNotFoundError(CommandError): pass
 
 class CommandNotImplementedError(CommandError): pass
 
+class CommandTimeoutError(CommandError): pass
+
 class Std:
     def __init__(self, content: bytes):
         self.content = content
@@ -27,26 +37,133 @@ class Stderr(Std):
         return f"err<{repr(self.content)}>"
 
 
+Buffer = Union[bytes, bytearray, memoryview]
+
+def to_bytes(content: Any) -> Buffer:
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        return content
+
+    return str(content).encode()
+
+
 class CommandOutput:
+    """stdout and stderr are kept in one bytearray each (or a wrapped buffer until the first write),
+    `_runs` records how the writes interleave as signed lengths (positive for stdout, negative for stderr)"""
+
     def __init__(self, stds: List[Std]=None, code=0) -> None:
-        self.stds = stds if stds is not None else []
+        self._out: Any = bytearray()
+        self._err: Any = bytearray()
+        self._runs = array('q')
+        self._combined: Optional[bytearray] = None
         self.code = code
+        self.budget = current_budget.get()
 
-    def stdout_write(self, content: Any) -> None:
-        if not isinstance(content, bytes):
-            content = str(content).encode()
+        for std in stds or ():
+            if isinstance(std, Stderr):
+                self.stderr_write(std.content)
+            else:
+                self.stdout_write(std.content)
+
+    @classmethod
+    def wrap(cls, content: Buffer) -> CommandOutput:
+        """an output holding `content` as its stdout without copying it, the first write
+        copies it into a buffer of its own. a bytearray is copied right away since its owner may change it"""
+        out = cls()
+        if len(content):
+            out._out = bytes(content) if isinstance(content, bytearray) else content
+            out._runs.append(len(content))
+        return out
+
+    def _write(self, content: Any, err: bool) -> None:
+        content = to_bytes(content)
+        n = len(content)
+        if not n:
+            return
+
+        buf = self._err if err else self._out
+        budget = self.budget
+        spilled = type(buf) is SpillBuffer
+        if budget is not None:
+            budget.charge(n, spilled)
+
+        if type(buf) is not bytearray and not spilled:
+            # wrapped content, copy on write
+            if budget is not None:
+                budget.charge(len(buf))
+            buf = bytearray(buf)
+        try:
+            buf += content
+        except BufferError:
+            # a memoryview of the old buffer is still alive, leave it to its holder
+            buf = buf + content
+
+        if budget is not None and not spilled and budget.should_spill(len(buf)):
+            buf = budget.spill(buf)
+
+        if err:
+            self._err = buf
+        else:
+            self._out = buf
+
+        run = -n if err else n
+        runs = self._runs
+        if runs and (runs[-1] < 0) == err:
+            runs[-1] += run
+        else:
+            runs.append(run)
+
+        self._combined = None
+
+    def _release(self, buf: Any) -> None:
+        if self.budget is not None and (type(buf) is bytearray or type(buf) is SpillBuffer):
+            self.budget.release(len(buf), type(buf) is SpillBuffer)
+        if type(buf) is SpillBuffer:
+            buf.close()
 
-        self.stds.append(Stdout(content))
+    def stdout_write(self, content: Any) -> None:
+        self._write(content, False)
 
     def stderr_write(self, content: Any) -> None:
-        if not isinstance(content, bytes):
-            content = str(content).encode()
-
-        self.stds.append(Stderr(content))
+        self._write(content, True)
 
     def set_code(self, code: int) -> None:
         self.code = code
 
+    def copy(self) -> CommandOutput:
+        """a copy that isn't charged to any budget, eg. for keeping it in a cache"""
+        other = CommandOutput(code=self.code)
+        other.budget = None
+        other._out = self._copy_buffer(self._out)
+        other._err = self._copy_buffer(self._err)
+        other._runs = array('q', self._runs)
+        return other
+
+    @staticmethod
+    def _copy_buffer(buf: Any) -> Any:
+        if type(buf) is bytes or type(buf) is memoryview:
+            # wrapped bytes (or views of them) are immutable and can be shared
+            return buf
+        if type(buf) is SpillBuffer:
+            return buf.copy()
+        return bytearray(buf)
+
+    def digest(self) -> bytes:
+        """a hash of both streams and how they interleave"""
+        digest = blake2b(buffer_view(self._out), digest_size=16)
+        digest.update(buffer_view(self._err))
+        digest.update(self._runs.tobytes())
+        return digest.digest()
+
+    def extend(self, other: CommandOutput) -> None:
+        """writes everything from `other` into this output, keeping the interleaving"""
+        for run, content in zip(other._runs, other.get_stds()):
+            if run > 0:
+                self.stdout_write(content)
+            else:
+                self.stderr_write(content)
+
+        self.set_code(other.code)
+
     def __lshift__(self, content: Any) -> Self:
         self.stdout_write(content) 
         return self
@@ -64,98 +181,334 @@ class CommandOutput:
         return self
     
     def __bytes__(self) -> bytes:
-        return b''.join(self.get_stds())
+        return bytes(self.view())
 
     def __repr__(self) -> str:
         return f"<stds={self.stds} code={self.code}>"
 
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state['_combined'] = None
+        state['budget'] = None
+        # wrapped views (eg. of a heredoc) don't pickle, the other process gets a copy anyway
+        for name in ('_out', '_err'):
+            if type(state[name]) is memoryview:
+                state[name] = bytes(state[name])
+        return state
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._out) + len(self._err)
+
+    @property
+    def stds(self) -> List[Std]:
+        return [Stdout(content) if run > 0 else Stderr(content) for run, content in zip(self._runs, self.get_stds())]
+
+    def _combine(self) -> Any:
+        if self._combined is None:
+            if type(self._out) is SpillBuffer or type(self._err) is SpillBuffer:
+                combined: Any = self.budget.spill_buffer() if self.budget is not None else SpillBuffer()
+            else:
+                combined = bytearray()
+            o = e = 0
+            with buffer_view(self._out) as out, buffer_view(self._err) as err:
+                for run in self._runs:
+                    if run > 0:
+                        combined += out[o : o + run]
+                        o += run
+                    else:
+                        combined += err[e : e - run]
+                        e -= run
+            self._combined = combined
+
+        return self._combined
+
+    def stdout_view(self) -> memoryview:
+        return buffer_view(self._out)
+
+    def stderr_view(self) -> memoryview:
+        return buffer_view(self._err)
+
+    def view(self) -> memoryview:
+        """stdout and stderr in the order they were written, this only copies when both streams were written to"""
+        if not self._err:
+            return buffer_view(self._out)
+        if not self._out:
+            return buffer_view(self._err)
+
+        return buffer_view(self._combine())
+
     def clear(self):
-        self.stds.clear()
+        self._release(self._out)
+        self._release(self._err)
+        if type(self._combined) is SpillBuffer:
+            self._combined.close()
+        self._reset()
         self.code = 0
 
+    def _reset(self) -> None:
+        self._out = bytearray()
+        self._err = bytearray()
+        self._runs = array('q')
+        self._combined = None
+
+    async def drain(self) -> None:
+        """lets streaming commands wait for downstream to catch up, a buffered output never blocks"""
+        pass
+
+    async def __aiter__(self) -> AsyncGenerator[bytes, None]:
+        for content in self.get_stds():
+            yield content
+
     def get_outs(self) -> Generator[bytes, None, None]:
-        for std in self.stds:
-            if isinstance(std, Stdout):
-                yield std.content
+        if self._out:
+            yield bytes(self._out)
 
     def get_errs(self) -> Generator[bytes, None, None]:
-        for std in self.stds:
-            if isinstance(std, Stderr):
-                yield std.content
+        if self._err:
+            yield bytes(self._err)
 
     def get_stds(self) -> Generator[bytes, None, None]:
-        for std in self.stds:
-            yield std.content
+        o = e = 0
+        for run in self._runs:
+            if run > 0:
+                yield bytes(self._out[o : o + run])
+                o += run
+            else:
+                yield bytes(self._err[e : e - run])
+                e -= run
             
     def clear_stds(self) -> None:
         self.clear()
         
     def clear_outs(self) -> None:
-        self.stds = [std for std in self.stds if not isinstance(std, Stdout)]
+        self._release(self._out)
+        self._out = bytearray()
+        self._runs = array('q', [-len(self._err)] if self._err else [])
+        self._combined = None
         
     def clear_errs(self) -> None:
-        self.stds = [std for std in self.stds if not isinstance(std, Stderr)]
+        self._release(self._err)
+        self._err = bytearray()
+        self._runs = array('q', [len(self._out)] if self._out else [])
+        self._combined = None
+
+    # the popped content is still held by the script (as a file to send), so it stays charged
+
+    def pop_stds(self) -> Buffer:
+        """returns the combined output and clears it, without copying when only one stream was written to"""
+        if not self._err:
+            content = self._out
+        elif not self._out:
+            content = self._err
+        else:
+            content = self._combine()
+            self._release(self._out)
+            self._release(self._err)
+            if self.budget is not None:
+                self.budget.charge(len(content), type(content) is SpillBuffer)
+
+        self._reset()
+        self.code = 0
+        return content.view() if type(content) is SpillBuffer else content
+
+    def pop_outs(self) -> Buffer:
+        content = self._out
+        self._out = bytearray()
+        self._runs = array('q', [-len(self._err)] if self._err else [])
+        self._combined = None
+        return content.view() if type(content) is SpillBuffer else content
+
+    def pop_errs(self) -> Buffer:
+        content = self._err
+        self._err = bytearray()
+        self._runs = array('q', [len(self._out)] if self._out else [])
+        self._combined = None
+        return content.view() if type(content) is SpillBuffer else content
+
+
+# bodies of cpu bound commands by (module, qualname), filled in every process that imports them
+_cpu_bound_bodies: Dict[Tuple[str, str], Callable[..., Awaitable[None]]] = {}
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def _run_cpu_bound(module: str, qualname: str, args: Any, pipe: Optional[CommandOutput]) -> CommandOutput:
+    """the worker process side of a cpu bound command, there is no ctx in here"""
+    global _worker_loop
+
+    if (module, qualname) not in _cpu_bound_bodies:
+        importlib.import_module(module)
+
+    if _worker_loop is None:
+        _worker_loop = asyncio.new_event_loop()
+
+    out = CommandOutput()
+    _worker_loop.run_until_complete(_cpu_bound_bodies[module, qualname](None, out, args, pipe=pipe))
+    return out
+
+async def _offload(coro, out: CommandOutput, args: Any, pipe: Any = None) -> None:
+    if pipe is not None and not isinstance(pipe, CommandOutput):
+        raise CommandError(f"cpu bound command {coro.__name__} can't take a {type(pipe).__name__} as its pipe")
+
+    try:
+        result = await process_pool.run(_run_cpu_bound, coro.__module__, coro.__qualname__, args, pipe)
+    except ProcessPoolTimeoutError as err:
+        raise CommandTimeoutError(f"{coro.__name__}: {err.args[0]}") from None
+
+    out.extend(result)
 
 
 class Command:
-    def __init__(self, coro, help=None, name=None):
+    def __init__(self, coro, help=None, name=None, streaming=False, cpu_bound=False, pure=False, waits=False):
         self._coro = coro
         self._help = help
         self.name = name
+        self.streaming = streaming
+        self.cpu_bound = cpu_bound
+        self.pure = pure
+        self.waits = waits
 
     def get_coro(self):
         return self._coro
 
     def get_help(self):
+        if callable(self._help):
+            self._help = self._help()
+
         return self._help
 
     def __repr__(self):
         return f"command<{self.name}>"
 
     def __call__(self, *args, **kwargs):
+        if metrics.enabled:
+            return self.call_instrumented(*args, **kwargs)
+
         return self.get_coro()(*args, **kwargs)
 
+    async def call_instrumented(self, ctx, out, args, pipe=None, **kwargs):
+        before = out.nbytes
+        if isinstance(pipe, CommandOutput):
+            metrics.inc('command_bytes_in_total', pipe.nbytes, command=self.name)
+
+        started = perf_counter()
+        try:
+            await self.get_coro()(ctx, out, args, pipe=pipe, **kwargs)
+        except BaseException:
+            metrics.inc('command_errors_total', command=self.name)
+            raise
+        finally:
+            metrics.observe('command_seconds', perf_counter() - started, command=self.name)
+            metrics.inc('command_bytes_out_total', out.nbytes - before, command=self.name)
+
 class Commands:
     def __init__(self, commands=None):
         self._commands = commands if commands is not None else {}
-
-    def command(self, name=None, argparser=None):
+        self._entry_points: Dict[str, str] = {}
+        # module -> {'import': seconds, 'register': seconds, 'commands': [names]}
+        self._load_stats: Dict[str, Dict[str, Any]] = {}
+
+    def lazy(self, name: str, module: str) -> None:
+        """records that `module` registers the command `name`, it is imported on first use"""
+        if name not in self._commands:
+            self._entry_points[name] = module
+
+    def load(self, module: str) -> None:
+        """imports `module`, which has to register exactly the commands it's the entry point of"""
+        promised = {name for name, entry in self._entry_points.items() if entry == module}
+        stats = self._load_stats.setdefault(module, {'import': 0.0, 'register': 0.0, 'commands': []})
+        registered, registering = len(stats['commands']), stats['register']
+
+        started = perf_counter()
+        importlib.import_module(module)
+        # the commands register while the module is imported, that time is reported on its own
+        stats['import'] += perf_counter() - started - (stats['register'] - registering)
+
+        missing = sorted(name for name in promised if name not in self._commands)
+        unlisted = sorted(set(stats['commands'][registered:]) - promised)
+        if missing or unlisted:
+            raise CommandError(
+                f"the entry points of {module} don't match its commands, "
+                f"missing: {' '.join(missing) or '-'}, unlisted: {' '.join(unlisted) or '-'}"
+            )
+
+    def load_all(self) -> None:
+        for module in dict.fromkeys(self._entry_points.values()):
+            self.load(module)
+
+    def names(self) -> List[str]:
+        return sorted(set(self._commands) | set(self._entry_points))
+
+    def startup_report(self) -> str:
+        """import and registration cost of every command module loaded so far"""
+        lines = [f"{'module':<40} {'import ms':>10} {'register ms':>12}  commands"]
+        for module, stats in self._load_stats.items():
+            lines.append(f"{module:<40} {stats['import'] * 1000:>10.2f} {stats['register'] * 1000:>12.2f}  {' '.join(stats['commands'])}")
+
+        pending = sorted(set(self._entry_points.values()) - set(self._load_stats))
+        if pending:
+            lines.append(f"not loaded yet: {' '.join(pending)}")
+
+        return '\n'.join(lines)
+
+    def command(self, name=None, argparser=None, streaming=False, cpu_bound=False, pure=False, waits=False):
+        """registers a command, a `streaming` command reads its pipe with `async for` and
+        may `await out.drain()`, everything else gets the whole upstream output at once.
+        a `cpu_bound` command runs in `process_pool`, it gets None as ctx and its module must be importable.
+        the output of a `pure` command depends on nothing but its args and pipe, so it may be reused.
+        a command that `waits` for work running elsewhere (eg. background jobs) is only held to the script deadline"""
         def factory(coro):
+            started = perf_counter()
+            body = coro
+
+            if cpu_bound:
+                _cpu_bound_bodies[body.__module__, body.__qualname__] = body
+                async def offloaded(ctx, out, args, pipe=None):
+                    await _offload(body, out, args, pipe)
+                coro = offloaded
 
             if argparser is not None:
-                argparser.prog = coro.__name__
+                argparser.prog = body.__name__
                 async def wrap(ctx, out, args, *_args, **kwargs):
-                    try:
-                        args = argparser.parse_args(args)
-
-                    except ArgumentParserParseError as err:
-                        ctx @ 1 // err.args[0]
-                        argparser.error_message = None
-                    except ArgumentParserHelpCallError as err:
-                        ctx << argparser.format_help()
-                        argparser.help = None
-                    else:    
+                    spec = argparser.compile()
+                    args, error, help = spec.parse(args)
+
+                    if help:
+                        out << spec.format_help()
+                    elif error is not None:
+                        out @ 1 // error
+                    else:
                         await coro(ctx, out, args, *_args, **kwargs)
-                        ctx
 
-                _help = argparser.format_help()
+                _help = lambda: argparser.compile().format_help()
             else:
                 async def wrap(ctx, out, *args, **kwargs):
                     await coro(ctx, out,  *args, **kwargs)
 
-                _help = coro.__doc__
+                _help = body.__doc__
 
-            wrap.__name__ = coro.__name__
-            wrap.__doc__ = coro.__doc__
+            wrap.__name__ = body.__name__
+            wrap.__doc__ = body.__doc__
 
             nonlocal name
-            name = name or coro.__name__
-            self._commands[name] = Command(wrap, help=_help)
+            name = name or body.__name__
+            self._commands[name] = Command(
+                wrap, help=_help, name=name, streaming=streaming and not cpu_bound, cpu_bound=cpu_bound, pure=pure, waits=waits
+            )
+            self._entry_points.pop(name, None)
+
+            stats = self._load_stats.setdefault(body.__module__, {'import': 0.0, 'register': 0.0, 'commands': []})
+            stats['register'] += perf_counter() - started
+            stats['commands'].append(name)
 
             return wrap
         return factory
 
     def get(self, name):
-        return self._commands.get(name)
+        command = self._commands.get(name)
+        if command is None and name in self._entry_points:
+            self.load(self._entry_points[name])
+            command = self._commands.get(name)
+
+        return command
 
 commands = Commands()
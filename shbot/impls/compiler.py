@@ -0,0 +1,154 @@
+from __future__ import annotations
+from typing import *
+
+from .command import Command, Commands, CommandNotFoundError
+from .shparser import Instrs, InstrType, split_statements, format_instrs
+
+__all__: List[str] = ['Program', 'compile_program', 'describe_op', 'OP_IN', 'OP_HEREDOC', 'OP_EVAL', 'OP_PIPE', 'OP_OUT', 'OP_OUT1', 'OP_OUT2', 'OP_BG']
+
+# every op is an (opcode, operand, args) tuple:
+#   OP_IN       attachment name                  ()
+#   OP_HEREDOC  body as bytes (or a memoryview)  ()
+#   OP_EVAL     Command                          args
+#   OP_PIPE     Command                          args
+#   OP_OUT*     filename                         ()
+#   OP_BG       Program of the statement         its description
+OP_IN, OP_HEREDOC, OP_EVAL, OP_PIPE, OP_OUT, OP_OUT1, OP_OUT2, OP_BG = range(8)
+
+Op = Tuple[int, Any, Any]
+# (start, end, whether it may run concurrently with its neighbours)
+Statement = Tuple[int, int, bool]
+
+OPCODES: Dict[InstrType, int] = {
+    InstrType.IN: OP_IN,
+    InstrType.HEREDOC: OP_HEREDOC,
+    InstrType.EVAL: OP_EVAL,
+    InstrType.PIPE: OP_PIPE,
+    InstrType.OUT: OP_OUT,
+    InstrType.OUT1: OP_OUT1,
+    InstrType.OUT2: OP_OUT2,
+}
+
+class Program:
+    """a compiled script, a flat tuple of ops with the commands already looked up.
+    it pickles with command names in place of commands, which are looked up again on loading"""
+    __slots__ = ('code', 'attachments', 'statements')
+
+    def __init__(self, code: Tuple[Op, ...]):
+        object.__setattr__(self, 'code', code)
+        # what the script reads with `<`, so it can all be fetched up front
+        object.__setattr__(self, 'attachments', tuple(dict.fromkeys(operand for op, operand, _ in code if op == OP_IN)))
+        object.__setattr__(self, 'statements', split_code(code))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __len__(self) -> int:
+        return len(self.code)
+
+    def __reduce__(self):
+        return (_load_program, (_dump_code(self.code),))
+
+    def __repr__(self) -> str:
+        return f"<Program ops={len(self.code)} attachments={self.attachments}>"
+
+def split_code(code: Tuple[Op, ...]) -> Tuple[Statement, ...]:
+    """finds the statements of compiled code. a statement only depends on the ones before it through
+    the side effects of its commands, so one made of pure commands only may run concurrently with
+    other such statements, anything else (and `&`) is a barrier"""
+    statements: List[Statement] = []
+    start = 0
+    inputs: Optional[int] = None
+    command = False
+    pure = True
+    for i, (op, operand, _) in enumerate(code):
+        if op == OP_IN or op == OP_HEREDOC:
+            # inputs in front of a command belong to its statement
+            if command and inputs is None:
+                inputs = i
+            continue
+
+        if (op == OP_EVAL or op == OP_BG) and command:
+            end = inputs if inputs is not None else i
+            statements.append((start, end, pure))
+            start, pure = end, True
+
+        inputs = None
+        if op == OP_EVAL or op == OP_PIPE:
+            command = True
+            pure = pure and operand.pure
+        elif op == OP_BG:
+            command = True
+            pure = False
+
+    if start < len(code):
+        statements.append((start, len(code), pure and command))
+
+    return tuple(statements)
+
+def describe_op(op: Op) -> str:
+    code, operand, args = op
+    if code == OP_EVAL or code == OP_PIPE:
+        return ('| ' if code == OP_PIPE else '') + ' '.join((operand.name,) + tuple(args))
+    if code == OP_IN:
+        return f"< {operand}"
+    if code == OP_HEREDOC:
+        return f"<< ({len(operand)} bytes)"
+    if code == OP_BG:
+        return f"{args} &"
+
+    return f"{('>', '1>', '2>')[code - OP_OUT]} {operand}"
+
+def _dump_operand(op: int, operand: Any) -> Any:
+    if op == OP_EVAL or op == OP_PIPE:
+        return operand.name
+    if op == OP_BG:
+        return _dump_code(operand.code)
+    if op == OP_HEREDOC and type(operand) is memoryview:
+        # a view of the script doesn't pickle, the bytes it shows do
+        return bytes(operand)
+
+    return operand
+
+def _dump_code(code: Tuple[Op, ...]) -> Tuple[Op, ...]:
+    return tuple((op, _dump_operand(op, operand), args) for op, operand, args in code)
+
+def _load_code(code: Tuple[Op, ...], commands: Commands) -> Tuple[Op, ...]:
+    return tuple(
+        (op, _resolve(commands, operand) if op in (OP_EVAL, OP_PIPE) else Program(_load_code(operand, commands)) if op == OP_BG else operand, args)
+        for op, operand, args in code
+    )
+
+def _load_program(code: Tuple[Op, ...]) -> Program:
+    from .command import commands
+    from .. import commands as builtin_commands  # registers the builtin commands lazily
+
+    return Program(_load_code(code, commands))
+
+def _resolve(commands: Commands, name: str) -> Command:
+    command = commands.get(name)
+    if command is None:
+        raise CommandNotFoundError(f"command {repr(name)} not found")
+
+    return command
+
+def compile_program(instrs: Instrs, commands: Commands) -> Program:
+    """compiles parsed instructions, raises CommandNotFoundError for an unknown command before anything runs"""
+    code: List[Op] = []
+    for statement, background in split_statements(instrs):
+        if background:
+            code.append((OP_BG, compile_program(statement, commands), format_instrs(statement)))
+            continue
+
+        for instr in statement:
+            op = OPCODES[instr.instr_type]
+            if op == OP_EVAL or op == OP_PIPE:
+                code.append((op, _resolve(commands, instr.args[0]), tuple(instr.args[1:])))
+            elif op == OP_HEREDOC:
+                # the tokenizer makes the body bytes (or a view of the script's), only made up Instrs hold a str
+                body = instr.args[0]
+                code.append((op, body.encode() if isinstance(body, str) else body, ()))
+            else:
+                code.append((op, instr.args[0], ()))
+
+    return Program(tuple(code))
@@ -0,0 +1,62 @@
+from __future__ import annotations
+from typing import *
+
+import asyncio
+
+__all__: List[str] = ['Deadline', 'Deadlines', 'DeadlineExceededError']
+
+class DeadlineExceededError(Exception):
+    def __init__(self, scope: str, what: str, seconds: float):
+        super().__init__(f"{what} timed out after {seconds:g}s")
+        self.scope = scope
+        self.what = what
+        self.seconds = seconds
+
+
+class Deadlines:
+    """how long a whole `script`, a single `command` and a single attachment `fetch` may take, in seconds.
+    None lets them take as long as they like"""
+    __slots__ = ('script', 'command', 'fetch')
+
+    def __init__(self, script: Optional[float] = 30.0, command: Optional[float] = 10.0, fetch: Optional[float] = 10.0):
+        self.script = script
+        self.command = command
+        self.fetch = fetch
+
+    def __repr__(self) -> str:
+        return f"<Deadlines script={self.script} command={self.command} fetch={self.fetch}>"
+
+
+class Deadline:
+    """cancels the task running the block once `seconds` have passed and raises DeadlineExceededError out of it.
+    the cancellation reaches whatever the task awaits, tasks it gathers cancel theirs in turn.
+    a cancellation from anywhere else (eg. an outer deadline or `kill`) passes through untouched"""
+    __slots__ = ('seconds', 'scope', 'what', '_task', '_handle', '_expired', '_cancelling')
+
+    def __init__(self, seconds: float, scope: str, what: str):
+        self.seconds = seconds
+        self.scope = scope
+        self.what = what
+        self._expired = False
+
+    async def __aenter__(self) -> Deadline:
+        self._task = asyncio.current_task()
+        # Task.cancelling is 3.11+, without it an outside cancellation racing the deadline may be taken for it
+        self._cancelling = self._task.cancelling() if hasattr(self._task, 'cancelling') else 0
+        self._handle = asyncio.get_running_loop().call_later(self.seconds, self._expire)
+        return self
+
+    def _expire(self) -> None:
+        self._expired = True
+        self._task.cancel()
+
+    async def __aexit__(self, exc_type: Any, exc: Any, tb: Any) -> bool:
+        self._handle.cancel()
+        if not self._expired:
+            return False
+
+        cancelling = self._task.uncancel() if hasattr(self._task, 'uncancel') else 0
+        if exc_type is asyncio.CancelledError and cancelling <= self._cancelling:
+            raise DeadlineExceededError(self.scope, self.what, self.seconds) from None
+
+        return False
@@ -0,0 +1,74 @@
+from __future__ import annotations
+from typing import *
+
+import codecs
+
+from ..clients.base import Context, File, OutputPolicy
+from .command import CommandOutput
+from .metrics import metrics
+
+__all__: List[str] = ['OutputPolicy', 'iter_pages', 'send', 'deliver']
+
+def iter_pages(content: memoryview, limit: int) -> Generator[str, None, None]:
+    """decodes `content` as utf-8 in pages of at most `limit` chars, decoding no further than the page being yielded"""
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    step = limit * 4
+    size = len(content)
+    pos = 0
+    pending = ''
+    while True:
+        while len(pending) < limit and pos < size:
+            pending += decoder.decode(content[pos : pos + step], final=pos + step >= size)
+            pos += step
+
+        if not pending:
+            return
+
+        yield pending[:limit]
+        pending = pending[limit:]
+
+async def send(ctx: Context, content: str, files: List[File]) -> None:
+    """sends a message through the context's outbox if it has one"""
+    if metrics.enabled:
+        size = len(content.encode()) + sum(len(file.fp) for file in files)
+        metrics.inc('bytes_out_total', size, stage='send', client=ctx.client_name)
+
+    if ctx.outbox is not None:
+        await ctx.outbox.send(ctx, content, files)
+    else:
+        await ctx.send(content, files=files)
+
+async def deliver(ctx: Context, out: CommandOutput, files: List[File], policy: Optional[OutputPolicy] = None) -> None:
+    """sends the combined output of a script following `policy` (the context's by default),
+    only the text that ends up in messages is decoded"""
+    policy = policy if policy is not None else ctx.output_policy
+    content = out.view()
+    pages = iter_pages(content, policy.limit)
+    first = next(pages, '') or policy.empty
+    overflow = next(pages, None)
+
+    if overflow is None or policy.mode == 'truncate':
+        await send(ctx, first, files)
+        return
+
+    whole = File(filename=policy.filename, fp=content)
+
+    if policy.mode == 'file' or policy.max_pages == 1:
+        await send(ctx, first, files + [whole])
+        return
+
+    await send(ctx, first, files)
+
+    count = 1
+    page: Optional[str] = overflow
+    while page is not None:
+        count += 1
+        following = next(pages, None)
+
+        if following is not None and count == policy.max_pages:
+            # out of pages, the whole output goes along with the last one
+            await send(ctx, page, [whole])
+            return
+
+        await send(ctx, page, [])
+        page = following
@@ -0,0 +1,230 @@
+### Persistent variables in global, guild, channel and user scopes, which scripts see under their own overlay
+from __future__ import annotations
+from typing import *
+
+import asyncio
+import json
+import re
+import sqlite3
+
+from .cache import LRUCache
+from .metrics import metrics
+from .shparser import Overlay
+
+__all__: List[str] = ['Environment', 'VariableStore', 'VariableError', 'SCOPES', 'environment']
+
+class VariableError(Exception): pass
+
+# from the widest to the narrowest, a narrower scope shadows the wider ones
+SCOPES = ('global', 'guild', 'channel', 'user')
+
+NAME_RE = re.compile(r"[a-zA-Z0-9]+")
+
+class Layer:
+    """the variables of one scope (eg. one channel), `version` changes with every assignment"""
+    __slots__ = ('values', 'version')
+
+    def __init__(self):
+        self.values: Dict[str, str] = {}
+        self.version = 0
+
+
+class VariableStore:
+    """keeps variables in the sqlite database at `path`. assignments are queued and written behind in batches
+    by a task every `interval` seconds (or as soon as `max_pending` are waiting), in a thread so the event loop
+    never waits on the disk. later assignments of a variable still pending replace the earlier ones"""
+
+    def __init__(self, path: str, interval: float = 1.0, max_pending: int = 1000):
+        self.path = path
+        self.interval = interval
+        self.max_pending = max_pending
+        self.written = 0
+        self.batches = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS variables (scope TEXT, key TEXT, name TEXT, value TEXT, PRIMARY KEY (scope, key, name))"
+        )
+        self._db.commit()
+        self._pending: Dict[Tuple[str, str, str], Optional[str]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+
+    def load(self) -> Iterator[Tuple[str, Hashable, str, str]]:
+        """every stored (scope, key, name, value), meant to be read once at startup"""
+        for scope, key, name, value in self._db.execute("SELECT scope, key, name, value FROM variables"):
+            yield scope, json.loads(key), name, value
+
+    def put(self, scope: str, key: Hashable, name: str, value: Optional[str]) -> None:
+        """queues an assignment, None deletes the variable"""
+        self._pending[scope, json.dumps(key), name] = value
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._write_behind())
+        elif len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    async def _write_behind(self) -> None:
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """writes every queued assignment now"""
+        async with self._lock:
+            if not self._pending:
+                return
+
+            batch, self._pending = self._pending, {}
+            write = asyncio.get_running_loop().run_in_executor(None, self._write, batch)
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # the thread is writing the batch already, it has to land before anyone else gets the lock
+                # (close() cancels the write behind task and then closes the database)
+                await write
+                raise
+            finally:
+                if write.done() and not write.cancelled() and write.exception() is None:
+                    self.written += len(batch)
+                    self.batches += 1
+                    if metrics.enabled:
+                        metrics.inc('variables_written_total', len(batch))
+
+    def _write(self, batch: Dict[Tuple[str, str, str], Optional[str]]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO variables VALUES (?, ?, ?, ?)",
+                [(*key, value) for key, value in batch.items() if value is not None],
+            )
+            self._db.executemany(
+                "DELETE FROM variables WHERE scope = ? AND key = ? AND name = ?",
+                [key for key, value in batch.items() if value is None],
+            )
+
+    async def close(self) -> None:
+        """flushes what's left and closes the database"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        await self.flush()
+        self._db.close()
+
+    def __repr__(self) -> str:
+        return f"<VariableStore {self.path} pending={len(self._pending)} written={self.written} batches={self.batches}>"
+
+
+class Environment:
+    """the variables of every scope. what a context sees (its guild's over the global ones, its channel's
+    over those and its author's over everything) is merged once and kept until one of the layers changes,
+    a script gets an Overlay of it so its own assignments never touch it. with a `store` every assignment
+    is persisted, `load` reads them back"""
+
+    def __init__(
+        self,
+        store: Optional[VariableStore] = None,
+        max_views: int = 4096,
+        max_variables: int = 100,
+        max_value: int = 2000,
+    ):
+        self.store = store
+        self.max_variables = max_variables
+        self.max_value = max_value
+        self.layers: Dict[Tuple[str, Hashable], Layer] = {}
+        self._views = LRUCache(maxsize=max_views)
+
+    def load(self, store: VariableStore) -> None:
+        """reads the variables kept in `store` and persists further assignments to it"""
+        self.store = store
+        for scope, key, name, value in store.load():
+            layer = self._layer(scope, key)
+            layer.values[name] = value
+            layer.version += 1
+
+    def _layer(self, scope: str, key: Hashable) -> Layer:
+        layer = self.layers.get((scope, key))
+        if layer is None:
+            layer = self.layers[scope, key] = Layer()
+
+        return layer
+
+    def key_of(self, ctx: Any, scope: str) -> Hashable:
+        """which layer of `scope` the context writes to"""
+        if scope == 'global':
+            return None
+        if scope == 'guild':
+            key = ctx.get_guild_id()
+            if key is None:
+                raise VariableError("there's no guild here")
+            return key
+        if scope == 'channel':
+            return ctx.get_channel_id()
+        if scope == 'user':
+            return ctx.get_author_id()
+
+        raise VariableError(f"unknown scope {repr(scope)}, expected one of {SCOPES}")
+
+    def view(self, guild: Hashable, channel: Hashable, user: Hashable) -> Dict[str, str]:
+        """the merged variables of the given layers, shared between callers so it mustn't be changed"""
+        layers = (
+            self.layers.get(('global', None)),
+            self.layers.get(('guild', guild)) if guild is not None else None,
+            self.layers.get(('channel', channel)),
+            self.layers.get(('user', user)),
+        )
+        versions = tuple(layer.version if layer is not None else -1 for layer in layers)
+
+        key = (guild, channel, user)
+        cached = self._views.get(key)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+
+        merged: Dict[str, str] = {}
+        for layer in layers:
+            if layer is not None:
+                merged.update(layer.values)
+
+        self._views.put(key, (versions, merged))
+        return merged
+
+    def scope(self, ctx: Any) -> Overlay:
+        """the variables a script of the context starts with"""
+        return Overlay(self.view(ctx.get_guild_id(), ctx.get_channel_id(), ctx.get_author_id()))
+
+    def set(self, scope: str, key: Hashable, name: str, value: Optional[str]) -> None:
+        """assigns a variable of a layer, None unsets it"""
+        if scope not in SCOPES:
+            raise VariableError(f"unknown scope {repr(scope)}, expected one of {SCOPES}")
+        if NAME_RE.fullmatch(name) is None:
+            raise VariableError(f"bad variable name {repr(name)}, only letters and digits are allowed")
+
+        if value is None:
+            # unsetting what was never set mustn't leave an empty layer behind
+            layer = self.layers.get((scope, key))
+            if layer is None or layer.values.pop(name, None) is None:
+                return
+        else:
+            layer = self._layer(scope, key)
+            if len(value) > self.max_value:
+                raise VariableError(f"the value of {name} is longer than {self.max_value} chars")
+            if name not in layer.values and len(layer.values) >= self.max_variables:
+                raise VariableError(f"a {scope} can't have more than {self.max_variables} variables")
+            layer.values[name] = value
+
+        layer.version += 1
+        if self.store is not None:
+            self.store.put(scope, key, name, value)
+
+    def get(self, scope: str, key: Hashable) -> Dict[str, str]:
+        layer = self.layers.get((scope, key))
+        return dict(layer.values) if layer is not None else {}
+
+    def __repr__(self) -> str:
+        return f"<Environment layers={len(self.layers)} views={len(self._views)} store={self.store}>"
+
+
+environment = Environment()
@@ -0,0 +1,397 @@
+#! /usr/bin/env python
+### Multi-process mode, a gateway process owns the client and hands scripts to interpreter worker processes
+from __future__ import annotations
+from typing import *
+from itertools import count
+
+import asyncio
+import os
+import pickle
+import struct
+import sys
+
+from ..clients.base import Context as BaseContext, File, Files, OutputPolicy
+from .metrics import metrics
+from .shparser import ENGINES, VAR_RE
+
+__all__: List[str] = ['Gateway', 'GatewayError', 'WorkerError', 'WorkerCrashedError', 'read_frame', 'write_frame']
+
+class GatewayError(Exception): pass
+class WorkerError(GatewayError): pass
+class WorkerCrashedError(WorkerError): pass
+
+# frames are a 4 byte length and a 1 byte kind followed by a pickled payload
+HEADER = struct.Struct('!IB')
+MAX_FRAME = 256 * 1024 * 1024
+
+# gateway -> worker
+RUN = 1      # (job id, script, variables, {attachment name: cache key}, channel id, author id, client name, output policy, admin)
+REPLY = 2    # (call id, result, error message or None)
+# worker -> gateway
+CALL = 3     # (call id, job id, method, args)
+DONE = 4     # (job id, error message or None)
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Tuple[int, Any]]:
+    """returns (kind, payload), or None once the other side is gone"""
+    try:
+        header = await reader.readexactly(HEADER.size)
+        size, kind = HEADER.unpack(header)
+        if size > MAX_FRAME:
+            raise GatewayError(f"frame of {size} bytes is over the limit")
+        payload = await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+    return kind, pickle.loads(payload)
+
+def write_frame(writer: asyncio.StreamWriter, kind: int, payload: Any) -> None:
+    """frames go out with a single write so concurrent writers never interleave"""
+    data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(HEADER.pack(len(data), kind) + data)
+
+
+class WorkerContext(BaseContext):
+    """the worker side stand-in for the gateway's context, sends and fetches are forwarded to the gateway"""
+
+    def __init__(
+        self,
+        worker: Worker,
+        job_id: int,
+        channel_id: Hashable,
+        author_id: Hashable,
+        client_name: str,
+        attachments: Dict[str, Hashable],
+        output_policy: OutputPolicy,
+        admin: bool = False,
+    ):
+        self.message = None
+        self.client_name = client_name
+        self.worker = worker
+        self.job_id = job_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.attachments = attachments
+        self.output_policy = output_policy
+        self.admin = admin
+
+    async def send(self, content: str = None, files: Files = None) -> None:
+        # memoryviews don't pickle
+        files = [(file.filename, file.fp if isinstance(file.fp, (bytes, bytearray)) else bytes(file.fp)) for file in files or ()]
+        await self.worker.call(self.job_id, 'send', content, files)
+
+    def get_channel_id(self) -> Hashable:
+        return self.channel_id
+
+    def get_author_id(self) -> Hashable:
+        return self.author_id
+
+    def is_admin(self) -> bool:
+        return self.admin
+
+    def get_attachments(self) -> Dict:
+        return {name: name for name in self.attachments}
+
+    async def fetch_attachment_content(self, name: str) -> bytes:
+        return await self.worker.call(self.job_id, 'fetch', name)
+
+    async def get_variables(self) -> Mapping[str, str]:
+        return await self.worker.call(self.job_id, 'get_variables')
+
+    async def set_variable(self, scope: str, name: str, value: Optional[str]) -> None:
+        from .env import VariableError
+
+        # variables live in the gateway process
+        try:
+            await self.worker.call(self.job_id, 'set_variable', scope, name, value)
+        except GatewayError as err:
+            raise VariableError(str(err)) from None
+
+    def attachment_key(self, name: str) -> Optional[Hashable]:
+        return self.attachments[name]
+
+
+class Worker:
+    """runs in a worker process, executes the scripts the gateway sends over stdin one channel at a time"""
+
+    def __init__(self, streaming: bool = False, engine: str = 'classic'):
+        from .. import commands as builtin_commands  # registers the builtin commands lazily
+        from .cache import ScriptCache
+        from .command import commands
+        from .interpreter import Interpreter
+        from .shparser import Parser
+
+        self.commands = commands
+        self.interpreter = Interpreter(streaming=streaming)
+        self.scripts = ScriptCache(Parser(engine=engine))
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self._calls: Dict[int, asyncio.Future] = {}
+        self._call_ids = count()
+        self._channels: Dict[Hashable, asyncio.Task] = {}
+
+    async def call(self, job_id: int, method: str, *args: Any) -> Any:
+        call_id = next(self._call_ids)
+        future = self._calls[call_id] = asyncio.get_running_loop().create_future()
+        write_frame(self.writer, CALL, (call_id, job_id, method, args))
+        await self.writer.drain()
+        return await future
+
+    async def run(self, previous: Optional[asyncio.Task], job_id: int, ctx: WorkerContext, script: str, variables: Dict[str, str]) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        error = None
+        try:
+            await self.interpreter.interpret(ctx, self.commands, self.scripts.load(script, variables, self.commands, ctx.client_name), script)
+        except Exception as err:
+            error = f"{type(err).__name__}: {err}"
+
+        write_frame(self.writer, DONE, (job_id, error))
+        await self.writer.drain()
+
+        if self._channels.get(ctx.channel_id) is asyncio.current_task():
+            del self._channels[ctx.channel_id]
+
+    async def serve(self, stdin: BinaryIO, stdout: BinaryIO) -> None:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=2 ** 20)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stdin)
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, stdout)
+        self.writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                break
+
+            kind, payload = frame
+            if kind == RUN:
+                job_id, script, variables, attachments, channel_id, author_id, client_name, output_policy, admin = payload
+                ctx = WorkerContext(self, job_id, channel_id, author_id, client_name, attachments, output_policy, admin)
+                # scripts of a channel run in the order they came in
+                previous = self._channels.get(channel_id)
+                self._channels[channel_id] = asyncio.ensure_future(self.run(previous, job_id, ctx, script, variables))
+
+            elif kind == REPLY:
+                call_id, result, error = payload
+                future = self._calls.pop(call_id, None)
+                if future is not None and not future.done():
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(GatewayError(error))
+
+        for task in list(self._channels.values()):
+            task.cancel()
+
+def worker_main(streaming: bool = False, engine: str = 'classic') -> None:
+    # frames own the real stdout, anything printed goes to stderr instead
+    stdout = os.fdopen(os.dup(1), 'wb', buffering=0)
+    os.dup2(2, 1)
+    asyncio.run(Worker(streaming=streaming, engine=engine).serve(os.fdopen(0, 'rb', buffering=0), stdout))
+
+
+class WorkerProcess:
+    __slots__ = ('index', 'process', 'reader_task', 'jobs', 'restarts', 'spawning')
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.jobs: Dict[int, Tuple[BaseContext, Dict[str, Any], asyncio.Future]] = {}
+        self.restarts = 0
+        # held while a process is started for it, so concurrent starts make only one
+        self.spawning = asyncio.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+
+class Gateway:
+    """sends every script to one of `workers` interpreter processes, picked by a hash of its channel
+    so a channel's scripts run in order. the gateway's context does the sends and attachment fetches
+    the workers ask for, a worker that dies fails its running scripts and is started again"""
+
+    def __init__(self, workers: int = 2, streaming: bool = False, engine: str = 'classic', restart_delay: float = 0.5):
+        self.streaming = streaming
+        self.engine = engine
+        self.restart_delay = restart_delay
+        self.workers = [WorkerProcess(i) for i in range(max(workers, 1))]
+        self._job_ids = count()
+        self._closing = False
+
+    async def start(self) -> None:
+        self._closing = False
+        await asyncio.gather(*(self._ensure(worker) for worker in self.workers))
+
+    async def _ensure(self, worker: WorkerProcess) -> None:
+        """starts a process for `worker` unless it has a live one, whoever else asks meanwhile waits for that one"""
+        async with worker.spawning:
+            if not worker.alive:
+                await self._spawn(worker)
+
+    async def _spawn(self, worker: WorkerProcess) -> None:
+        package = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package, os.environ.get('PYTHONPATH')])))
+        args = ['-m', 'shbot.impls.gateway', '--worker', '--engine', self.engine] + (['--streaming'] if self.streaming else [])
+        worker.process = await asyncio.create_subprocess_exec(
+            sys.executable, *args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, env=env,
+        )
+        worker.reader_task = asyncio.ensure_future(self._read(worker, worker.process))
+
+    def route(self, ctx: BaseContext) -> WorkerProcess:
+        return self.workers[hash(ctx.get_channel_id()) % len(self.workers)]
+
+    async def run(self, ctx: BaseContext, script: str, variables: Optional[Mapping[str, str]] = None) -> None:
+        """runs a script on a worker and returns once its output has been sent through `ctx`.
+        the variables default to the ones the context sees in `environment`"""
+        ctx.received(script)
+        if variables is None:
+            from .env import environment
+
+            variables = environment.scope(ctx)
+        worker = self.route(ctx)
+        if not worker.alive:
+            # not started yet, or it died and hasn't been restarted
+            await self._ensure(worker)
+
+        attachments = ctx.get_attachments() if '<' in script else {}
+        keys = {name: ctx.attachment_key(attch) for name, attch in attachments.items()}
+
+        job_id = next(self._job_ids)
+        future = asyncio.get_running_loop().create_future()
+        worker.jobs[job_id] = (ctx, attachments, future)
+        write_frame(worker.process.stdin, RUN, (
+            # only what the script refers to crosses over
+            job_id, script, {name: variables[name] for name in VAR_RE.findall(script) if name in variables}, keys, ctx.get_channel_id(), ctx.get_author_id(), ctx.client_name, ctx.output_policy, ctx.is_admin(),
+        ))
+        try:
+            await worker.process.stdin.drain()
+        except ConnectionError:
+            pass  # the reader fails the job once it notices
+
+        if metrics.enabled:
+            metrics.inc('gateway_jobs_total', worker=str(worker.index))
+
+        await future
+
+    async def _read(self, worker: WorkerProcess, process: asyncio.subprocess.Process) -> None:
+        while True:
+            frame = await read_frame(process.stdout)
+            if frame is None:
+                break
+
+            kind, payload = frame
+            if kind == DONE:
+                job_id, error = payload
+                _, _, future = worker.jobs.pop(job_id)
+                if not future.done():
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(WorkerError(error))
+
+            elif kind == CALL:
+                asyncio.ensure_future(self._answer(worker, process, *payload))
+
+        await process.wait()
+
+        jobs, worker.jobs = worker.jobs, {}
+        for _, _, future in jobs.values():
+            if not future.done():
+                future.set_exception(WorkerCrashedError(f"worker {worker.index} exited with {process.returncode}"))
+
+        if self._closing or worker.process is not process:
+            return
+
+        worker.restarts += 1
+        if metrics.enabled:
+            metrics.inc('gateway_worker_restarts_total', worker=str(worker.index))
+
+        await asyncio.sleep(self.restart_delay)
+        if not self._closing and worker.process is process:
+            # a script may have started it again meanwhile
+            await self._ensure(worker)
+
+    async def _answer(self, worker: WorkerProcess, process: asyncio.subprocess.Process, call_id: int, job_id: int, method: str, args: Tuple) -> None:
+        from .delivery import send
+
+        result, error = None, None
+        try:
+            ctx, attachments, _ = worker.jobs[job_id]
+            if method == 'send':
+                content, files = args
+                await send(ctx, content, [File(filename=filename, fp=fp) for filename, fp in files])
+            elif method == 'fetch':
+                result = await ctx.fetch_attachment_content(attachments[args[0]])
+            elif method == 'get_variables':
+                result = dict(await ctx.get_variables())
+            elif method == 'set_variable':
+                await ctx.set_variable(*args)
+            else:
+                raise GatewayError(f"unknown call {repr(method)}")
+        except Exception as err:
+            error = f"{type(err).__name__}: {err}"
+
+        if process.returncode is None:
+            try:
+                write_frame(process.stdin, REPLY, (call_id, result, error))
+                await process.stdin.drain()
+            except ConnectionError:
+                pass
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [{
+            'pid': worker.process.pid if worker.process else None,
+            'running': len(worker.jobs),
+            'restarts': worker.restarts,
+        } for worker in self.workers]
+
+    async def stop(self) -> None:
+        """waits for the running scripts, then closes the workers' stdin and waits for them to exit"""
+        self._closing = True
+        pending = [future for worker in self.workers for _, _, future in worker.jobs.values()]
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        for worker in self.workers:
+            if worker.alive:
+                worker.process.stdin.close()
+
+        await asyncio.gather(*(worker.reader_task for worker in self.workers if worker.reader_task is not None), return_exceptions=True)
+        for worker in self.workers:
+            worker.process = worker.reader_task = None
+
+
+async def demo(scripts: Sequence[str], workers: int, streaming: bool, engine: str) -> None:
+    from ..clients.debug import Context
+
+    gateway = Gateway(workers=workers, streaming=streaming, engine=engine)
+    await gateway.start()
+    try:
+        results = await asyncio.gather(
+            *(gateway.run(Context(None, channel_id=f"channel{i % workers}"), script) for i, script in enumerate(scripts)),
+            return_exceptions=True,
+        )
+        for script, result in zip(scripts, results):
+            if result is not None:
+                print(f"{script!r} failed: {result}")
+        print(gateway.stats())
+    finally:
+        await gateway.stop()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser: Any = argparse.ArgumentParser(description="runs shbot scripts in worker processes")
+    parser.add_argument("scripts", nargs="*", metavar="SCRIPT", help="scripts to run through a gateway with the debug client")
+    parser.add_argument("--workers", "-w", type=int, default=2, help="number of worker processes")
+    parser.add_argument("--streaming", action="store_true", help="run pipes in streaming mode")
+    parser.add_argument("--engine", "-e", choices=ENGINES, default="classic", help="tokenizer engine to use")
+    parser.add_argument("--worker", action="store_true", help="serve a gateway over stdin and stdout")
+
+    args = parser.parse_args()
+
+    if args.worker:
+        worker_main(streaming=args.streaming, engine=args.engine)
+    else:
+        asyncio.run(demo(args.scripts, args.workers, args.streaming, args.engine))
@@ -2,79 +2,566 @@ from __future__ import annotations
 from typing import *
 
 from ..clients.base import Context, File
-from .shparser import Instrs, InstrType
-from .command import Command, CommandOutput, Commands
+from .shparser import Instrs, format_instrs
+from .compiler import Op, Program, compile_program, describe_op, OP_IN, OP_HEREDOC, OP_EVAL, OP_PIPE, OP_OUT, OP_OUT1, OP_BG
+from .command import Command, CommandOutput, Commands, CommandTimeoutError
+from .pipeline import AttachmentStream, Channel, StreamOutput
+from .cache import LRUCache, attachment_cache, command_cache
+from .metrics import metrics
+from .delivery import deliver, send
+from .jobs import Job, JobError, JobTables, current_job_tables, job_tables
+from .budget import MemoryBudget, MemoryBudgetExceededError, current_budget
+from .slowlog import SlowLog, SlowLogEntry, Trace, slow_log
+from .deadlines import Deadline, Deadlines, DeadlineExceededError
+from collections import Counter
 from io import BytesIO
+from time import perf_counter, time
+
+import asyncio
+import logging
 
 __all__: List[str] = ['Interpreter']
 
+log = logging.getLogger(__name__)
+
+Stage = Tuple[int, Command, Sequence[str], Optional[CommandOutput]]
+
 class Interpreter:
-    async def interpret(self, ctx: Context, commands: Commands, instrs: Instrs):
+    def __init__(
+        self,
+        streaming: bool = False,
+        channel_limit: int = 65536,
+        attachment_cache: LRUCache = attachment_cache,
+        command_cache: Optional[LRUCache] = command_cache,
+        job_tables: JobTables = job_tables,
+        memory_budget: Optional[Callable[[], MemoryBudget]] = MemoryBudget,
+        fan_out: int = 8,
+        slow_log: SlowLog = slow_log,
+        deadlines: Deadlines = Deadlines(),
+    ):
+        """with `streaming` the commands of a pipe run concurrently, connected by channels
+        that hold at most `channel_limit` bytes. outputs of pure commands are reused through
+        `command_cache`, None turns that off. statements ending in `&` run as jobs of `job_tables`,
+        which are the tables `jobs`, `wait` and `kill` look into.
+        every script gets its own budget from `memory_budget`, None runs scripts without one.
+        up to `fan_out` independent statements of a script run at once, 1 runs them in sequence.
+        scripts slower than the threshold of `slow_log` are recorded in it while it's enabled.
+        a script (or background job) that runs out of `deadlines` is cancelled and delivers what it had so far"""
+        self.streaming = streaming
+        self.channel_limit = channel_limit
+        self.attachment_cache = attachment_cache
+        self.command_cache = command_cache
+        self.job_tables = job_tables
+        self.memory_budget = memory_budget
+        self.fan_out = fan_out
+        self.slow_log = slow_log
+        self.deadlines = deadlines
+        # timeouts by the name of the command that was cut off ('fetch' for attachments)
+        self.timeouts: Counter[str] = Counter()
+
+    async def interpret(
+        self, ctx: Context, commands: Commands, script: Union[Program, Instrs], source: Optional[str] = None,
+    ) -> Optional[MemoryBudget]:
+        """runs a script (compiling it first unless it's a Program already) and returns its memory budget,
+        which has the peak usage. unknown commands raise CommandNotFoundError before anything runs.
+        `source` is the text of the script, for the slow log"""
+        if not metrics.enabled and not self.slow_log.enabled:
+            program = script if isinstance(script, Program) else compile_program(script, commands)
+            return await self.run(ctx, program)
+
+        started = perf_counter()
+        trace: Optional[Trace] = None
+        profiler = None
+        error = None
+        try:
+            program = script if isinstance(script, Program) else compile_program(script, commands)
+            if self.slow_log.enabled:
+                trace = Trace(len(program.code))
+                profiler = self.slow_log.start_profile()
+            return await self.run(ctx, program, trace)
+        except BaseException as err:
+            error = f"{type(err).__name__}: {err}"
+            if metrics.enabled:
+                metrics.inc('errors_total', stage='interpret', client=ctx.client_name)
+            raise
+        finally:
+            elapsed = perf_counter() - started
+            if metrics.enabled:
+                metrics.observe('stage_seconds', elapsed, stage='interpret', client=ctx.client_name)
+            if trace is not None:
+                try:
+                    self.log_slow(ctx, script, source, program, trace, elapsed, profiler, error)
+                except Exception:
+                    # the script is done either way, a broken slow log mustn't change how it ended
+                    log.exception("couldn't record a slow script")
+
+    def log_slow(
+        self,
+        ctx: Context,
+        script: Union[Program, Instrs],
+        source: Optional[str],
+        program: Program,
+        trace: Trace,
+        elapsed: float,
+        profiler: Any,
+        error: Optional[str],
+    ) -> None:
+        profile = self.slow_log.stop_profile(profiler, ctx.client_name) if profiler is not None else None
+        if elapsed < self.slow_log.threshold:
+            return
+
+        instrs = None if isinstance(script, Program) else tuple(script)
+        if source is None:
+            source = format_instrs(instrs) if instrs is not None else repr(program)
+
+        self.slow_log.record(SlowLogEntry(
+            started=time() - elapsed,
+            duration=elapsed,
+            client=ctx.client_name,
+            channel=ctx.get_channel_id(),
+            author=ctx.get_author_id(),
+            script=source,
+            instrs=instrs,
+            ops=[(describe_op(op), seconds) for op, seconds in zip(program.code, trace.times)],
+            bytes_in=trace.bytes_in,
+            bytes_out=trace.bytes_out,
+            profile=profile,
+            error=error,
+        ))
+
+    async def run(self, ctx: Context, program: Program, trace: Optional[Trace] = None) -> Optional[MemoryBudget]:
+        budget = self.memory_budget() if self.memory_budget is not None else None
+        token = current_budget.set(budget)
+        tables_token = current_job_tables.set(self.job_tables)
+        try:
+            await self.execute(ctx, program, budget, trace)
+        except MemoryBudgetExceededError as err:
+            if metrics.enabled:
+                metrics.inc('errors_total', stage='budget', client=ctx.client_name)
+            await send(ctx, f"script aborted: {err}", [])
+        finally:
+            current_budget.reset(token)
+            current_job_tables.reset(tables_token)
+            if budget is not None:
+                budget.close()
+                if metrics.enabled:
+                    metrics.observe('script_peak_bytes', budget.peak, client=ctx.client_name)
+                    metrics.inc('spilled_bytes_total', budget.spilled, client=ctx.client_name)
+
+        return budget
+
+    async def execute(self, ctx: Context, program: Program, budget: Optional[MemoryBudget], trace: Optional[Trace] = None) -> None:
         out_files: List[File] = []
-        in_files_cache: Dict[str, Any] = {}
+        # (index of the op, its output) for every op cut off by a deadline
+        partial: List[Tuple[int, CommandOutput]] = []
+        try:
+            if self.deadlines.script is None:
+                out = await self.evaluate(ctx, program, budget, out_files, trace, partial)
+            else:
+                async with Deadline(self.deadlines.script, 'script', 'the script'):
+                    out = await self.evaluate(ctx, program, budget, out_files, trace, partial)
+        except (DeadlineExceededError, CommandTimeoutError) as err:
+            out = self.timed_out(ctx, program, err, partial)
+
+        if trace is not None:
+            trace.bytes_out = out.nbytes + sum(len(file.fp) for file in out_files)
+
+        await deliver(ctx, out, out_files)
+
+    async def evaluate(
+        self,
+        ctx: Context,
+        program: Program,
+        budget: Optional[MemoryBudget],
+        out_files: List[File],
+        trace: Optional[Trace] = None,
+        partial: Optional[List[Tuple[int, CommandOutput]]] = None,
+    ) -> CommandOutput:
+        in_files = await self.fetch_attachments(ctx, program.attachments)
+        # attachments (and heredoc bodies) are only read through wrapped outputs, their bytes are
+        # charged once a command's output copies them, streamed ones by the stages they come into
+        fetched = [content for content in in_files.values() if type(content) is not AttachmentStream]
+
+        if trace is not None:
+            trace.bytes_in = sum(map(len, fetched)) + sum(len(operand) for op, operand, _ in program.code if op == OP_HEREDOC)
+
+        out: CommandOutput = CommandOutput()
+        statements = program.statements
+        if self.fan_out <= 1 or sum(concurrent for _, _, concurrent in statements) < 2:
+            return await self.run_code(ctx, program.code, in_files, budget, out, out_files, trace, 0, partial)
+
+        return await self.run_statements(ctx, program, in_files, budget, out, out_files, trace, partial)
+
+    def timed_out(
+        self, ctx: Context, program: Program, err: Exception, partial: List[Tuple[int, CommandOutput]],
+    ) -> CommandOutput:
+        """the output of a script that ran out of time: what the first op to be cut off had written, then the error"""
+        if partial:
+            index, out = min(partial, key=lambda entry: entry[0])
+            command = running_command(program.code, index)
+        else:
+            # it didn't get past fetching the attachments
+            out, command = CommandOutput(), 'fetch'
+
+        scope = err.scope if isinstance(err, DeadlineExceededError) else 'command'
+        if scope == 'command' and isinstance(err, DeadlineExceededError):
+            # in a streamed pipe it may not be the last command
+            command = err.what
+        self.timeouts[command] += 1
+        if metrics.enabled:
+            metrics.inc('timeouts_total', scope=scope, command=command, client=ctx.client_name)
+
+        if out.nbytes and bytes(out.view()[-1:]) != b'\n':
+            out // '\n'
+        out @ 1 // f"script aborted: {err}\n"
+        return out
+
+    async def run_statements(
+        self,
+        ctx: Context,
+        program: Program,
+        in_files: Dict[str, bytes],
+        budget: Optional[MemoryBudget],
+        out: CommandOutput,
+        out_files: List[File],
+        trace: Optional[Trace] = None,
+        partial: Optional[List[Tuple[int, CommandOutput]]] = None,
+    ) -> CommandOutput:
+        """runs consecutive concurrent statements as tasks, at most `fan_out` at once, each into an output
+        of its own. the outputs are then taken in statement order, which gives what running them one
+        after another would have since each of them starts by clearing the output"""
+        semaphore = asyncio.Semaphore(self.fan_out)
+
+        async def run_statement(start: int, end: int) -> Tuple[CommandOutput, List[File]]:
+            async with semaphore:
+                files: List[File] = []
+                return await self.run_code(ctx, program.code[start:end], in_files, budget, CommandOutput(), files, trace, start, partial), files
+
+        batch: List[asyncio.Future] = []
+
+        async def collect() -> CommandOutput:
+            nonlocal out
+            try:
+                for task in batch:
+                    statement_out, files = await task
+                    out_files.extend(files)
+                    # what running it in sequence would have cleared
+                    out.clear()
+                    out = statement_out
+            except BaseException:
+                for task in batch:
+                    task.cancel()
+                # lets the statements still running record what they had written
+                await asyncio.gather(*batch, return_exceptions=True)
+                raise
+            finally:
+                batch.clear()
+
+            return out
+
+        for start, end, concurrent in program.statements:
+            if concurrent:
+                batch.append(asyncio.ensure_future(run_statement(start, end)))
+                continue
+
+            # a barrier, everything before it finishes first and everything after waits for it
+            await collect()
+            out = await self.run_code(ctx, program.code[start:end], in_files, budget, out, out_files, trace, start, partial)
+
+        return await collect()
+
+    async def run_code(
+        self,
+        ctx: Context,
+        code: Sequence[Op],
+        in_files: Dict[str, bytes],
+        budget: Optional[MemoryBudget],
+        out: CommandOutput,
+        out_files: List[File],
+        trace: Optional[Trace] = None,
+        base: int = 0,
+        partial: Optional[List[Tuple[int, CommandOutput]]] = None,
+    ) -> CommandOutput:
+        """runs ops one after another, appending redirected files to `out_files` and returning the output left over.
+        with a `trace` the time spent on every op is added to it (`base` is the index of the first one),
+        a streamed pipe is charged to the op that ends up running it. when an op is cut off
+        its index and output go to `partial`"""
+        streaming = self.streaming
         in_file: Optional[CommandOutput] = None
         pipe: Optional[CommandOutput] = None
-        out: CommandOutput = CommandOutput()
-        for instr in instrs:
-            instr_type = instr.instr_type
-            arg1, *args = instr.args
+        stages: List[Stage] = []
+        op_started = 0.0
+        index = base
+        try:
+            for index, (op, operand, args) in enumerate(code, base):
+                if trace is not None:
+                    op_started = perf_counter()
+
+                if op == OP_EVAL or op == OP_PIPE:
+                    if streaming:
+                        if op == OP_EVAL and stages:
+                            out = await self.run_stages(ctx, stages, out)
+                            stages = []
 
+                        stages.append((op, operand, args, in_file))
 
-            if instr_type == InstrType.IN:
-                filename = arg1
+                    elif op == OP_PIPE:
+                        pipe = out
+                        out = CommandOutput()
+                        await self.invoke(ctx, operand, out, args, in_file or pipe)
+                        # consumed, this gives its bytes back to the budget
+                        pipe.clear()
+                    else:
+                        out.clear_stds()
+                        await self.invoke(ctx, operand, out, args, in_file)
 
-                names = ctx.get_attachments()
+                    in_file = None
 
-                if filename not in names:
-                    raise Exception
+                elif op == OP_IN:
+                    content = in_files[operand]
+                    in_file = content if type(content) is AttachmentStream else CommandOutput.wrap(content)
+
+                elif op == OP_HEREDOC:
+                    in_file = CommandOutput.wrap(operand)
+
+                elif op == OP_BG:
+                    if stages:
+                        out = await self.run_stages(ctx, stages, out)
+                        stages = []
+
+                    try:
+                        self.spawn_job(ctx, operand, args)
+                    except JobError as err:
+                        out // f"{err}\n"
 
-                if filename in in_files_cache:
-                    content = in_files_cache[filename]
                 else:
-                    content = await ctx.fetch_attachment_content(names[filename])
-                    in_files_cache[filename] = content
-                    in_file = CommandOutput()
-                    in_file + content
+                    if stages:
+                        out = await self.run_stages(ctx, stages, out)
+                        stages = []
+
+                    if op == OP_OUT:
+                        fp = out.pop_stds()
+                    elif op == OP_OUT1:
+                        fp = out.pop_outs()
+                    else:
+                        fp = out.pop_errs()
+
+                    out_files.append(File(filename=operand, fp=fp))
+
+                if trace is not None:
+                    trace.add(index, perf_counter() - op_started)
+
+            if stages:
+                if trace is not None:
+                    op_started = perf_counter()
+                out = await self.run_stages(ctx, stages, out)
+                if trace is not None:
+                    trace.add(base + len(code) - 1, perf_counter() - op_started)
+        except BaseException:
+            if partial is not None:
+                partial.append((index, out))
+            raise
+
+        return out
+
+    def spawn_job(self, ctx: Context, program: Program, description: str) -> Job:
+        table = self.job_tables.get(ctx.get_channel_id())
+        return table.spawn(self.run_job(ctx, program, description), description)
+
+    async def run_job(self, ctx: Context, program: Program, description: str) -> Optional[Exception]:
+        """runs a background statement, which delivers its own output once it is done"""
+        try:
+            await self.run(ctx, program)
+        except Exception as err:
+            await send(ctx, f"background job `{description}` failed: {err}", [])
+            return err
+
+        return None
+
+    async def invoke(self, ctx: Context, command: Command, out: CommandOutput, args: Sequence[str], pipe: Any) -> None:
+        """runs a command, reusing an earlier output when the command is pure and its input was seen before"""
+        if self.command_cache is None or not command.pure or not (pipe is None or isinstance(pipe, CommandOutput)):
+            return await self.call(ctx, command, out, args, pipe)
+
+        key = (command.name, tuple(args), pipe.digest() if pipe is not None else None)
+        cached = self.command_cache.get(key)
+
+        if cached is not None:
+            if metrics.enabled:
+                metrics.inc('command_cache_hits_total', command=command.name)
+            out.extend(cached)
+            return
+
+        if metrics.enabled:
+            metrics.inc('command_cache_misses_total', command=command.name)
+
+        if type(out) is CommandOutput and not out.nbytes:
+            await self.call(ctx, command, out, args, pipe)
+            result = out.copy()
+        else:
+            # owned by the cache like a copy, so it's charged (and maybe spilled) only once it's in `out`
+            result = CommandOutput()
+            result.budget = None
+            await self.call(ctx, command, result, args, pipe)
+            out.extend(result)
+
+        self.command_cache.put(key, result)
 
+    async def call(self, ctx: Context, command: Command, out: CommandOutput, args: Sequence[str], pipe: Any) -> None:
+        # a command waiting on jobs would only cut them off early, the script deadline still bounds it
+        if self.deadlines.command is None or command.waits:
+            return await command(ctx, out, args, pipe=pipe)
 
-            elif instr_type in (InstrType.OUT, InstrType.OUT1, InstrType.OUT2):
-                filename = arg1
+        async with Deadline(self.deadlines.command, 'command', command.name):
+            await command(ctx, out, args, pipe=pipe)
 
-                if out is None:
-                    raise Exception
-                elif instr_type == InstrType.OUT:
-                    fp = b''.join(out.get_stds())
-                    out.clear_stds()
-                elif instr_type == InstrType.OUT1:
-                    fp = b''.join(out.get_outs())
-                    out.clear_outs()
-                elif instr_type == InstrType.OUT2:
-                    fp = b''.join(out.get_errs())
-                    out.clear_errs()
+    async def fetch_attachments(self, ctx: Context, filenames: Sequence[str]) -> Dict[str, Union[bytes, AttachmentStream]]:
+        """fetches every attachment read by a `<` of the script concurrently, before anything runs.
+        in streaming mode those the client can stream and that aren't cached are left as
+        AttachmentStreams and downloaded into the stages reading them instead"""
+        if not filenames:
+            return {}
 
-                out_files.append(File(filename=filename, fp=fp))
+        names = ctx.get_attachments()
 
+        for filename in filenames:
+            if filename not in names:
+                raise Exception(f'attachment {repr(filename)} not found')
+
+        streamed: Dict[str, Union[bytes, AttachmentStream]] = {}
+        if self.streaming:
+            for filename in filenames:
+                attch = names[filename]
+                if ctx.streams_attachment(attch):
+                    key = ctx.attachment_key(attch)
+                    # only a whole cached body is worth more than streaming it
+                    content = self.attachment_cache.get(key) if key is not None else None
+                    streamed[filename] = content if content is not None else AttachmentStream(ctx, attch, filename)
+
+            filenames = [filename for filename in filenames if filename not in streamed]
+            if not filenames:
+                return streamed
+
+        tasks = [asyncio.ensure_future(self.fetch_attachment(ctx, names[filename], filename)) for filename in filenames]
+        try:
+            contents = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        streamed.update(zip(filenames, contents))
+        return streamed
+
+    async def fetch_attachment(self, ctx: Context, attch, filename: str = 'an attachment') -> bytes:
+        """fetches through the attachment cache, scripts reading the same attachment at once fetch it once"""
+        key = ctx.attachment_key(attch)
+        if key is None:
+            return await self.load_attachment(ctx, attch, filename)
+
+        return await self.attachment_cache.fetch(key, lambda: self.load_attachment(ctx, attch, filename))
+
+    async def load_attachment(self, ctx: Context, attch, filename: str) -> bytes:
+        if self.deadlines.fetch is None:
+            content = await ctx.fetch_attachment_content(attch)
+        else:
+            async with Deadline(self.deadlines.fetch, 'fetch', f"fetching {repr(filename)}"):
+                content = await ctx.fetch_attachment_content(attch)
+
+        if metrics.enabled:
+            metrics.inc('bytes_in_total', len(content), stage='fetch', client=ctx.client_name)
+
+        return content
+
+    async def run_stages(self, ctx: Context, stages: List[Stage], out: CommandOutput) -> CommandOutput:
+        """runs a chain of piped commands as concurrent tasks and returns the output of the last one"""
+        if stages[0][0] == OP_EVAL:
+            out.clear_stds()
+            source: Union[CommandOutput, Channel, None] = None
+            sink = out
+        else:
+            source = out
+            sink = CommandOutput()
+
+        tasks: List[asyncio.Future] = []
+        for i, (_, command, args, in_file) in enumerate(stages):
+            if i == len(stages) - 1:
+                stage_out = sink
             else:
-                command_name = arg1
-                command = commands.get(command_name)
+                stage_out = StreamOutput(Channel(self.channel_limit))
+
+            tasks.append(asyncio.ensure_future(self.run_stage(ctx, command, stage_out, args, source, in_file)))
 
-                if command is None:
-                    raise Exception(f'command {repr(command_name)} not found')
+            if isinstance(stage_out, StreamOutput):
+                source = stage_out.channel
 
-                if instr_type == InstrType.PIPE:
-                    pipe = out
-                    out = CommandOutput()
-                    await command(ctx, out, args, pipe=in_file or pipe)
-                elif instr_type == InstrType.EVAL:
-                    out.clear_stds()
-                    await command(ctx, out, args, pipe=in_file)
-                
-                in_file = None
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        return sink
+
+    async def run_stage(
+        self,
+        ctx: Context,
+        command: Command,
+        out: CommandOutput,
+        args: Sequence[str],
+        source: Union[CommandOutput, Channel, None],
+        in_file: Union[CommandOutput, AttachmentStream, None],
+    ) -> None:
+        pipe: Union[CommandOutput, Channel, None] = source
+        # the channel a streamed attachment is downloaded into and the task doing it
+        download: Optional[Channel] = None
+        feeder: Optional[asyncio.Future] = None
+        try:
+            if in_file is not None:
+                if isinstance(source, Channel):
+                    source.discard()
+
+                if type(in_file) is AttachmentStream:
+                    pipe = download = Channel(self.channel_limit)
+                    feeder = asyncio.ensure_future(in_file.feed(download))
+                    if not command.streaming:
+                        pipe = await download.collect()
+                        # a failed download fails the stage before the command sees half of it
+                        await feeder
+                else:
+                    pipe = in_file
+            elif isinstance(source, Channel) and not command.streaming:
+                pipe = await source.collect()
 
-        content = b''.join(out.get_stds()).decode('utf-8', 'replace') or "** **"
-        await ctx.send(content[:2000], files=out_files)
+            await self.invoke(ctx, command, out, args, pipe)
+            await out.drain()
 
+            if feeder is not None:
+                # the command may not have read all of it
+                download.discard()
+                await feeder
 
+            if isinstance(pipe, CommandOutput) and pipe is not source and pipe is not in_file:
+                pipe.clear()
+        finally:
+            if feeder is not None:
+                if not feeder.done():
+                    feeder.cancel()
+                elif not feeder.cancelled():
+                    # the stage failed on its own, what the download raised doesn't matter anymore
+                    feeder.exception()
+            if isinstance(out, StreamOutput):
+                out.close()
+            if isinstance(source, Channel):
+                source.discard()
 
 
+def running_command(code: Sequence[Op], index: int) -> str:
+    """the name of the command that was running when the op at `index` was cut off,
+    a streamed pipe runs at the op after its last command"""
+    for op, operand, _ in reversed(code[: index + 1]):
+        if op == OP_EVAL or op == OP_PIPE:
+            return operand.name
 
+    return '-'
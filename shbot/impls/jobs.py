@@ -0,0 +1,179 @@
+from __future__ import annotations
+from typing import *
+from contextvars import ContextVar
+from time import monotonic
+
+import asyncio
+
+__all__: List[str] = ['Job', 'JobTable', 'JobTables', 'JobError', 'JobLimitError', 'JobNotFoundError', 'current_job', 'current_job_tables', 'job_tables']
+
+class JobError(Exception): pass
+class JobLimitError(JobError): pass
+class JobNotFoundError(JobError): pass
+
+class Job:
+    def __init__(self, job_id: int, description: str, task: asyncio.Task):
+        self.id = job_id
+        self.description = description
+        self.task = task
+        self.started = monotonic()
+
+    @property
+    def status(self) -> str:
+        if not self.task.done():
+            return 'running'
+        if self.task.cancelled():
+            return 'killed'
+        if self.task.exception() is not None or self.task.result() is not None:
+            # the task either raised or returned the error it already reported
+            return 'failed'
+        return 'done'
+
+    def __str__(self):
+        return f"[{self.id}] {self.status:<8} {self.description}"
+
+    def __repr__(self):
+        return f"<Job id={self.id} status={self.status}>"
+
+
+class JobTable:
+    """the background jobs of one channel. finished jobs are kept for `keep_finished` seconds so they
+    can be listed or waited on, at most `max_finished` of them, `on_empty` is called once none are left"""
+
+    def __init__(
+        self,
+        max_jobs: int = 4,
+        max_finished: int = 16,
+        keep_finished: float = 600.0,
+        on_empty: Optional[Callable[[JobTable], None]] = None,
+    ):
+        self.max_jobs = max_jobs
+        self.max_finished = max_finished
+        self.keep_finished = keep_finished
+        self.on_empty = on_empty
+        self.jobs: Dict[int, Job] = {}
+        self._next_id = 1
+
+    def running(self) -> List[Job]:
+        return [job for job in self.jobs.values() if not job.task.done()]
+
+    def spawn(self, coro: Coroutine, description: str) -> Job:
+        if len(self.running()) >= self.max_jobs:
+            coro.close()
+            raise JobLimitError(f"too many background jobs, at most {self.max_jobs} may run at once")
+
+        job = Job(self._next_id, description, asyncio.ensure_future(self._run(coro)))
+        job.task.add_done_callback(lambda task: self._finished(job, coro))
+        self.jobs[job.id] = job
+        self._next_id += 1
+        return job
+
+    async def _run(self, coro: Coroutine) -> Any:
+        current_job.set(asyncio.current_task())
+        return await coro
+
+    def _finished(self, job: Job, coro: Coroutine) -> None:
+        # a job killed before it started never ran its coroutine
+        coro.close()
+
+        finished = [other for other in self.jobs.values() if other.task.done()]
+        for old in finished[: max(len(finished) - self.max_finished, 0)]:
+            self.forget(old)
+
+        if job.id in self.jobs:
+            asyncio.get_running_loop().call_later(self.keep_finished, self.forget, job)
+
+    def forget(self, job: Job) -> None:
+        """drops a job if it's still here"""
+        if self.jobs.get(job.id) is job:
+            del self.jobs[job.id]
+            self._check_empty()
+
+    def _check_empty(self) -> None:
+        if not self.jobs and self.on_empty is not None:
+            self.on_empty(self)
+
+    def get(self, job_id: int) -> Job:
+        if job_id not in self.jobs:
+            self._check_empty()
+            raise JobNotFoundError(f"no such job: {job_id}")
+
+        return self.jobs[job_id]
+
+    def list(self) -> List[Job]:
+        """every job, finished ones are forgotten once they have been listed"""
+        jobs = list(self.jobs.values())
+        for job in jobs:
+            if job.task.done():
+                self.forget(job)
+
+        self._check_empty()
+        return jobs
+
+    async def wait(self, job_ids: Optional[Iterable[int]] = None) -> List[Job]:
+        """waits for the given jobs or every job but the one waiting, if it is one"""
+        own = current_job.get()
+        if job_ids is not None:
+            jobs = [self.get(job_id) for job_id in job_ids]
+            if any(job.task is own for job in jobs):
+                raise JobError("a job can't wait for itself")
+        else:
+            jobs = [job for job in self.jobs.values() if job.task is not own]
+
+        if jobs:
+            await asyncio.wait([job.task for job in jobs])
+
+        for job in jobs:
+            self.forget(job)
+
+        self._check_empty()
+        return jobs
+
+    def kill(self, job_id: int) -> Job:
+        job = self.get(job_id)
+        job.task.cancel()
+        return job
+
+    def __len__(self) -> int:
+        return len(self.jobs)
+
+
+class JobTables:
+    """the job tables of every channel, a table is dropped once it has no jobs left"""
+
+    def __init__(self, max_jobs: int = 4, max_finished: int = 16, keep_finished: float = 600.0):
+        self.max_jobs = max_jobs
+        self.max_finished = max_finished
+        self.keep_finished = keep_finished
+        self._tables: Dict[Hashable, JobTable] = {}
+
+    def get(self, channel: Hashable) -> JobTable:
+        table = self._tables.get(channel)
+        if table is None:
+            table = self._tables[channel] = JobTable(
+                self.max_jobs,
+                self.max_finished,
+                self.keep_finished,
+                on_empty=lambda table: self._drop(channel, table),
+            )
+
+        return table
+
+    def _drop(self, channel: Hashable, table: JobTable) -> None:
+        if self._tables.get(channel) is table:
+            del self._tables[channel]
+
+    def __len__(self) -> int:
+        return len(self._tables)
+
+    def __repr__(self):
+        return f"<JobTables channels={len(self._tables)} max_jobs={self.max_jobs}>"
+
+
+# the task of the job running in this context, None outside of jobs
+current_job: ContextVar[Optional[asyncio.Task]] = ContextVar('current_job', default=None)
+
+job_tables = JobTables()
+
+# the job tables of the interpreter running in this context, which the job builtins look into
+current_job_tables: ContextVar[JobTables] = ContextVar('current_job_tables', default=job_tables)
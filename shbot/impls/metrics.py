@@ -0,0 +1,160 @@
+from __future__ import annotations
+from typing import *
+from bisect import bisect_left
+
+import os
+
+__all__: List[str] = ['Metrics', 'Histogram', 'Exporter', 'PrometheusExporter', 'MemoryExporter', 'metrics']
+
+Labels = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTE_BUCKETS = tuple(float(1024 * 4 ** i) for i in range(11))  # 1KiB to 1GiB
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Sequence[float] = DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """(upper bound, observations <= bound) pairs, the last bound is inf"""
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+
+        return buckets
+
+    def __repr__(self) -> str:
+        return f"<Histogram count={self.count} sum={self.sum}>"
+
+
+class Metrics:
+    """histograms and counters for script execution, every hook checks `enabled` first
+    so a disabled registry costs one attribute lookup per hook"""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.exporters: List[Exporter] = []
+        # histograms that don't measure seconds, by name
+        self.buckets: Dict[str, Sequence[float]] = {'script_peak_bytes': BYTE_BUCKETS}
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(self.buckets.get(name, DEFAULT_BUCKETS))
+
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def get_counter(self, name: str, **labels: str) -> float:
+        return self.counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def get_histogram(self, name: str, **labels: str) -> Optional[Histogram]:
+        return self.histograms.get(name, {}).get(tuple(sorted(labels.items())))
+
+    def reset(self) -> None:
+        self.histograms.clear()
+        self.counters.clear()
+
+    def add_exporter(self, exporter: Exporter) -> None:
+        self.exporters.append(exporter)
+
+    def export(self) -> None:
+        for exporter in self.exporters:
+            exporter.export(self)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'histograms': {
+                name: {labels: {'count': h.count, 'sum': h.sum, 'buckets': h.cumulative()} for labels, h in series.items()}
+                for name, series in self.histograms.items()
+            },
+            'counters': {name: dict(series) for name, series in self.counters.items()},
+        }
+
+
+class Exporter:
+    def export(self, metrics: Metrics) -> None:
+        raise NotImplementedError
+
+
+class MemoryExporter(Exporter):
+    """keeps every exported snapshot, meant for tests"""
+
+    def __init__(self):
+        self.snapshots: List[Dict[str, Any]] = []
+
+    def export(self, metrics: Metrics) -> None:
+        self.snapshots.append(metrics.snapshot())
+
+    @property
+    def last(self) -> Optional[Dict[str, Any]]:
+        return self.snapshots[-1] if self.snapshots else None
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels: Iterable[Tuple[str, Any]]) -> str:
+    labels = [f'{k}="{_escape(v)}"' for k, v in labels]
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+class PrometheusExporter(Exporter):
+    """renders the prometheus text format, `path` (if given) is rewritten atomically on every export
+    so it can be picked up by node_exporter's textfile collector"""
+
+    def __init__(self, path: Optional[str] = None, prefix: str = 'shbot_'):
+        self.path = path
+        self.prefix = prefix
+        self.text = ''
+
+    def render(self, metrics: Metrics) -> str:
+        lines = []
+        for name, series in metrics.counters.items():
+            lines.append(f"# TYPE {self.prefix}{name} counter")
+            for labels, value in series.items():
+                lines.append(f"{self.prefix}{name}{_format_labels(labels)} {value}")
+
+        for name, series in metrics.histograms.items():
+            lines.append(f"# TYPE {self.prefix}{name} histogram")
+            for labels, histogram in series.items():
+                for bound, count in histogram.cumulative():
+                    lines.append(f"{self.prefix}{name}_bucket{_format_labels(labels + (('le', _format_bound(bound)),))} {count}")
+                lines.append(f"{self.prefix}{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{self.prefix}{name}_count{_format_labels(labels)} {histogram.count}")
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, metrics: Metrics) -> None:
+        self.text = self.render(metrics)
+
+        if self.path is not None:
+            temp = f"{self.path}.tmp"
+            with open(temp, 'w') as fp:
+                fp.write(self.text)
+            os.replace(temp, self.path)
+
+
+metrics = Metrics()
@@ -0,0 +1,191 @@
+from __future__ import annotations
+from typing import *
+from collections import deque
+
+import asyncio
+
+from .budget import current_budget
+from .command import CommandOutput, to_bytes
+from .metrics import metrics
+
+__all__: List[str] = ['AttachmentStream', 'Channel', 'ChannelClosedError', 'StreamOutput']
+
+class ChannelClosedError(Exception): pass
+
+class Channel:
+    """a bounded byte channel connecting two pipeline stages,
+    chunks keep the stream (stdout/stderr) they were written to. writers that don't wait for `drain`
+    (eg. a non streaming command writing all its output at once) may go over the limit, what's
+    buffered past it is charged to the memory budget of the script until it's read.
+    `code` is the exit code of the writer, set when it closes the channel"""
+
+    def __init__(self, limit: int = 65536):
+        self.limit = limit
+        self.code = 0
+        self.budget = current_budget.get()
+        self._chunks: Deque[Tuple[bool, bytes]] = deque()
+        self._size = 0
+        self._charged = 0
+        self._closed = False
+        self._discarding = False
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def write_nowait(self, content: bytes, err: bool = False) -> None:
+        if self._closed:
+            raise ChannelClosedError("write to a closed channel")
+
+        if self._discarding or not content:
+            return
+
+        over = self._size + len(content) - self.limit - self._charged
+        if over > 0 and self.budget is not None:
+            self.budget.charge(over)
+            self._charged += over
+
+        self._chunks.append((err, content))
+        self._size += len(content)
+        self._readable.set()
+
+        if self._size >= self.limit:
+            self._writable.clear()
+
+    async def drain(self) -> None:
+        """waits until the reader has brought the buffered size below the limit"""
+        while self._size >= self.limit and not self._discarding:
+            await self._writable.wait()
+
+    async def write(self, content: bytes, err: bool = False) -> None:
+        self.write_nowait(content, err)
+        await self.drain()
+
+    def close(self, code: Optional[int] = None) -> None:
+        if code is not None:
+            self.code = code
+        self._closed = True
+        self._readable.set()
+
+    def _uncharge(self) -> None:
+        excess = max(self._size - self.limit, 0)
+        if self._charged > excess:
+            self.budget.release(self._charged - excess)
+            self._charged = excess
+
+    @property
+    def discarded(self) -> bool:
+        return self._discarding
+
+    def discard(self) -> None:
+        """called when the reader goes away, further writes are dropped and writers never block"""
+        self._discarding = True
+        self._chunks.clear()
+        self._size = 0
+        self._uncharge()
+        self._writable.set()
+
+    async def read_chunk(self) -> Optional[Tuple[bool, bytes]]:
+        """returns the next (err, content) chunk or None at EOF"""
+        while not self._chunks:
+            if self._closed:
+                return None
+
+            self._readable.clear()
+            await self._readable.wait()
+
+        chunk = self._chunks.popleft()
+        self._size -= len(chunk[1])
+        if self._charged:
+            self._uncharge()
+
+        if self._size < self.limit:
+            self._writable.set()
+
+        return chunk
+
+    async def read(self) -> bytes:
+        chunk = await self.read_chunk()
+        return chunk[1] if chunk is not None else b''
+
+    async def __aiter__(self) -> AsyncGenerator[bytes, None]:
+        while (chunk := await self.read_chunk()) is not None:
+            yield chunk[1]
+
+    async def collect(self) -> CommandOutput:
+        """reads everything up to EOF into a CommandOutput, this is what non streaming commands see.
+        like a buffered pipe it carries the exit code of the writer"""
+        out = CommandOutput()
+        while (chunk := await self.read_chunk()) is not None:
+            if chunk[0]:
+                out.stderr_write(chunk[1])
+            else:
+                out.stdout_write(chunk[1])
+
+        out.set_code(self.code)
+        return out
+
+    def __repr__(self) -> str:
+        return f"<Channel size={self._size} limit={self.limit} charged={self._charged} closed={self._closed}>"
+
+
+class StreamOutput(CommandOutput):
+    """a CommandOutput that forwards every write into a Channel instead of buffering it"""
+
+    def __init__(self, channel: Channel, code=0) -> None:
+        super().__init__(code=code)
+        self.channel = channel
+        self.written = 0
+
+    def stdout_write(self, content: Any) -> None:
+        content = to_bytes(content)
+        self.written += len(content)
+        self.channel.write_nowait(content)
+
+    def stderr_write(self, content: Any) -> None:
+        content = to_bytes(content)
+        self.written += len(content)
+        self.channel.write_nowait(content, err=True)
+
+    @property
+    def nbytes(self) -> int:
+        return self.written
+
+    async def drain(self) -> None:
+        await self.channel.drain()
+
+    def close(self) -> None:
+        self.channel.close(self.code)
+
+    def __repr__(self) -> str:
+        return f"<stream={self.channel} code={self.code}>"
+
+
+class AttachmentStream:
+    """an attachment a `<` reads in a streaming pipeline, it's downloaded into the stage's channel
+    while the stage runs instead of being fetched whole before the script starts"""
+    __slots__ = ('ctx', 'attch', 'filename')
+
+    def __init__(self, ctx: Any, attch: Any, filename: str):
+        self.ctx = ctx
+        self.attch = attch
+        self.filename = filename
+
+    async def feed(self, channel: Channel) -> None:
+        """writes the chunks into `channel` as they come in, waiting whenever the reader falls behind,
+        and closes it. stops downloading as soon as the reader goes away"""
+        chunks = self.ctx.stream_attachment_content(self.attch)
+        try:
+            async for chunk in chunks:
+                if channel.discarded:
+                    break
+                if metrics.enabled:
+                    metrics.inc('bytes_in_total', len(chunk), stage='fetch', client=self.ctx.client_name)
+                await channel.write(chunk)
+        finally:
+            # gives the connection back right away instead of whenever the generator is collected
+            if hasattr(chunks, 'aclose'):
+                await chunks.aclose()
+            channel.close()
+
+    def __repr__(self) -> str:
+        return f"<AttachmentStream {repr(self.filename)}>"
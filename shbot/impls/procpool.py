@@ -0,0 +1,132 @@
+from __future__ import annotations
+from typing import *
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import asyncio
+import importlib
+import multiprocessing
+
+__all__: List[str] = ['ProcessPool', 'ProcessPoolTimeoutError', 'process_pool']
+
+class ProcessPoolTimeoutError(Exception): pass
+
+def _init_worker(modules: Sequence[str]) -> None:
+    for module in modules:
+        importlib.import_module(module)
+
+def _ping() -> None:
+    pass
+
+class ProcessPool:
+    """a lazily started ProcessPoolExecutor for work that would otherwise stall the event loop.
+    a worker can't be stopped in the middle of a task, so when one times out or is cancelled while it runs
+    the executor is retired: new tasks go to a fresh one and the old workers are terminated as soon as
+    the other tasks they were running are done"""
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        timeout: Optional[float] = 30.0,
+        preload: Sequence[str] = (),
+        start_method: Optional[str] = None,
+    ):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # the unfinished tasks of the current executor
+        self._tasks: Set[Future] = set()
+        # the retired executors' tasks, waiting for the tasks of theirs that weren't abandoned
+        self._retiring: Set[asyncio.Task] = set()
+        self.timeouts = 0
+        self.retired = 0
+        self.configure(max_workers=max_workers, timeout=timeout, preload=preload, start_method=start_method)
+
+    def configure(
+        self,
+        max_workers: Optional[int] = None,
+        timeout: Optional[float] = 30.0,
+        preload: Sequence[str] = (),
+        start_method: Optional[str] = None,
+    ) -> None:
+        """`preload` lists modules every worker imports when it starts, `timeout` applies to each task"""
+        self.shutdown()
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.preload = tuple(preload)
+        self.start_method = start_method
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context(self.start_method),
+                initializer=_init_worker,
+                initargs=(self.preload,),
+            )
+            self._tasks = set()
+
+        return self._executor
+
+    async def warm_up(self) -> None:
+        """starts every worker process up front instead of on the first tasks"""
+        executor = self.get_executor()
+        await asyncio.gather(*(asyncio.wrap_future(executor.submit(_ping)) for _ in range(self.max_workers)))
+
+    async def run(self, func: Callable[..., Any], *args: Any, timeout: Optional[float] = None) -> Any:
+        """runs a picklable `func` in a worker process"""
+        timeout = timeout if timeout is not None else self.timeout
+        executor = self.get_executor()
+        tasks = self._tasks
+        task = executor.submit(func, *args)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(task), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._abandon(executor, tasks, task)
+            raise ProcessPoolTimeoutError(f"task did not finish within {timeout}s") from None
+        except asyncio.CancelledError:
+            # eg. the command's deadline ran out
+            self._abandon(executor, tasks, task)
+            raise
+
+    def _abandon(self, executor: ProcessPoolExecutor, tasks: Set[Future], task: Future) -> None:
+        # a task that was still queued got cancelled along with its asyncio future, it never took a worker
+        tasks.discard(task)
+        if task.done() or executor is not self._executor:
+            return
+
+        self._executor = None
+        self._tasks = set()
+        self.retired += 1
+        retiring = asyncio.ensure_future(self._retire(executor, set(tasks)))
+        self._retiring.add(retiring)
+        retiring.add_done_callback(self._retiring.discard)
+
+    async def _retire(self, executor: ProcessPoolExecutor, tasks: Set[Future]) -> None:
+        if tasks:
+            await asyncio.wait([asyncio.wrap_future(task) for task in tasks])
+
+        # there's no public way to stop a worker that is busy
+        for process in list(getattr(executor, '_processes', {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self, wait: bool = False) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'running': len(self._tasks),
+            'timeouts': self.timeouts,
+            'retired': self.retired,
+            'retiring': len(self._retiring),
+        }
+
+    def __repr__(self) -> str:
+        return f"<ProcessPool max_workers={self.max_workers} timeout={self.timeout} started={self._executor is not None} {self.stats()}>"
+
+
+process_pool = ProcessPool()
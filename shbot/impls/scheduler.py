@@ -0,0 +1,163 @@
+from __future__ import annotations
+from typing import *
+from collections import OrderedDict, deque
+from time import perf_counter
+
+import asyncio
+
+from ..clients.base import Context
+from .command import Commands
+from .shparser import Instrs
+
+__all__: List[str] = ['Scheduler', 'SchedulerError', 'SchedulerQueueFullError', 'TimingStats']
+
+T = TypeVar('T')
+
+class SchedulerError(Exception): pass
+class SchedulerQueueFullError(SchedulerError): pass
+
+class TimingStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+        }
+
+    def __repr__(self) -> str:
+        return f"<TimingStats {self.as_dict()}>"
+
+
+class Scheduler:
+    """limits how many executions run at once, waiting executions are queued per channel
+    and per user, channels take turns and so do the users within a channel"""
+
+    def __init__(self, max_concurrency: int = 8, max_queue_depth: int = 256, max_user_queue_depth: int = 16):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_user_queue_depth = max_user_queue_depth
+        self.running = 0
+        self.queued = 0
+        self.rejected = 0
+        self.wait_stats = TimingStats()
+        self.run_stats = TimingStats()
+        # channel -> user -> waiters
+        self._queues: OrderedDict[Hashable, OrderedDict[Hashable, Deque[asyncio.Future]]] = OrderedDict()
+
+    async def run(self, ctx: Context, func: Callable[[], Awaitable[T]]) -> T:
+        await self.acquire(ctx)
+        started = perf_counter()
+        try:
+            return await func()
+        finally:
+            self.run_stats.add(perf_counter() - started)
+            self.release()
+
+    async def interpret(self, ctx: Context, interpreter: Any, commands: Commands, instrs: Instrs) -> None:
+        await self.run(ctx, lambda: interpreter.interpret(ctx, commands, instrs))
+
+    async def acquire(self, ctx: Context) -> None:
+        if self.running < self.max_concurrency and not self.queued:
+            self.running += 1
+            self.wait_stats.add(0.0)
+            return
+
+        channel, user = ctx.get_channel_id(), ctx.get_author_id()
+        users = self._queues.get(channel)
+        waiters = users.get(user) if users is not None else None
+
+        if self.queued >= self.max_queue_depth or (waiters is not None and len(waiters) >= self.max_user_queue_depth):
+            self.rejected += 1
+            raise SchedulerQueueFullError(f"too many queued executions, try again later")
+
+        if users is None:
+            users = self._queues[channel] = OrderedDict()
+        if waiters is None:
+            waiters = users[user] = deque()
+
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        self.queued += 1
+        started = perf_counter()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was granted right before the cancellation
+                self.release()
+            else:
+                self._remove(channel, user, waiter)
+            raise
+
+        self.wait_stats.add(perf_counter() - started)
+
+    def release(self) -> None:
+        self.running -= 1
+        self._dispatch()
+
+    def _remove(self, channel: Hashable, user: Hashable, waiter: asyncio.Future) -> None:
+        users = self._queues.get(channel)
+        waiters = users.get(user) if users is not None else None
+        if waiters is None or waiter not in waiters:
+            # a release between the cancellation and now already dropped it
+            return
+
+        waiters.remove(waiter)
+        self.queued -= 1
+
+        if not waiters:
+            del users[user]
+        if not users:
+            del self._queues[channel]
+
+    def _dispatch(self) -> None:
+        while self.running < self.max_concurrency and self._queues:
+            channel, users = next(iter(self._queues.items()))
+            user, waiters = next(iter(users.items()))
+            waiter = waiters.popleft()
+            self.queued -= 1
+
+            if waiters:
+                users.move_to_end(user)
+            else:
+                del users[user]
+
+            if users:
+                self._queues.move_to_end(channel)
+            else:
+                del self._queues[channel]
+
+            if waiter.done():
+                # cancelled while queued, its task hasn't got around to removing it yet
+                continue
+
+            self.running += 1
+            waiter.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'channels': len(self._queues),
+            'wait': self.wait_stats.as_dict(),
+            'run': self.run_stats.as_dict(),
+        }
+
+    def __repr__(self) -> str:
+        return f"<Scheduler running={self.running} queued={self.queued} rejected={self.rejected}>"
@@ -3,12 +3,43 @@
 from __future__ import annotations
 from typing import *
 from enum import Enum
+from time import perf_counter
 
-__all__: List[str] = ["Parser", "Token", "TokenType"]
+import re
+
+from .metrics import metrics
+
+__all__: List[str] = ["Parser", "Token", "TokenType", "Overlay", "split_statements", "format_instrs"]
 
 
 OPERATORS = ["|", ">", "1>", "2>", "<", "<<", "&"]
 EOLS = [";"]
+ENGINES = ["classic", "table"]
+
+# character classes used by the table driven tokenizer
+C_BAD, C_EOL, C_VAR, C_FD, C_OP, C_IN, C_SQUOTE, C_DQUOTE, C_IDENTSYM, C_WS = range(10)
+
+CHAR_CLASSES: Dict[str, int] = {}
+for _c in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789./,:+=-_":
+    CHAR_CLASSES[_c] = C_IDENTSYM
+for _c in " \n\t":
+    CHAR_CLASSES[_c] = C_WS
+for _c in EOLS:
+    CHAR_CLASSES[_c] = C_EOL
+for _c in (">", "|", "&"):
+    CHAR_CLASSES[_c] = C_OP
+CHAR_CLASSES["$"] = C_VAR
+CHAR_CLASSES["1"] = CHAR_CLASSES["2"] = C_FD
+CHAR_CLASSES["<"] = C_IN
+CHAR_CLASSES["'"] = C_SQUOTE
+CHAR_CLASSES['"'] = C_DQUOTE
+
+IDENT_RE = re.compile(r"[a-zA-Z0-9]*")
+HEREDOC_DELIM_RE = re.compile(r"[ \t]*(?:'([^'\n]*)'|\"([^\"\n]*)\"|([a-zA-Z0-9./,:+=\-_]+))")
+IDENTSYM_RE = re.compile(r"[a-zA-Z0-9./,:+=\-_]+")
+WS_RE = re.compile(r"[ \n\t]+")
+VAR_RE = re.compile(r"\$([a-zA-Z0-9]*)")
+ASSIGN_RE = re.compile(r"([a-zA-Z0-9]+)=(.*)", re.S)
 
 
 class TokenType(Enum):
@@ -24,6 +55,12 @@ class InstrType(Enum):
     OUT1: str = '1>'
     OUT2: str = '2>'
     IN: str = '<'
+    HEREDOC: str = '<<'
+    BG: str = '&'
+
+def _shown(value: Any) -> Any:
+    # a heredoc body may be a view of the script, which wouldn't show its content
+    return bytes(value) if type(value) is memoryview else value
 
 class Instr:
     __slots__ = ('instr_type', 'args')
@@ -36,10 +73,30 @@ class Instr:
         self.args.append(arg)
         return self
         
+    def freeze(self) -> FrozenInstr:
+        return FrozenInstr(self.instr_type, *self.args)
+
     def __repr__(self):
-        return f"Instr<type={self.instr_type} args={self.args}>"
+        return f"Instr<type={self.instr_type} args={[_shown(arg) for arg in self.args]}>"
+
+class FrozenInstr(Instr):
+    """immutable Instr, safe to share between concurrent interpretations"""
+    __slots__ = ()
 
-Instrs = List[Instr]
+    def __init__(self, instr_type: InstrType, *args: str):
+        object.__setattr__(self, 'instr_type', instr_type)
+        object.__setattr__(self, 'args', args)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def add_argument(self, arg: str) -> Instr:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def freeze(self) -> FrozenInstr:
+        return self
+
+Instrs = Sequence[Instr]
 
 class Token:
     __slots__ = ('string', 'token_type')
@@ -49,16 +106,45 @@ class Token:
         self.token_type = token_type
 
     def __repr__(self):
-        return f"<string={repr(self.string)}, type={self.token_type}>"
+        return f"<string={repr(_shown(self.string))}, type={self.token_type}>"
 
     def __str__(self):
         return self.string
 
+class Overlay(dict):
+    """variables of its own over a `base` mapping that is shared and never copied nor changed,
+    lookups are a dict lookup or two whatever the size of the base"""
+
+    # the tokenizer notes how many tokens there were after the latest assignment it took back
+    assigned = -1
+
+    def __init__(self, base: Mapping[str, str]):
+        super().__init__()
+        self.base = base
+
+    def __missing__(self, name: str) -> str:
+        return self.base[name]
+
+    def __contains__(self, name: object) -> bool:
+        return dict.__contains__(self, name) or name in self.base
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self[name] if name in self else default
+
+    def __repr__(self) -> str:
+        return f"Overlay({dict.__repr__(self)} over {len(self.base)} variables)"
+
 class ParserError(Exception): pass
 class ParserEOFError(ParserError): pass
 class ParserBadCharError(ParserError): pass
 
 class Parser:
+    def __init__(self, engine: str = "classic"):
+        if engine not in ENGINES:
+            raise ValueError(f"unknown tokenizer engine {repr(engine)}, expected one of {ENGINES}")
+
+        self.engine = engine
+
     def mlc(self, c: str) -> bool:
         """match lower case"""
         return ord(c) >= 97 and ord(c) <= 122
@@ -94,16 +180,126 @@ class Parser:
     def repvars(self, string: str, variables) -> str:
         pass
 
-    def tokenize(self, string: str, variables={}) -> List[Token]:
+    def assign(
+        self,
+        tokens: List[Token],
+        variables: Mapping[str, str],
+        given: Mapping[str, str],
+        temp: Sequence[str] = (),
+        lit: int = -1,
+    ) -> Mapping[str, str]:
+        """called after appending a word with a `=`, if it's a `NAME=value` in front of a statement's command
+        it's taken back and assigns NAME for the rest of the script instead. the word was joined from `temp`,
+        whose first `lit` pieces came before its first quote or expansion (-1 for none), the `NAME=` must be
+        among those so neither `"A=1"` nor a variable holding `A=1` assign anything. returns the variables to
+        expand from then on, the ones `given` to the tokenizer are left alone and get an Overlay on the first assignment"""
+        if len(tokens) > 1 and (tokens[-2].token_type != TokenType.OP or tokens[-2].string not in (";", "&")):
+            return variables
+
+        m = ASSIGN_RE.match(tokens[-1].string)
+        if m is None or (lit >= 0 and sum(map(len, temp[:lit])) <= m.end(1)):
+            return variables
+
+        tokens.pop()
+        if variables is given:
+            variables = Overlay(given)
+        variables[m.group(1)] = m.group(2)
+        variables.assigned = len(tokens)
+        return variables
+
+    @staticmethod
+    def check_assigned(tokens: List[Token], variables: Mapping[str, str], given: Mapping[str, str], op: str) -> None:
+        """raises when the operator `op` would follow an assignment that was taken back, it'd have no command"""
+        if variables is given or variables.assigned != len(tokens):
+            return
+        if op == "&":
+            raise ParserError("assignments can't run in the background, end them with `;` instead")
+
+        raise ParserError(f"assignments need a command or `;` after them, not `{op}`")
+
+    def scan_heredoc(self, string: str, i: int, body_start: int, variables={}, encoded: bytes = b'') -> Tuple[Union[bytes, memoryview], int, int]:
+        """reads the delimiter at `i` (just past the `<<`) and finds the line that ends the body
+        starting at `body_start` with one `find`, the body never goes through the tokenizer loop.
+        `encoded` is the script encoded once when it's ascii, a body without expansions is then a view
+        of it and copied nowhere else, otherwise it's sliced and encoded on its own.
+        returns the body, the end of the delimiter and the end of the terminating line"""
+        m = HEREDOC_DELIM_RE.match(string, i)
+        if m is None:
+            raise ParserError("expected a delimiter after `<<`")
+
+        quoted = m.group(3) is None
+        delim = m.group(3) if not quoted else m.group(1) if m.group(1) is not None else m.group(2)
+
+        if body_start > len(string):
+            raise ParserEOFError(f"EOF while scanning for the heredoc body")
+
+        # the body starts right after a newline, so "\n" + delim finds its last line
+        j = body_start - 1
+        while True:
+            j = string.find("\n" + delim, j)
+            if j == -1:
+                raise ParserEOFError(f"EOF while scanning for the heredoc delimiter {delim}")
+            end = j + 1 + len(delim)
+            if end == len(string) or string[end] == "\n":
+                break
+            j += 1
+
+        if not quoted and string.find("$", body_start, j + 1) != -1:
+            body: Union[bytes, memoryview] = VAR_RE.sub(lambda m: variables[m.group(1)] if m.group(1) in variables else "", string[body_start : j + 1]).encode()
+        elif encoded:
+            body = memoryview(encoded)[body_start : j + 1]
+        else:
+            body = string[body_start : j + 1].encode()
+
+        return body, m.end(), end
+
+    @staticmethod
+    def end_heredoc_line(tokens: List[Token]) -> None:
+        """the statement of a `<<` ends with its body unless its line leaves it open (eg. with `|`)"""
+        if tokens and tokens[-1].token_type == TokenType.STRING:
+            tokens.append(Token(';', TokenType.OP))
+
+    def tokenize(self, string: str, variables={}, client: str = 'unknown') -> List[Token]:
+        """`client` only labels the metrics of the script, it's the name of the client it came from"""
+        tokenize = self.tokenize_table if self.engine == "table" else self.tokenize_classic
+
+        if not metrics.enabled:
+            return tokenize(string, variables)
+
+        started = perf_counter()
+        try:
+            tokens = tokenize(string, variables)
+        except ParserError:
+            metrics.inc('errors_total', stage='tokenize', client=client)
+            raise
+        finally:
+            metrics.observe('stage_seconds', perf_counter() - started, stage='tokenize', client=client)
+
+        # bytes like every other stage counts, not characters
+        metrics.inc('bytes_in_total', len(string) if string.isascii() else len(string.encode()), stage='tokenize', client=client)
+        return tokens
+
+    def tokenize_classic(self, string: str, variables={}) -> List[Token]:
+        """tokenizes by classifying one char at a time"""
+        given = variables
         tokens = []
         temp: List[str] = []
+        # how many pieces of temp came before the word's first quote or expansion, -1 while it has none
+        lit = -1
+        # the newline ending the line with pending heredocs, and where the last of their bodies ends
+        heredoc_nl = heredoc_end = -1
+        # the script as bytes once it has a heredoc, b'' when it isn't ascii
+        encoded: Optional[bytes] = None
         i = 0
         while i < len(string):
             c = string[i]
 
             if c in EOLS:
-                if temp: tokens.append(Token("".join(temp), TokenType.STRING))
+                if temp:
+                    tokens.append(Token(word := "".join(temp), TokenType.STRING))
+                    if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
                 temp.clear()
+                lit = -1
 
                 tokens.append(Token(c, TokenType.OP))
 
@@ -119,6 +315,7 @@ class Parser:
                 i -= 1
                 vtemp_str = "".join(vtemp)
 
+                if lit < 0: lit = len(temp)
                 if vtemp_str in variables:
                     temp.extend(variables[vtemp_str])
 
@@ -127,9 +324,13 @@ class Parser:
                 if j < len(string):
                     if string[j] == ">":
 
-                        if temp: tokens.append(Token("".join(temp), TokenType.STRING))
+                        if temp:
+                            tokens.append(Token(word := "".join(temp), TokenType.STRING))
+                            if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
                         temp.clear()
+                        lit = -1
 
+                        self.check_assigned(tokens, variables, given, c + ">")
                         tokens.append(Token(c + ">", TokenType.OP))
                         i = j
                     else:
@@ -138,20 +339,38 @@ class Parser:
                     temp.append(c)
 
             elif c in (">", "|", "&"):
-                if temp: tokens.append(Token("".join(temp), TokenType.STRING))
+                if temp:
+                    tokens.append(Token(word := "".join(temp), TokenType.STRING))
+                    if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
                 temp.clear()
+                lit = -1
 
+                self.check_assigned(tokens, variables, given, c)
                 tokens.append(Token(c, TokenType.OP))
 
             elif c == "<":
-                if temp: tokens.append(Token("".join(temp), TokenType.STRING))
+                if temp:
+                    tokens.append(Token(word := "".join(temp), TokenType.STRING))
+                    if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
                 temp.clear()
+                lit = -1
 
                 j = i + 1
+                self.check_assigned(tokens, variables, given, "<<" if string.startswith("<", j) else "<")
                 if j < len(string):
                     if string[j] == "<":
+                        if heredoc_nl == -1:
+                            heredoc_nl = string.find("\n", j)
+                            body_start = len(string) + 1 if heredoc_nl == -1 else heredoc_nl + 1
+                        else:
+                            body_start = heredoc_end + 1
+                        if encoded is None:
+                            encoded = string.encode() if string.isascii() else b''
+                        body, j, heredoc_end = self.scan_heredoc(string, j + 1, body_start, variables, encoded)
+
                         tokens.append(Token("<<", TokenType.OP))
-                        i = j
+                        tokens.append(Token(body, TokenType.STRING))
+                        i = j - 1
                     else:
                         tokens.append(Token("<", TokenType.OP))
 
@@ -161,6 +380,7 @@ class Parser:
                 if n == -1:
                     raise ParserEOFError(f"EOF while scanning for the string literal")
 
+                if lit < 0: lit = len(temp)
                 temp.append(string[i + 1 : n])
                 i = n
 
@@ -191,6 +411,7 @@ class Parser:
                         new_content.append(content[j])
                     j += 1
 
+                if lit < 0: lit = len(temp)
                 temp.append("".join(new_content))
                 i = n
 
@@ -204,23 +425,172 @@ class Parser:
                 i -= 1
 
             elif self.mws(c):
-                if temp: tokens.append(Token("".join(temp), TokenType.STRING))
+                if temp:
+                    tokens.append(Token(word := "".join(temp), TokenType.STRING))
+                    if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
                 temp.clear()
+                lit = -1
+
+                if i == heredoc_nl:
+                    self.end_heredoc_line(tokens)
+                    i = heredoc_end - 1
+                    heredoc_nl = -1
 
             else:
                 raise ParserBadCharError(f"Illegal/Bad char {c}")
 
             i += 1
 
-        if temp: tokens.append(Token("".join(temp), TokenType.STRING))
+        if temp:
+            tokens.append(Token(word := "".join(temp), TokenType.STRING))
+            if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
 
         if tokens and ((tokens[-1].token_type == TokenType.OP and tokens[-1].string != ';') or (tokens[-1].token_type == TokenType.STRING)):
             tokens.append(Token(';', TokenType.OP))
 
         return tokens
 
-    def parse(self, tokens: List[Token]) -> Instrs:
-        instrs: Instrs = []
+    def tokenize_table(self, string: str, variables={}) -> List[Token]:
+        """tokenizes by looking up char classes in a table and scanning whole runs at once,
+        the output is identical to `tokenize_classic`"""
+        given = variables
+        tokens: List[Token] = []
+        temp: List[str] = []
+        lit = -1
+        classes = CHAR_CLASSES
+        n = len(string)
+        heredoc_nl = heredoc_end = -1
+        encoded: Optional[bytes] = None
+        i = 0
+        while i < n:
+            c = string[i]
+            cls = classes.get(c, C_BAD)
+
+            if cls == C_IDENTSYM:
+                m = IDENTSYM_RE.match(string, i)
+                temp.append(m.group())
+                i = m.end()
+                continue
+
+            elif cls == C_WS:
+                if temp:
+                    tokens.append(Token(word := "".join(temp), TokenType.STRING))
+                    if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
+                    temp.clear()
+                lit = -1
+                j = WS_RE.match(string, i).end()
+                if i <= heredoc_nl < j:
+                    self.end_heredoc_line(tokens)
+                    j = heredoc_end
+                    heredoc_nl = -1
+                i = j
+                continue
+
+            elif cls == C_EOL or cls == C_OP:
+                if temp:
+                    tokens.append(Token(word := "".join(temp), TokenType.STRING))
+                    if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
+                    temp.clear()
+                lit = -1
+                if c != ";":
+                    self.check_assigned(tokens, variables, given, c)
+                tokens.append(Token(c, TokenType.OP))
+
+            elif cls == C_FD:
+                if string.startswith(">", i + 1):
+                    if temp:
+                        tokens.append(Token(word := "".join(temp), TokenType.STRING))
+                        if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
+                        temp.clear()
+                    lit = -1
+                    self.check_assigned(tokens, variables, given, c + ">")
+                    tokens.append(Token(c + ">", TokenType.OP))
+                    i += 1
+                else:
+                    temp.append(c)
+
+            elif cls == C_VAR:
+                m = IDENT_RE.match(string, i + 1)
+                if lit < 0: lit = len(temp)
+                # like the classic engine an empty value adds nothing, so alone it makes no word
+                if m.group() in variables:
+                    value = variables[m.group()]
+                    if value:
+                        temp.append(value)
+                i = m.end()
+                continue
+
+            elif cls == C_IN:
+                if temp:
+                    tokens.append(Token(word := "".join(temp), TokenType.STRING))
+                    if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
+                    temp.clear()
+                lit = -1
+                self.check_assigned(tokens, variables, given, "<<" if string.startswith("<", i + 1) else "<")
+                if string.startswith("<", i + 1):
+                    if heredoc_nl == -1:
+                        heredoc_nl = string.find("\n", i)
+                        body_start = n + 1 if heredoc_nl == -1 else heredoc_nl + 1
+                    else:
+                        body_start = heredoc_end + 1
+                    if encoded is None:
+                        encoded = string.encode() if string.isascii() else b''
+                    body, i, heredoc_end = self.scan_heredoc(string, i + 2, body_start, variables, encoded)
+
+                    tokens.append(Token("<<", TokenType.OP))
+                    tokens.append(Token(body, TokenType.STRING))
+                    continue
+                elif i + 1 < n:
+                    tokens.append(Token("<", TokenType.OP))
+
+            elif cls == C_SQUOTE:
+                j = string.find("'", i + 1)
+                if j == -1:
+                    raise ParserEOFError(f"EOF while scanning for the string literal")
+                if lit < 0: lit = len(temp)
+                temp.append(string[i + 1 : j])
+                i = j
+
+            elif cls == C_DQUOTE:
+                j = string.find('"', i + 1)
+                if j == -1:
+                    raise ParserEOFError(f"EOF while scanning for the string literal")
+                content = string[i + 1 : j]
+                if "$" in content:
+                    content = VAR_RE.sub(lambda m: variables[m.group(1)] if m.group(1) in variables else "", content)
+                if lit < 0: lit = len(temp)
+                temp.append(content)
+                i = j
+
+            else:
+                raise ParserBadCharError(f"Illegal/Bad char {c}")
+
+            i += 1
+
+        if temp:
+            tokens.append(Token(word := "".join(temp), TokenType.STRING))
+            if "=" in word and lit: variables = self.assign(tokens, variables, given, temp, lit)
+
+        if tokens and (tokens[-1].token_type == TokenType.STRING or tokens[-1].string != ';'):
+            tokens.append(Token(';', TokenType.OP))
+
+        return tokens
+
+    def parse(self, tokens: List[Token], client: str = 'unknown') -> Instrs:
+        if not metrics.enabled:
+            return self.parse_tokens(tokens)
+
+        started = perf_counter()
+        try:
+            return self.parse_tokens(tokens)
+        except Exception:
+            metrics.inc('errors_total', stage='parse', client=client)
+            raise
+        finally:
+            metrics.observe('stage_seconds', perf_counter() - started, stage='parse', client=client)
+
+    def parse_tokens(self, tokens: List[Token]) -> Instrs:
+        instrs: List[Instr] = []
         i = 0
         instr: Instr = Instr(InstrType.EVAL)
         while i < len(tokens):
@@ -234,9 +604,21 @@ class Parser:
 
                     else:
                         raise Exception('EOL ')
+                elif m == '<<':
+                    # the tokenizer always puts the body right after the operator
+                    i += 1
+                    instrs.append(Instr(InstrType.HEREDOC, tokens[i].string))
+
+                elif m in (';', '&') and instr.instr_type == InstrType.EVAL and not instr.args:
+                    # nothing to end, eg. the `;` the tokenizer adds after a trailing `&`
+                    if m == '&':
+                        raise ParserError("expected a command before `&`")
                 else:
                     instrs.append(instr)
-                    if m == '|':
+                    if m == '&':
+                        instrs.append(Instr(InstrType.BG))
+                        instr = Instr(InstrType.EVAL)
+                    elif m == '|':
                         instr = Instr(InstrType.PIPE)
                     elif m == '>':
                         instr = Instr(InstrType.OUT)
@@ -255,6 +637,59 @@ class Parser:
         return instrs
 
 
+def split_statements(instrs: Instrs) -> List[Tuple[List[Instr], bool]]:
+    """splits instructions into statements, each with whether it should run in the background,
+    the `<` and `<<` instructions in front of a statement's first command belong to that statement"""
+    statements: List[Tuple[List[Instr], bool]] = []
+    current: List[Instr] = []
+    pending: List[Instr] = []
+    for instr in instrs:
+        if instr.instr_type in (InstrType.IN, InstrType.HEREDOC):
+            pending.append(instr)
+        elif instr.instr_type == InstrType.BG:
+            statements.append((current + pending, True))
+            current, pending = [], []
+        elif instr.instr_type == InstrType.EVAL:
+            if current:
+                statements.append((current, False))
+            current, pending = pending + [instr], []
+        else:
+            current += pending
+            current.append(instr)
+            pending = []
+
+    if current or pending:
+        statements.append((current + pending, False))
+
+    return statements
+
+def format_instrs(instrs: Instrs) -> str:
+    """renders instructions back into (roughly) the script they came from"""
+    rendered: List[str] = []
+    for statement, background in split_statements(instrs):
+        parts: List[str] = []
+        inputs: List[str] = []
+        for instr in statement:
+            if instr.instr_type == InstrType.IN:
+                inputs.append(f"< {instr.args[0]}")
+                continue
+            if instr.instr_type == InstrType.HEREDOC:
+                inputs.append(f"<< ({len(instr.args[0])} bytes)")
+                continue
+
+            if instr.instr_type == InstrType.EVAL:
+                parts.append(' '.join(instr.args))
+            else:
+                parts.append(f"{instr.instr_type.value} {' '.join(instr.args)}")
+
+            if instr.instr_type in (InstrType.EVAL, InstrType.PIPE):
+                parts += inputs
+                inputs = []
+
+        rendered.append(' '.join(parts + inputs) + (' &' if background else ';'))
+
+    return ' '.join(rendered).rstrip(';')
+
 def test() -> None:
     parser = Parser()
     print(parser.parse(parser.tokenize("""./shparser.py -t 'foo|bar > baz;' < ffff < fff ; lol lolo lol""")))
@@ -268,6 +703,7 @@ if __name__ == "__main__":
     )
     parser.add_argument("--variables", '-v', nargs='+', help="variables to be passed to the tokenizer")
     parser.add_argument("--test", action='store', nargs='*', help="run the test function")
+    parser.add_argument("--engine", '-e', choices=ENGINES, default="classic", help="tokenizer engine to use")
 
     args = parser.parse_args()
 
@@ -277,7 +713,7 @@ if __name__ == "__main__":
         else:
             variables = {}
 
-        parser = Parser()
+        parser = Parser(engine=args.engine)
         tokens = parser.tokenize(args.tokenize, variables=variables)
         print(tokens)
         ast = parser.parse(tokens)
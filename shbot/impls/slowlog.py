@@ -0,0 +1,150 @@
+from __future__ import annotations
+from typing import *
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import time
+
+import cProfile
+import logging
+import os
+import random
+
+__all__: List[str] = ['SlowLog', 'SlowLogEntry', 'Trace', 'slow_log']
+
+log = logging.getLogger(__name__)
+
+class Trace:
+    """what one interpretation spent per op and how many bytes it moved, only kept while the slow log is enabled"""
+    __slots__ = ('times', 'bytes_in', 'bytes_out')
+
+    def __init__(self, size: int):
+        self.times = [0.0] * size
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, index: int, seconds: float) -> None:
+        self.times[index] += seconds
+
+
+class SlowLogEntry:
+    __slots__ = ('started', 'duration', 'client', 'channel', 'author', 'script', 'instrs', 'ops', 'bytes_in', 'bytes_out', 'profile', 'error')
+
+    def __init__(
+        self,
+        started: float,
+        duration: float,
+        client: str,
+        channel: Hashable,
+        author: Hashable,
+        script: str,
+        instrs: Any,
+        ops: List[Tuple[str, float]],
+        bytes_in: int,
+        bytes_out: int,
+        profile: Optional[str] = None,
+        error: Optional[str] = None,
+    ):
+        self.started = started
+        self.duration = duration
+        self.client = client
+        self.channel = channel
+        self.author = author
+        self.script = script
+        self.instrs = instrs
+        self.ops = ops
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.profile = profile
+        self.error = error
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'instrs'}
+
+    def __repr__(self) -> str:
+        return f"<SlowLogEntry {self.duration:.3f}s {self.client} {self.script!r}>"
+
+
+class SlowLog:
+    """keeps the last `maxlen` interpretations that took at least `threshold` seconds. `profile_rate`
+    of all interpretations run under cProfile, their dumps go to `profile_dir` which keeps the newest
+    `max_profiles` of them. dumping and rotating happen on a thread of their own. like metrics it's off until `enabled` is set, which costs one check per script"""
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        threshold: float = 1.0,
+        maxlen: int = 100,
+        profile_rate: float = 0.0,
+        profile_dir: Optional[str] = None,
+        max_profiles: int = 20,
+    ):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles
+        self.entries: Deque[SlowLogEntry] = deque(maxlen=maxlen)
+        self.profiled = 0
+        self.dump_errors = 0
+        self._profiling = False
+        # a single thread, so rotations don't race each other
+        self._dumper = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slowlog')
+
+    def start_profile(self) -> Optional[cProfile.Profile]:
+        """returns a running profiler for a sampled interpretation, or None.
+        it sees everything the event loop runs meanwhile, so only one runs at a time"""
+        if self._profiling or self.profile_dir is None or not self.profile_rate or random.random() >= self.profile_rate:
+            return None
+
+        self._profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop_profile(self, profiler: cProfile.Profile, client: str) -> str:
+        """stops the profiler and has it dumped off the event loop, returns the path of the dump"""
+        profiler.disable()
+        self._profiling = False
+        self.profiled += 1
+
+        path = os.path.join(self.profile_dir, f"{int(time() * 1000)}-{os.getpid()}-{self.profiled}-{client}.prof")
+        self._dumper.submit(self.dump, profiler, path).add_done_callback(self._dumped)
+        return path
+
+    def dump(self, profiler: cProfile.Profile, path: str) -> None:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profiler.dump_stats(path)
+        self.rotate()
+
+    def _dumped(self, future: Future) -> None:
+        err = future.exception()
+        if err is not None:
+            self.dump_errors += 1
+            log.error("couldn't dump a profile to %s", self.profile_dir, exc_info=err)
+
+    def rotate(self) -> None:
+        dumps = sorted(
+            (entry for entry in os.scandir(self.profile_dir) if entry.name.endswith('.prof')),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in dumps[: max(len(dumps) - self.max_profiles, 0)]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def record(self, entry: SlowLogEntry) -> None:
+        self.entries.append(entry)
+
+    def latest(self, n: int = 10) -> List[SlowLogEntry]:
+        """the `n` most recent entries, newest first"""
+        return list(reversed(self.entries))[:n]
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def __repr__(self) -> str:
+        return f"<SlowLog enabled={self.enabled} threshold={self.threshold} entries={len(self.entries)}>"
+
+
+slow_log = SlowLog()
@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+### Replays captured traffic (see clients.capture) through the parser and interpreter with the debug client
+from __future__ import annotations
+from typing import *
+from time import perf_counter
+
+import asyncio
+import json
+import platform
+import random
+
+from .benchmark import CASES, percentile
+from .clients.capture import CaptureEntry, read_capture, write_capture
+from .clients.debug import Context
+from .impls.shparser import Parser, ENGINES
+from .impls.interpreter import Interpreter
+from .impls.cache import ByteLRUCache, attachment_cache, command_cache as default_command_cache
+from .impls.command import commands
+from . import commands as builtin_commands  # registers the builtin commands lazily
+
+__all__: List[str] = ['replay', 'run', 'saturation', 'synthesize']
+
+# a paced run that completes less than this share of what it was offered couldn't keep up
+SATURATED = 0.9
+
+class Attachments:
+    """made up attachment contents of the captured sizes, shared between replayed scripts"""
+
+    def __init__(self, unknown_size: int = 1024):
+        self.unknown_size = unknown_size
+        self._contents: Dict[int, bytes] = {}
+
+    def get(self, sizes: Dict[str, int]) -> Dict[str, bytes]:
+        attachments = {}
+        for name, size in sizes.items():
+            size = size if size >= 0 else self.unknown_size
+            content = self._contents.get(size)
+            if content is None:
+                content = self._contents[size] = b'x' * size
+            attachments[name] = content
+
+        return attachments
+
+
+async def replay(
+    entries: Sequence[CaptureEntry],
+    speed: Optional[float] = 1.0,
+    concurrency: int = 8,
+    engine: str = 'classic',
+    streaming: bool = False,
+    command_cache: bool = True,
+) -> Dict[str, Any]:
+    """plays the entries back `speed` times as fast as they came in, at most `concurrency` at once. latency
+    runs from when a script was due, so it includes the wait for a free slot. with `speed` None every script
+    is started as soon as a slot frees up, which measures how much the interpreter can take"""
+    parser = Parser(engine=engine)
+    # caches of its own, so a run doesn't start warmed up by the ones before it
+    interpreter = Interpreter(
+        streaming=streaming,
+        attachment_cache=ByteLRUCache(max_bytes=attachment_cache.max_bytes),
+        command_cache=ByteLRUCache(max_bytes=default_command_cache.max_bytes, sizeof=default_command_cache.sizeof) if command_cache else None,
+    )
+    attachments = Attachments()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+    finished = 0.0
+
+    async def run_entry(entry: CaptureEntry, due: float) -> None:
+        nonlocal errors, finished
+        ctx = Context(None, attachments=attachments.get(entry.attachments), channel_id=entry.channel, author_id=entry.author, quiet=True)
+        try:
+            # variables aren't captured, the scripts run without any
+            await interpreter.interpret(ctx, commands, parser.parse(parser.tokenize(entry.script, client=ctx.client_name), ctx.client_name), entry.script)
+        except Exception:
+            errors += 1
+        finally:
+            semaphore.release()
+
+        finished = perf_counter()
+        latencies.append(finished - due)
+
+    async def paced(entry: CaptureEntry, due: float) -> None:
+        await semaphore.acquire()
+        await run_entry(entry, due)
+
+    tasks: List[asyncio.Future] = []
+    first = entries[0].offset if entries else 0.0
+    started = perf_counter()
+    for entry in entries:
+        if speed is None:
+            await semaphore.acquire()
+            tasks.append(asyncio.ensure_future(run_entry(entry, perf_counter())))
+            continue
+
+        due = started + (entry.offset - first) / speed
+        delay = due - perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(paced(entry, due)))
+
+    await asyncio.gather(*tasks)
+
+    elapsed = (finished or perf_counter()) - started
+    span = (entries[-1].offset - first) / speed if entries and speed else 0.0
+    offered = len(entries) / span if span > 0 else None
+    throughput = len(entries) / elapsed if elapsed > 0 else 0.0
+    return {
+        'speed': speed,
+        'concurrency': concurrency,
+        'scripts': len(entries),
+        'errors': errors,
+        'elapsed_s': elapsed,
+        'offered_per_s': offered,
+        'throughput_per_s': throughput,
+        'p50_ms': percentile(latencies, 50) * 1e3,
+        'p95_ms': percentile(latencies, 95) * 1e3,
+        'p99_ms': percentile(latencies, 99) * 1e3,
+        'max_ms': max(latencies) * 1e3 if latencies else 0.0,
+        'saturated': offered is not None and throughput < offered * SATURATED,
+    }
+
+def saturation(results: List[Dict[str, Any]]) -> Dict[int, Optional[Dict[str, Any]]]:
+    """for every concurrency, the slowest paced run that couldn't keep up, None if they all did"""
+    points: Dict[int, Optional[Dict[str, Any]]] = {}
+    for result in sorted(results, key=lambda result: (result['concurrency'], result['speed'] or float('inf'))):
+        points.setdefault(result['concurrency'], None)
+        if result['saturated'] and points[result['concurrency']] is None:
+            points[result['concurrency']] = result
+
+    return points
+
+async def run(
+    entries: Sequence[CaptureEntry],
+    speeds: Iterable[Optional[float]] = (1.0, None),
+    concurrencies: Iterable[int] = (8,),
+    engine: str = 'classic',
+    streaming: bool = False,
+    command_cache: bool = True,
+) -> Dict[str, Any]:
+    results = []
+    for concurrency in concurrencies:
+        for speed in speeds:
+            results.append(await replay(entries, speed, concurrency, engine, streaming, command_cache))
+
+    return {
+        'python': platform.python_version(),
+        'engine': engine,
+        'streaming': streaming,
+        'results': results,
+    }
+
+def synthesize(count: int, rate: float = 20.0, channels: int = 16, seed: int = 0) -> List[CaptureEntry]:
+    """made up traffic from the benchmark cases, `rate` scripts per second arriving at random"""
+    rng = random.Random(seed)
+    cases = [case for case in CASES if not case.variables]
+    entries = []
+    offset = 0.0
+    for _ in range(count):
+        offset += rng.expovariate(rate)
+        case = rng.choice(cases)
+        sizes = {name: len(content) for name, content in case.attachments.items()}
+        entries.append(CaptureEntry(offset, rng.randrange(channels), rng.randrange(channels * 8), case.script, sizes))
+
+    return entries
+
+def report(results: Dict[str, Any]) -> str:
+    lines = [
+        f"{'conc':>5} {'speed':>6} {'offered/s':>10} {'done/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}"
+    ]
+    for result in results['results']:
+        speed = f"{result['speed']:g}x" if result['speed'] is not None else 'max'
+        offered = f"{result['offered_per_s']:.1f}" if result['offered_per_s'] is not None else '-'
+        lines.append(
+            f"{result['concurrency']:>5} {speed:>6} {offered:>10} {result['throughput_per_s']:>10.1f} {result['p50_ms']:>9.2f} "
+            f"{result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['errors']:>7}{'  saturated' if result['saturated'] else ''}"
+        )
+
+    lines.append('')
+    for concurrency, point in saturation(results['results']).items():
+        capacity = [result['throughput_per_s'] for result in results['results'] if result['concurrency'] == concurrency and result['speed'] is None]
+        line = f"concurrency {concurrency}: "
+        if point is not None:
+            line += f"saturates at {point['speed']:g}x ({point['offered_per_s']:.1f} scripts/s offered)"
+        else:
+            line += "didn't saturate at the paced speeds"
+        if capacity:
+            line += f", sustains {capacity[0]:.1f} scripts/s at most"
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+def parse_speed(value: str) -> Optional[float]:
+    return None if value == 'max' else float(value.rstrip('x'))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser: Any = argparse.ArgumentParser(description="replays captured traffic through the interpreter")
+    parser.add_argument("capture", metavar="FILE", help="a capture written by clients.capture.Capture")
+    parser.add_argument("--speed", "-s", nargs="+", type=parse_speed, default=[1.0, None], metavar="N",
+                        help="replay speeds, eg. 1 4x max (default: 1 max)")
+    parser.add_argument("--concurrency", "-c", nargs="+", type=int, default=[8], metavar="N", help="scripts running at once")
+    parser.add_argument("--engine", "-e", choices=ENGINES, default="classic", help="tokenizer engine to use")
+    parser.add_argument("--streaming", action="store_true", help="run pipes in streaming mode")
+    parser.add_argument("--no-command-cache", action="store_true", help="don't reuse the outputs of pure commands")
+    parser.add_argument("--limit", "-n", type=int, help="only replay the first N scripts")
+    parser.add_argument("--generate", type=int, metavar="N", help="write N scripts of synthetic traffic to FILE instead")
+    parser.add_argument("--rate", type=float, default=20.0, help="scripts per second of the synthetic traffic")
+    parser.add_argument("--output", "-o", metavar="FILE", help="write the results as json to FILE")
+
+    args = parser.parse_args()
+
+    if args.generate is not None:
+        write_capture(args.capture, synthesize(args.generate, args.rate))
+        print(f"wrote {args.generate} scripts to {args.capture}")
+        raise SystemExit
+
+    entries = read_capture(args.capture)[: args.limit]
+    results = asyncio.run(run(entries, args.speed, args.concurrency, args.engine, args.streaming, not args.no_command_cache))
+
+    print(report(results))
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
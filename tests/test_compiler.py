@@ -0,0 +1,34 @@
+from __future__ import annotations
+from typing import *
+
+import pickle
+
+from shbot.impls.cache import ScriptCache
+from shbot.impls.command import Commands, commands
+from shbot.impls.compiler import OP_EVAL, OP_HEREDOC, compile_program, describe_op
+from shbot.impls.shparser import Parser
+import shbot.commands
+
+def test_pickle_heredoc():
+    """heredoc bodies may be views of the script, a Program holding them still pickles"""
+    parser = Parser()
+    program = compile_program(parser.parse(parser.tokenize("cb << EOF | cb\nsome body\nEOF\necho a & echo b")), commands)
+    loaded = pickle.loads(pickle.dumps(program))
+
+    assert list(map(describe_op, loaded.code)) == list(map(describe_op, program.code))
+    assert [bytes(operand) for op, operand, _ in loaded.code if op == OP_HEREDOC] == [b'some body\n']
+
+def test_script_cache_per_registry():
+    """one ScriptCache serving two registries hands each a Program bound to its own commands"""
+    other = Commands()
+
+    @other.command()
+    async def echo(ctx, out, args, pipe=None):
+        out << "other\n"
+
+    cache = ScriptCache()
+    first = cache.load("echo a", {}, commands)
+    second = cache.load("echo a", {}, other)
+    assert [operand for op, operand, args in first.code if op == OP_EVAL] == [commands.get('echo')]
+    assert [operand for op, operand, args in second.code if op == OP_EVAL] == [other.get('echo')]
+    assert cache.load("echo a", {}, commands) is first
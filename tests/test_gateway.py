@@ -0,0 +1,30 @@
+from __future__ import annotations
+from typing import *
+
+import asyncio
+
+from shbot.clients.debug import Context
+from shbot.impls.gateway import Gateway
+
+def test_concurrent_runs_spawn_once():
+    """scripts arriving together at a worker that isn't running start a single process for it"""
+
+    async def main() -> None:
+        gateway = Gateway(workers=1)
+        spawned = []
+        spawn = gateway._spawn
+
+        async def counted(worker: Any) -> None:
+            await spawn(worker)
+            spawned.append(worker.process)
+
+        gateway._spawn = counted  # type: ignore
+        try:
+            await asyncio.gather(*(gateway.run(Context(None, quiet=True), 'echo hi', {}) for _ in range(3)))
+        finally:
+            await gateway.stop()
+
+        assert len(spawned) == 1
+        assert all(process.returncode is not None for process in spawned)
+
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+from __future__ import annotations
+from typing import *
+
+import asyncio
+
+from shbot.clients.debug import Context
+from shbot.impls.cache import ByteLRUCache, command_cache
+from shbot.impls.command import commands
+from shbot.impls.interpreter import Interpreter
+from shbot.impls.jobs import JobTables, job_tables
+from shbot.impls.metrics import metrics
+from shbot.impls.shparser import Parser
+import shbot.commands
+
+def test_cached_spilled_output_repeats():
+    """a pure command's output that spilled is cached past its script, a second run gets it back whole"""
+
+    async def main() -> List[Tuple[Optional[str], List[bytes]]]:
+        parser = Parser()
+        interpreter = Interpreter(streaming=True, command_cache=ByteLRUCache(max_bytes=64 * 1024 * 1024, sizeof=command_cache.sizeof))
+        sent = []
+        for _ in range(2):
+            ctx = Context(None, attachments={'f': b'x' * (9 * 1024 * 1024)}, quiet=True)
+            budget = await interpreter.interpret(ctx, commands, parser.parse(parser.tokenize('cb < f | echo')))
+            # the output is in the budget once, not once more for the cached copy
+            assert budget.peak < 2 * 9 * 1024 * 1024
+            content, files = ctx.last_sent
+            sent.append((content, [bytes(file.fp) for file in files or ()]))
+        return sent
+
+    first, second = asyncio.run(main())
+    assert first == second
+    # the last page comes with the whole output attached
+    assert [len(content) for content in first[1]] == [len(b"```\n") + 9 * 1024 * 1024 + len(b"```")]
+
+def test_metric_labels_consistent():
+    """each series keeps one set of labels, stages always name their client"""
+
+    async def main() -> None:
+        parser = Parser()
+        interpreter = Interpreter()
+        ctx = Context(None, attachments={'f': 'é'.encode() * 16}, quiet=True)
+        script = "cb < f | echo 'é'"
+        await interpreter.interpret(ctx, commands, parser.parse(parser.tokenize(script, client=ctx.client_name), ctx.client_name), script)
+
+    metrics.reset()
+    metrics.enabled = True
+    try:
+        asyncio.run(main())
+        snapshot = metrics.snapshot()
+    finally:
+        metrics.enabled = False
+        metrics.reset()
+
+    for kind in ('counters', 'histograms'):
+        for name, series in snapshot[kind].items():
+            labels = {tuple(label for label, _ in key) for key in series}
+            assert len(labels) == 1, name
+            if 'stage' in labels.pop():
+                assert all(('client', 'debug') in key for key in series), name
+    assert snapshot['counters']['bytes_in_total'][(('client', 'debug'), ('stage', 'tokenize'))] == len("cb < f | echo 'é'".encode())
+
+def test_job_builtins_use_interpreter_tables():
+    """`wait` sees the jobs of the interpreter's own tables, not the global ones"""
+
+    async def main() -> Tuple[int, int, Optional[str]]:
+        parser = Parser()
+        tables = JobTables()
+        interpreter = Interpreter(job_tables=tables)
+        ctx = Context(None, quiet=True)
+        await interpreter.interpret(ctx, commands, parser.parse(parser.tokenize('echo a &')))
+        spawned = len(tables.get(ctx.get_channel_id()))
+        await interpreter.interpret(ctx, commands, parser.parse(parser.tokenize('wait')))
+        content, _ = ctx.last_sent
+        return spawned, len(job_tables), content
+
+    spawned, global_tables, content = asyncio.run(main())
+    assert spawned == 1 and global_tables == 0
+    assert content == '[1] done     echo a\n'
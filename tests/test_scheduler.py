@@ -0,0 +1,37 @@
+from __future__ import annotations
+from typing import *
+
+import asyncio
+
+from shbot.clients.debug import Context
+from shbot.impls.scheduler import Scheduler
+
+def test_cancel_then_release():
+    """a release landing between a queued acquire's cancellation and its cleanup mustn't lose the slot"""
+
+    async def main() -> None:
+        scheduler = Scheduler(max_concurrency=1)
+        await scheduler.acquire(Context(None, author_id='a', quiet=True))
+
+        task = asyncio.ensure_future(scheduler.acquire(Context(None, author_id='b', quiet=True)))
+        await asyncio.sleep(0)
+        assert scheduler.queued == 1
+
+        # the waiter is cancelled now but the task only handles it on a later iteration
+        task.cancel()
+        scheduler.release()
+
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        assert scheduler.running == 0
+        assert scheduler.queued == 0
+        assert not scheduler._queues
+
+        # the slot is still there to take
+        await asyncio.wait_for(scheduler.acquire(Context(None, author_id='c', quiet=True)), 1)
+        assert scheduler.running == 1
+
+    asyncio.run(main())
@@ -0,0 +1,20 @@
+from __future__ import annotations
+from typing import *
+
+import pytest
+
+from shbot.impls.shparser import ENGINES, Parser, ParserError
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('script', ['A=1 | cb', 'A=1 > f', 'A=1 1> f', 'A=1 2> f', 'A=1 < a', 'A=1 << EOF\nx\nEOF', 'A=1 &'])
+def test_assignment_without_command(engine: str, script: str):
+    """an operator right after an assignment would leave its statement without a command"""
+    parser = Parser(engine=engine)
+    with pytest.raises(ParserError):
+        parser.tokenize(script)
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_assignment_then_statement(engine: str):
+    parser = Parser(engine=engine)
+    instrs = parser.parse(parser.tokenize('A=1; echo $A | cb'))
+    assert [instr.args for instr in instrs] == [['echo', '1'], ['cb']]